@@ -2,13 +2,20 @@
 """
 管理员功能相关API
 """
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from functools import wraps
+import json
+import re
 import traceback
+from datetime import datetime, timedelta
 from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
 
-from models import db, User, RedemptionCode, CreditTransaction, Setting
-from models_supabase import UserSupabase, SettingSupabase, RedemptionCodeSupabase
+from repository import repository, USER_LIST_FIELDS, USER_SORT_COLUMNS
+from tokens import revocation_list
+from passwords import PasswordHasherBusy
+from rate_limit import rate_limit, rate_limiter
+from code_filter import code_filter
+import exports
 
 # 创建管理员蓝图
 admin_bp = Blueprint('admin', __name__, url_prefix='/api/admin')
@@ -28,6 +35,7 @@ def admin_jwt_required(f):
 
 # --- 认证和密码管理 ---
 @admin_bp.route('/login', methods=['POST'])
+@rate_limit('admin_login')
 def admin_login():
     """管理员登录"""
     try:
@@ -48,14 +56,16 @@ def admin_login():
             
         # 检查密码（需要确保数据库中有admin_password设置）
         try:
-            password_valid = SettingSupabase.check_password('admin_password', password)
+            password_valid = repository.check_setting_password('admin_password', password)
+        except PasswordHasherBusy:
+            return jsonify({"error": "登录人数较多，请稍后重试"}), 503
         except Exception as e:
             current_app.logger.error(f"检查管理员密码时出错: {e}")
             # 如果没有设置密码，使用配置中的默认密码
             default_password = current_app.config.get('ADMIN_PASSWORD', 'admin123')
             if password == default_password:
                 # 初始化密码到数据库
-                SettingSupabase.set_password('admin_password', password)
+                repository.set_setting_password('admin_password', password)
                 password_valid = True
             else:
                 password_valid = False
@@ -88,12 +98,12 @@ def admin_change_password():
 
         if not current_password or not new_password:
             return jsonify({"error": "当前密码和新密码都不能为空"}), 400
-        if not SettingSupabase.check_password('admin_password', current_password):
+        if not repository.check_setting_password('admin_password', current_password):
             return jsonify({"error": "当前密码错误"}), 400
         if len(new_password) < 6:
             return jsonify({"error": "新密码长度至少6位"}), 400
 
-        SettingSupabase.set_password('admin_password', new_password)
+        repository.set_setting_password('admin_password', new_password)
         current_app.logger.info("管理员密码已成功修改")
         return jsonify({"success": True, "message": "管理员密码修改成功"}), 200
     except Exception as e:
@@ -101,37 +111,61 @@ def admin_change_password():
         return jsonify({"error": "密码修改失败"}), 500
 
 # --- 用户管理 ---
+def public_user(user):
+    """用户字典中可返回给前端的字段（不包含密码哈希和令牌版本）"""
+    return {field: user.get(field) for field in USER_LIST_FIELDS}
+
 @admin_bp.route('/users', methods=['GET'])
 @admin_jwt_required
 def get_users():
-    """获取用户列表"""
+    """获取用户列表（游标分页）
+
+    参数: cursor, per_page, search（用户名或邮箱）, sort（created_at/credits/last_login）,
+    order（desc/asc）, include_total
+    """
     try:
-        # 获取所有用户（简化版本，不支持分页和搜索）
-        users_data = UserSupabase.get_all()
+        from pagination import InvalidCursor
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        sort = request.args.get('sort', 'created_at')
+        if sort not in USER_SORT_COLUMNS:
+            return jsonify({'error': f'不支持的排序字段: {sort}'}), 400
+        descending = request.args.get('order', 'desc').lower() != 'asc'
+        with_total = request.args.get('include_total', '').lower() in ('1', 'true')
+
+        try:
+            page = repository.users_page(
+                limit=per_page, cursor=request.args.get('cursor'), sort=sort,
+                descending=descending, search=request.args.get('search', ''),
+                with_total=with_total
+            )
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
 
-        # 格式化用户数据
         formatted_users = []
-        for user in users_data:
-            user_dict = {
+        for user in page['items']:
+            is_active = user.get('is_active', True)
+            formatted_users.append({
                 'id': user['id'],
                 'username': user['username'],
                 'email': user['email'],
                 'credits': user['credits'],
-                'is_active': user.get('is_active', True),
-                'is_active_text': '活跃' if user.get('is_active', True) else '禁用',
+                'is_active': is_active,
+                'is_active_text': '活跃' if is_active else '禁用',
                 'created_at': user['created_at'],
                 'last_login': user.get('last_login')
-            }
-            formatted_users.append(user_dict)
+            })
+
+        pagination = {
+            'per_page': per_page,
+            'sort': sort,
+            'order': 'desc' if descending else 'asc',
+            'next_cursor': page['next_cursor'],
+            'has_next': page['next_cursor'] is not None
+        }
+        if with_total:
+            pagination['total_estimate'] = page['total']
 
-        return jsonify({
-            'users': formatted_users,
-            'pagination': {
-                'page': 1, 'per_page': len(formatted_users),
-                'total': len(formatted_users), 'pages': 1,
-                'has_next': False, 'has_prev': False
-            }
-        }), 200
+        return jsonify({'users': formatted_users, 'pagination': pagination}), 200
     except Exception as e:
         current_app.logger.error(f"获取用户列表失败: {e}")
         return jsonify({"error": "获取用户列表失败"}), 500
@@ -139,94 +173,146 @@ def get_users():
 @admin_bp.route('/users/<int:user_id>', methods=['GET'])
 @admin_jwt_required
 def get_user_detail(user_id):
-    """获取用户详细信息"""
+    """获取用户详细信息（含按流水计算的余额、第一页交易记录和已使用的兑换码）"""
     try:
-        # 获取用户信息
-        from supabase_client import get_supabase_manager
-        manager = get_supabase_manager()
-
-        # 获取用户基本信息
-        user_result = manager.client.table('users').select('*').eq('id', user_id).execute()
-        if not user_result.data:
+        user_data = repository.user_detail(user_id)
+        if not user_data:
             return jsonify({"error": "用户不存在"}), 404
 
-        user_data = user_result.data[0]
-
-        # 获取交易记录
-        from models_supabase import CreditTransactionSupabase
-        transactions = CreditTransactionSupabase.get_by_user(user_id)
-
-        # 获取使用的兑换码
-        used_codes_result = manager.client.table('redemption_codes').select('*').eq('used_by_user_id', user_id).execute()
-        used_codes = used_codes_result.data
-
-        formatted_user_data = {
-            'id': user_data['id'],
-            'username': user_data['username'],
-            'email': user_data['email'],
-            'credits': user_data['credits'],
-            'is_active': user_data.get('is_active', True),
-            'is_active_text': '活跃' if user_data.get('is_active', True) else '禁用',
-            'created_at': user_data['created_at'],
-            'last_login': user_data.get('last_login'),
-            'transactions': transactions,
-            'used_codes': used_codes
-        }
-
-        return jsonify({'user': formatted_user_data}), 200
+        is_active = user_data.get('is_active', True)
+        user_data.update({
+            'is_active': is_active,
+            'is_active_text': '活跃' if is_active else '禁用'
+        })
+        return jsonify({'user': user_data}), 200
     except Exception as e:
         current_app.logger.error(f"获取用户详情失败: {e}")
         return jsonify({"error": "获取用户详情失败"}), 500
 
+@admin_bp.route('/users/<int:user_id>/transactions', methods=['GET'])
+@admin_jwt_required
+def get_user_transactions(user_id):
+    """分页获取用户交易记录（游标分页）"""
+    try:
+        from pagination import InvalidCursor
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+        try:
+            page = repository.transactions_page(user_id, limit=per_page, cursor=request.args.get('cursor'))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'transactions': page['items'], 'next_cursor': page['next_cursor']}), 200
+    except Exception as e:
+        current_app.logger.error(f"获取用户交易记录失败: {e}")
+        return jsonify({"error": "获取交易记录失败"}), 500
+
+@admin_bp.route('/users/<int:user_id>/codes', methods=['GET'])
+@admin_jwt_required
+def get_user_used_codes(user_id):
+    """分页获取用户使用过的兑换码（游标分页）"""
+    try:
+        from pagination import InvalidCursor
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 200)
+        try:
+            page = repository.used_codes_page(user_id, limit=per_page, cursor=request.args.get('cursor'))
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'used_codes': page['items'], 'next_cursor': page['next_cursor']}), 200
+    except Exception as e:
+        current_app.logger.error(f"获取用户兑换码失败: {e}")
+        return jsonify({"error": "获取兑换码失败"}), 500
+
 @admin_bp.route('/users/<int:user_id>/credits', methods=['POST'])
 @admin_jwt_required
 def adjust_user_credits(user_id):
-    """调整用户积分"""
+    """调整用户积分（一次RPC完成；只有调整失败时才再查询用户以区分原因）"""
     try:
         data = request.get_json()
         amount = data.get('amount', 0)
         description = data.get('description', '管理员调整')
 
         if amount == 0: return jsonify({'error': '调整数量不能为0'}), 400
-        
-        # 检查用户是否存在
-        from supabase_client import get_supabase_manager
-        manager = get_supabase_manager()
-        user_result = manager.client.table('users').select('*').eq('id', user_id).execute()
-        if not user_result.data:
-            return jsonify({'error': '用户不存在'}), 404
 
         if amount > 0:
-            success = UserSupabase.add_credits(user_id, amount, f"管理员增加: {description}")
+            new_credits = repository.adjust_credits(user_id, amount, 'recharge', f"管理员增加: {description}")
         else:
-            success = UserSupabase.consume_credits(user_id, abs(amount), f"管理员扣减: {description}")
-
-        if success:
-            # 获取更新后的用户信息
-            updated_user = manager.client.table('users').select('*').eq('id', user_id).execute()
-            return jsonify({
-                'message': '积分调整成功',
-                'user': updated_user.data[0] if updated_user.data else None
-            }), 200
-        else:
-            return jsonify({'error': '积分调整失败'}), 400
+            new_credits = repository.adjust_credits(user_id, amount, 'consume', f"管理员扣减: {description}")
+
+        if new_credits is None:
+            if not repository.get_user(user_id, fresh=True):
+                return jsonify({'error': '用户不存在'}), 404
+            return jsonify({'error': '积分调整失败，可用积分不足'}), 400
+
+        return jsonify({
+            'message': '积分调整成功',
+            'user': {'id': user_id, 'credits': new_credits}
+        }), 200
 
     except Exception as e:
         current_app.logger.error(f"调整用户积分失败: {e}")
         return jsonify({'error': '调整积分失败'}), 500
 
+# 单次批量调整最多指定的用户ID数
+MAX_BULK_CREDIT_USERS = 5000
+
+@admin_bp.route('/users/bulk-credits', methods=['POST'])
+@admin_jwt_required
+def bulk_adjust_user_credits():
+    """批量调整积分（如给整个班级发放积分），一个事务内完成
+
+    请求体: {user_ids: [...], username_prefix: 可选, amount, description}
+    返回每个用户的结果和汇总；扣减时余额不足的用户跳过，不影响其他用户
+    """
+    try:
+        data = request.get_json() or {}
+        user_ids = data.get('user_ids') or []
+        username_prefix = (data.get('username_prefix') or '').strip()
+        amount = data.get('amount', 0)
+        description = data.get('description', '管理员批量调整')
+
+        if not isinstance(amount, int) or amount == 0:
+            return jsonify({'error': '调整数量必须为非零整数'}), 400
+        if not isinstance(user_ids, list) or not all(isinstance(i, int) for i in user_ids):
+            return jsonify({'error': 'user_ids必须是用户ID列表'}), 400
+        if len(user_ids) > MAX_BULK_CREDIT_USERS:
+            return jsonify({'error': f'单次最多调整{MAX_BULK_CREDIT_USERS}个用户'}), 400
+        if not user_ids and not username_prefix:
+            return jsonify({'error': '请指定用户ID列表或用户名前缀'}), 400
+
+        if amount > 0:
+            transaction_type, description = 'recharge', f"管理员批量增加: {description}"
+        else:
+            transaction_type, description = 'consume', f"管理员批量扣减: {description}"
+        results = repository.bulk_adjust_credits(
+            user_ids, amount, transaction_type, description, username_prefix=username_prefix
+        )
+
+        summary = {'applied': 0, 'insufficient': 0, 'not_found': 0}
+        for row in results:
+            summary[row['status']] += 1
+        return jsonify({'message': f"已调整 {summary['applied']} 个用户的积分", 'summary': summary, 'results': results}), 200
+    except Exception as e:
+        current_app.logger.error(f"批量调整积分失败: {e}")
+        return jsonify({'error': '批量调整积分失败'}), 500
+
 @admin_bp.route('/users/<int:user_id>/status', methods=['PUT'])
 @admin_jwt_required
 def toggle_user_status(user_id):
     """切换用户状态（启用/禁用）"""
     try:
-        user = User.query.get_or_404(user_id)
-        user.is_active = not user.is_active
-        db.session.commit()
-        status_text = '启用' if user.is_active else '禁用'
-        return jsonify({'message': f'用户已{status_text}', 'user': user.to_dict()}), 200
+        user = repository.get_user(user_id, fresh=True)
+        if not user:
+            return jsonify({'error': '用户不存在'}), 404
+        # 禁用时提升令牌版本，重新启用后旧令牌仍然无效
+        user = repository.set_user_active(user_id, not user['is_active'])
+        if not user:
+            return jsonify({'error': '用户不存在'}), 404
+        if user['is_active']:
+            revocation_list.reinstate(user_id, user.get('token_version') or 0)
+        else:
+            revocation_list.revoke_all(user_id)
+        status_text = '启用' if user['is_active'] else '禁用'
+        return jsonify({'message': f'用户已{status_text}', 'user': public_user(user)}), 200
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(f"切换用户状态失败: {e}")
         return jsonify({'error': '操作失败'}), 500
 
@@ -240,16 +326,94 @@ def reset_user_password(user_id):
         if not new_password or len(new_password) < 6:
             return jsonify({'error': '新密码不能为空且长度至少6位'}), 400
         
-        user = User.query.get_or_404(user_id)
-        user.set_password(new_password)
-        db.session.commit()
-        current_app.logger.info(f"管理员重置了用户 {user.username} 的密码")
-        return jsonify({'message': f'用户 {user.username} 的密码已重置', 'new_password': new_password}), 200
+        user = repository.get_user(user_id, fresh=True)
+        if not user:
+            return jsonify({'error': '用户不存在'}), 404
+        token_version = (user.get('token_version') or 0) + 1
+        repository.set_password(user_id, new_password, token_version=token_version)
+        revocation_list.revoke(user_id, token_version)
+        current_app.logger.info(f"管理员重置了用户 {user['username']} 的密码")
+        return jsonify({'message': f"用户 {user['username']} 的密码已重置", 'new_password': new_password}), 200
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(f"重置用户密码失败: {e}")
         return jsonify({'error': '重置密码失败'}), 500
 
+# --- 批量导入 ---
+MAX_IMPORT_ROWS = 5000
+
+def prepare_import_rows(rows, default_credits=10):
+    """校验批量导入的用户数据，返回 (有效行, 错误列表)"""
+    from auth import validate_username, validate_password
+
+    valid_rows, errors = [], []
+    seen_usernames, seen_emails = set(), set()
+    for line, row in enumerate(rows, start=1):
+        username = str(row.get('username') or '').strip()
+        email = str(row.get('email') or '').strip().lower()
+        password = str(row.get('password') or '')
+
+        is_valid, msg = validate_username(username)
+        if is_valid:
+            is_valid, msg = validate_password(password)
+        if is_valid and not re.match(r'^[^@\s]+@[^@\s]+\.[^@\s]+$', email):
+            is_valid, msg = False, "邮箱格式错误"
+        if is_valid and (username in seen_usernames or email in seen_emails):
+            is_valid, msg = False, "与导入数据中的其他行重复"
+        if not is_valid:
+            errors.append({'line': line, 'username': username, 'error': msg})
+            continue
+
+        # 只有未填写时才使用默认值（0 是有效的积分）
+        credits = row.get('credits')
+        if credits is None or (isinstance(credits, str) and not credits.strip()):
+            credits = default_credits
+        try:
+            credits = int(credits)
+        except (TypeError, ValueError):
+            errors.append({'line': line, 'username': username, 'error': '积分必须为整数'})
+            continue
+        if credits < 0:
+            errors.append({'line': line, 'username': username, 'error': '积分不能为负数'})
+            continue
+
+        seen_usernames.add(username)
+        seen_emails.add(email)
+        valid_rows.append({'username': username, 'email': email, 'password': password, 'credits': credits})
+    return valid_rows, errors
+
+@admin_bp.route('/users/import', methods=['POST'])
+@admin_jwt_required
+def import_users():
+    """批量导入用户（班级账号）"""
+    try:
+        data = request.get_json() or {}
+        rows = data.get('users') or []
+        if not isinstance(rows, list) or not rows:
+            return jsonify({'error': '导入数据不能为空'}), 400
+        if len(rows) > MAX_IMPORT_ROWS:
+            return jsonify({'error': f'单次最多导入{MAX_IMPORT_ROWS}个用户'}), 400
+
+        try:
+            default_credits = int(data.get('credits', 10))
+        except (TypeError, ValueError):
+            return jsonify({'error': '默认积分必须为整数'}), 400
+        if default_credits < 0:
+            return jsonify({'error': '默认积分不能为负数'}), 400
+
+        valid_rows, errors = prepare_import_rows(rows, default_credits)
+        result = repository.bulk_create_users(valid_rows) if valid_rows else {'created': [], 'skipped': []}
+
+        current_app.logger.info(f"管理员批量导入用户: 成功 {len(result['created'])} 个，跳过 {len(result['skipped'])} 个")
+        return jsonify({
+            'message': '导入完成',
+            'created': len(result['created']),
+            'skipped': result['skipped'],
+            'errors': errors
+        }), 200
+    except Exception as e:
+        current_app.logger.error(f"批量导入用户失败: {e}")
+        return jsonify({'error': '批量导入用户失败'}), 500
+
 # --- 兑换码管理 ---
 @admin_bp.route('/codes/generate', methods=['POST'])
 @admin_jwt_required
@@ -261,56 +425,192 @@ def generate_redemption_code():
         if not credits_value or credits_value <= 0:
             return jsonify({'error': '积分数值必须为正数'}), 400
 
-        redemption_code = RedemptionCode.create_code(
-            credits_value=credits_value,
+        redemption_code = repository.create_code(
+            credits_value,
             description=data.get('description'),
             expires_days=data.get('expires_days')
         )
-        db.session.add(redemption_code)
-        db.session.commit()
-        return jsonify({'message': '兑换码生成成功', 'redemption_code': redemption_code.to_dict()}), 201
+        if not redemption_code:
+            return jsonify({'error': '生成兑换码失败'}), 500
+        code_filter.added([redemption_code['code']])
+        return jsonify({'message': '兑换码生成成功', 'redemption_code': redemption_code}), 201
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(f"生成兑换码失败: {e}")
         return jsonify({'error': '生成兑换码失败'}), 500
 
+# 单次批量生成的兑换码数量上限
+MAX_MINT_CODES = 100000
+CODE_CSV_FIELDS = ['code', 'credits_value', 'expires_at', 'description']
+
+@admin_bp.route('/codes/bulk-generate', methods=['POST'])
+@admin_jwt_required
+def bulk_generate_redemption_codes():
+    """批量生成兑换码，以CSV流的形式边生成边返回"""
+    data = request.get_json() or {}
+    count = data.get('count')
+    credits_value = data.get('credits_value')
+    if not isinstance(count, int) or not 0 < count <= MAX_MINT_CODES:
+        return jsonify({'error': f'生成数量必须在1到{MAX_MINT_CODES}之间'}), 400
+    if not isinstance(credits_value, int) or credits_value <= 0:
+        return jsonify({'error': '积分数值必须为正数'}), 400
+
+    batches = repository.bulk_create_codes(
+        count, credits_value,
+        description=data.get('description'),
+        expires_days=data.get('expires_days')
+    )
+
+    def generate():
+        try:
+            yield from exports.iter_csv(batches, CODE_CSV_FIELDS)
+        except Exception as e:
+            # 响应已开始发送，无法再修改状态码，在CSV末尾标明错误
+            current_app.logger.error(f"批量生成兑换码失败: {e}")
+            yield f"# 生成中断: {e}\n"
+
+    filename = f"codes_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@admin_bp.route('/export/<kind>', methods=['GET'])
+@admin_jwt_required
+def export_table(kind):
+    """流式导出用户/兑换码/交易记录
+
+    参数: format（ndjson/csv，默认ndjson）, gzip（1时输出.gz文件）,
+    user_id（仅transactions，按用户过滤）, used（仅codes，true/false）
+    """
+    if kind not in exports.EXPORTS:
+        return jsonify({'error': f'不支持的导出类型: {kind}'}), 400
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in exports.FORMATS:
+        return jsonify({'error': f'不支持的导出格式: {fmt}'}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true')
+
+    filters = {}
+    if kind == 'transactions' and request.args.get('user_id'):
+        filters['user_id'] = request.args.get('user_id', type=int)
+    if kind == 'codes' and request.args.get('used'):
+        filters['is_used'] = request.args.get('used').lower() in ('1', 'true')
+
+    try:
+        chunks = exports.iter_export(kind, fmt, filters)
+    except Exception as e:
+        # 第一页读取失败时响应尚未开始，返回错误状态码
+        current_app.logger.error(f"导出{kind}失败: {e}")
+        return jsonify({'error': f'导出{kind}失败'}), 500
+
+    def generate():
+        try:
+            yield from chunks
+        except Exception as e:
+            # 响应已开始发送，无法再修改状态码，在文件末尾标明错误
+            current_app.logger.error(f"导出{kind}失败: {e}")
+            if fmt == 'ndjson':
+                yield json.dumps({'error': f'导出中断: {e}'}, ensure_ascii=False) + '\n'
+            else:
+                yield f"# 导出中断: {e}\n"
+
+    filename = exports.export_filename(kind, fmt, compress, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    return Response(
+        stream_with_context(exports.encode_chunks(generate(), compress)),
+        mimetype='application/gzip' if compress else exports.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
 @admin_bp.route('/codes', methods=['GET'])
 @admin_jwt_required
 def list_redemption_codes():
-    """获取兑换码列表"""
+    """获取兑换码列表（游标分页，按创建顺序倒序）
+
+    参数: cursor, per_page, include_total
+    """
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
-        
-        query = RedemptionCode.query.order_by(RedemptionCode.created_at.desc())
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-        
-        return jsonify({
-            'codes': [code.to_dict() for code in pagination.items],
-            'pagination': {
-                'page': pagination.page, 'per_page': pagination.per_page,
-                'total': pagination.total, 'pages': pagination.pages
-            }
-        }), 200
+        from pagination import InvalidCursor
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        with_total = request.args.get('include_total', '').lower() in ('1', 'true')
+        try:
+            page = repository.codes_page(limit=per_page, cursor=request.args.get('cursor'), with_total=with_total)
+        except InvalidCursor as e:
+            return jsonify({'error': str(e)}), 400
+
+        pagination = {
+            'per_page': per_page,
+            'next_cursor': page['next_cursor'],
+            'has_next': page['next_cursor'] is not None
+        }
+        if with_total:
+            pagination['total_estimate'] = page['total']
+        return jsonify({'codes': page['items'], 'pagination': pagination}), 200
     except Exception as e:
         current_app.logger.error(f"获取兑换码列表失败: {e}")
         return jsonify({'error': '获取兑换码列表失败'}), 500
 
 # --- 统计数据 ---
+@admin_bp.route('/rate-limits', methods=['GET'])
+@admin_jwt_required
+def get_rate_limit_stats():
+    """获取限流计数（各接口放行/拒绝次数）"""
+    return jsonify({'rate_limits': rate_limiter.stats()}), 200
+
+@admin_bp.route('/idempotency', methods=['GET'])
+@admin_jwt_required
+def get_idempotency_stats():
+    """获取幂等键统计（avoided为避免的重复执行次数）"""
+    from idempotency import idempotency_stats
+    return jsonify({'idempotency': idempotency_stats.stats()}), 200
+
+@admin_bp.route('/code-filter', methods=['GET'])
+@admin_jwt_required
+def get_code_filter_stats():
+    """获取兑换码过滤器统计（rejected为未访问数据库直接拒绝的次数）"""
+    return jsonify({'code_filter': code_filter.stats()}), 200
+
 @admin_bp.route('/stats', methods=['GET'])
 @admin_jwt_required
 def get_stats():
-    """获取系统统计数据"""
+    """获取系统统计数据（读取触发器维护的计数，不扫描全表）"""
     try:
-        total_users = User.query.count()
-        total_credits = db.session.query(db.func.sum(User.credits)).scalar() or 0
-        total_codes = RedemptionCode.query.count()
-        used_codes = RedemptionCode.query.filter(RedemptionCode.is_used == True).count()
-
+        stats = repository.usage_summary()
         return jsonify({
-            'users': {'total': total_users, 'total_credits': total_credits},
-            'codes': {'total': total_codes, 'used': used_codes}
+            'users': {'total': stats['users'], 'total_credits': stats['total_credits']},
+            'codes': {'total': stats['codes'], 'used': stats['used_codes']},
+            'generations': {'total': stats['generations']},
+            'transactions': {'total': stats['transactions']}
         }), 200
     except Exception as e:
         current_app.logger.error(f"获取统计数据失败: {e}")
         return jsonify({"error": "获取统计数据失败"}), 500
+
+# 每日用量最多查询的天数
+MAX_USAGE_DAYS = 366
+
+@admin_bp.route('/stats/daily', methods=['GET'])
+@admin_jwt_required
+def get_daily_stats():
+    """按天的用量序列（?days=30），没有记录的日期补0，可直接用于趋势图"""
+    try:
+        days = min(max(request.args.get('days', 30, type=int), 1), MAX_USAGE_DAYS)
+        end = datetime.now().date()
+        start = end - timedelta(days=days - 1)
+        rows = {row['day']: row for row in repository.daily_usage(start, end)}
+
+        series = []
+        for offset in range(days):
+            day = (start + timedelta(days=offset)).isoformat()
+            row = rows.get(day, {})
+            series.append({
+                'day': day,
+                'generations': int(row.get('generations') or 0),
+                'credits_consumed': int(row.get('credits_consumed') or 0),
+                'redemptions': int(row.get('redemptions') or 0),
+                'credits_redeemed': int(row.get('credits_redeemed') or 0),
+                'signups': int(row.get('signups') or 0)
+            })
+        return jsonify({'days': series}), 200
+    except Exception as e:
+        current_app.logger.error(f"获取每日用量失败: {e}")
+        return jsonify({"error": "获取每日用量失败"}), 500
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import csv
+import click
 from datetime import timedelta
 from flask import Flask, jsonify, request
 from flask_cors import CORS
@@ -9,11 +11,14 @@ from flask_migrate import Migrate
 from dotenv import load_dotenv
 import traceback
 
-from models import db, User, RedemptionCode, Setting
+from models import db
 from auth import auth_bp, setup_jwt_error_handlers
 from credits import credits_bp
 from admin import admin_bp
 from image_proxy import image_proxy_bp
+from repository import repository
+import sqlite_engine
+import query_stats
 
 load_dotenv()
 
@@ -84,14 +89,8 @@ if database_url.startswith('postgresql'):
         'pool_timeout': 30       # 连接超时时间
     }
 else:
-    # SQLite 配置
-    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-        'pool_size': 3,          # 减少连接池大小
-        'pool_recycle': 300,     # 5分钟回收连接
-        'pool_pre_ping': True,   # 连接前检查
-        'max_overflow': 0,       # 不允许超出连接池
-        'pool_timeout': 20       # 连接超时时间
-    }
+    # SQLite 配置（WAL等PRAGMA在引擎创建后设置，见 sqlite_engine.py）
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = sqlite_engine.engine_options()
 app.config['ADMIN_USERNAME'] = os.getenv('ADMIN_USERNAME', 'admin')
 
 # --- 初始化扩展 ---
@@ -101,13 +100,17 @@ cors = CORS(app,
      origins="*",  # 允许所有域名
      supports_credentials=False,  # 通配符模式下必须设为False
      methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
-     allow_headers=['Content-Type', 'Authorization', 'Accept', 'X-Requested-With'],
-     expose_headers=['Content-Type', 'Authorization'])
+     allow_headers=['Content-Type', 'Authorization', 'Accept', 'X-Requested-With', 'Idempotency-Key'],
+     expose_headers=['Content-Type', 'Authorization', 'Retry-After', 'Idempotent-Replayed'])
 print("CORS配置完成")
 db.init_app(app)
+if database_url.startswith('sqlite'):
+    with app.app_context():
+        sqlite_engine.configure_engine(db.engine)
 jwt = JWTManager(app)
 setup_jwt_error_handlers(jwt) # 注册自定义JWT错误处理器
 migrate = Migrate(app, db) # 初始化 Flask-Migrate
+query_stats.init_app(app)   # 按请求统计SQL和REST查询（Server-Timing响应头、慢请求日志、N+1告警）
 
 # --- 注册蓝图 ---
 app.register_blueprint(auth_bp)
@@ -115,6 +118,15 @@ app.register_blueprint(credits_bp)
 app.register_blueprint(admin_bp)
 app.register_blueprint(image_proxy_bp)
 
+# --- 后台任务 ---
+from ledger_snapshots import ledger_snapshot_job
+from ledger_outbox import ledger_outbox
+from ledger_archive import ledger_archive_job
+ledger_snapshot_job.start()  # 定期写入积分余额快照
+ledger_archive_job.start()   # 定期归档保留期之前的积分流水（LEDGER_ARCHIVE_SECONDS，默认不启动）
+ledger_outbox.start()        # 提交上次未发送的积分结算操作，并开始批量提交
+repository.start()           # 数据访问后端的后台任务（SQLite单机模式的WAL检查点）
+
 # --- CORS调试和备用处理 ---
 @app.before_request
 def before_request():
@@ -129,8 +141,8 @@ def after_request(response):
     # 手动添加CORS头作为备用
     response.headers['Access-Control-Allow-Origin'] = '*'
     response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, X-Requested-With'
-    response.headers['Access-Control-Expose-Headers'] = 'Content-Type, Authorization'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, Accept, X-Requested-With, Idempotency-Key'
+    response.headers['Access-Control-Expose-Headers'] = 'Content-Type, Authorization, Retry-After, Idempotent-Replayed'
     return response
 
 # --- 数据库和初始数据设置 ---
@@ -140,19 +152,16 @@ def init_db_seed():
     with app.app_context():
         try:
             # 初始化管理员密码
-            if not Setting.query.get('admin_password'):
+            if not repository.get_setting('admin_password'):
                 print("初始化管理员密码...")
                 initial_password = app.config['ADMIN_PASSWORD']
-                Setting.set_password('admin_password', initial_password)
+                repository.set_setting_password('admin_password', initial_password)
                 print("管理员密码已初始化并存入数据库。")
 
             # 创建测试用户
-            if User.query.count() == 0:
+            if repository.count_users() == 0:
                 print("创建测试用户...")
-                test_user = User(username='testuser', email='test@example.com', credits=50)
-                test_user.set_password('123456')
-                db.session.add(test_user)
-                db.session.commit()
+                repository.create_user('testuser', 'test@example.com', '123456', credits=50)
                 print("测试数据创建成功")
             else:
                 print("数据库中已存在用户，跳过创建测试用户。")
@@ -161,6 +170,144 @@ def init_db_seed():
             print(f"数据库植入初始数据时发生错误: {e}")
             traceback.print_exc()
 
+@app.cli.command("import-users")
+@click.argument('csv_path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--credits', default=10, help='未在CSV中指定积分时的初始积分')
+@click.option('--batch-size', default=500, help='每批插入的用户数')
+def import_users_command(csv_path, credits, batch_size):
+    """从CSV批量导入用户（列: username,email,password[,credits]）"""
+    from admin import prepare_import_rows
+
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        rows = list(csv.DictReader(f))
+
+    valid_rows, errors = prepare_import_rows(rows, credits)
+    for error in errors:
+        print(f"第 {error['line']} 行 ({error['username']}): {error['error']}")
+
+    print(f"开始导入 {len(valid_rows)} 个用户...")
+    result = repository.bulk_create_users(valid_rows, batch_size=batch_size)
+    print(f"导入完成: 成功 {len(result['created'])} 个，已存在跳过 {len(result['skipped'])} 个，"
+          f"数据错误 {len(errors)} 行")
+
+@app.cli.command("mint-codes")
+@click.argument('count', type=int)
+@click.option('--credits', 'credits_value', required=True, type=int, help='每个兑换码的积分数')
+@click.option('--description', default=None, help='兑换码描述')
+@click.option('--expires-days', default=None, type=int, help='有效期（天），不指定则永不过期')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='CSV输出文件（默认标准输出）')
+def mint_codes_command(count, credits_value, description, expires_days, output):
+    """批量生成兑换码并导出为CSV"""
+    import time
+    from admin import CODE_CSV_FIELDS
+    from exports import iter_csv
+
+    start = time.perf_counter()
+    minted = 0
+
+    def counted(batches):
+        nonlocal minted
+        for batch in batches:
+            minted += len(batch)
+            yield batch
+
+    batches = repository.bulk_create_codes(count, credits_value, description, expires_days)
+    for chunk in iter_csv(counted(batches), CODE_CSV_FIELDS):
+        output.write(chunk)
+    click.echo(f"已生成 {minted} 个兑换码，耗时 {time.perf_counter() - start:.1f} 秒", err=True)
+
+@app.cli.command("export")
+@click.argument('kind', type=click.Choice(['users', 'codes', 'transactions']))
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson', help='输出格式')
+@click.option('--gzip', 'compress', is_flag=True, help='gzip压缩输出')
+@click.option('--user-id', default=None, type=int, help='只导出该用户的交易记录（仅transactions）')
+@click.option('--output', type=click.File('wb'), default='-', help='输出文件（默认标准输出）')
+def export_command(kind, fmt, compress, user_id, output):
+    """流式导出用户、兑换码或交易记录（内存占用与表大小无关）"""
+    import time
+    import exports
+
+    start = time.perf_counter()
+    filters = {'user_id': user_id} if kind == 'transactions' and user_id else None
+    written = 0
+    for data in exports.encode_chunks(exports.iter_export(kind, fmt, filters), compress):
+        output.write(data)
+        written += len(data)
+    click.echo(f"已导出 {kind}，共 {written / 1024 / 1024:.1f} MB，耗时 {time.perf_counter() - start:.1f} 秒", err=True)
+
+@app.cli.command("expire-credit-holds")
+def expire_credit_holds_command():
+    """释放所有已过期的积分预留（可配置为定时任务）"""
+    expired = repository.expire_holds()
+    print(f"已释放 {expired} 个过期的积分预留")
+
+@app.cli.command("snapshot-credits")
+@click.option('--settle-seconds', default=300, help='只包含该秒数之前写入的流水')
+def snapshot_credits_command(settle_seconds):
+    """立即为有新流水的用户写入积分余额快照"""
+    written = repository.write_snapshots(settle_seconds)
+    print(f"已写入 {written} 个积分余额快照")
+
+@app.cli.command("archive-credits")
+@click.option('--retention-days', default=None, type=int, help='保留最近多少天的流水（默认 ARCHIVE_RETENTION_DAYS）')
+@click.option('--batch-rows', default=None, type=int, help='每批归档的行数（默认 ARCHIVE_BATCH_ROWS）')
+@click.option('--compression', type=click.Choice(['zstd', 'gzip']), default=None,
+              help='压缩格式（默认 ARCHIVE_COMPRESSION）')
+def archive_credits_command(retention_days, batch_rows, compression):
+    """把保留期之前的积分流水计入快照后移到压缩文件（可配置为定时任务）"""
+    import time
+    import ledger_archive
+
+    start = time.perf_counter()
+    try:
+        summary = ledger_archive.archive_transactions(
+            retention_days=ledger_archive.ARCHIVE_RETENTION_DAYS if retention_days is None else retention_days,
+            batch_rows=batch_rows or ledger_archive.ARCHIVE_BATCH_ROWS,
+            compression=compression or ledger_archive.ARCHIVE_COMPRESSION
+        )
+    except ledger_archive.ArchiveDirNotConfigured as e:
+        raise click.ClickException(str(e))
+    print(f"已归档 {summary['before']} 之前的流水 {summary['transactions']} 条，"
+          f"写入 {summary['files']} 个文件（{summary['bytes'] / 1024 / 1024:.1f} MB），耗时 {time.perf_counter() - start:.1f} 秒")
+    print(f"新写入快照 {summary['snapshots']} 个，删除旧快照 {summary['pruned_snapshots']} 个")
+
+@app.cli.command("archived-transactions")
+@click.option('--user-id', default=None, type=int, help='只输出该用户的流水')
+@click.option('--from', 'start', default=None, type=click.DateTime(['%Y-%m-%d']), help='开始日期（包含）')
+@click.option('--to', 'end', default=None, type=click.DateTime(['%Y-%m-%d']), help='结束日期（包含）')
+@click.option('--output', type=click.File('w', encoding='utf-8'), default='-', help='NDJSON输出文件（默认标准输出）')
+def archived_transactions_command(user_id, start, end, output):
+    """以NDJSON输出已归档的积分流水"""
+    from exports import iter_ndjson
+    from ledger_archive import iter_archived
+
+    written = 0
+    for row in iter_archived(user_id, start.date() if start else None, end.date() if end else None):
+        output.write(next(iter_ndjson([[row]])))
+        written += 1
+    click.echo(f"已输出 {written} 条归档流水", err=True)
+
+@app.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """从基础表重新计算统计计数和每日用量汇总（会短暂阻塞写入）"""
+    stats = repository.rebuild_usage_stats()
+    print("统计计数已重建:")
+    for name, value in stats.items():
+        print(f"  {name}: {value}")
+
+@app.cli.command("reconcile-credits")
+@click.option('--all', 'check_all', is_flag=True, help='检查全部用户（默认只检查快照后有流水的用户）')
+@click.option('--repair', is_flag=True, help='以积分流水为准修复不一致的余额')
+def reconcile_credits_command(check_all, repair):
+    """核对用户余额与积分流水"""
+    mismatches = repository.reconcile_credits(check_all=check_all, repair=repair)
+    for row in mismatches:
+        line = f"用户 {row['user_id']}: 余额 {row['credits']}，流水合计 {row['ledger_credits']}"
+        if repair:
+            line += f"，已修复为 {row['repaired_credits']}"
+        print(line)
+    print(f"对账完成: {len(mismatches)} 个用户不一致")
+
 # --- 通用API路由 ---
 @app.route('/', methods=['GET'])
 def root():
@@ -170,17 +317,11 @@ def root():
 @app.route('/api/health', methods=['GET'])
 def health_check():
     try:
-        # 使用Supabase REST API进行健康检查
-        from supabase_client import get_supabase_manager
-        manager = get_supabase_manager()
-
-        if manager.is_connected() and manager.test_connection():
-            db_status = 'connected'
-        else:
-            db_status = 'disconnected'
+        # 检查当前数据访问后端（DATA_BACKEND）的数据库
+        db_status = 'connected' if repository.ping() else 'disconnected'
     except Exception:
         db_status = 'disconnected'
-    return jsonify({'status': 'healthy', 'database': db_status}), 200
+    return jsonify({'status': 'healthy', 'database': db_status, 'backend': repository.name}), 200
 
 @app.route('/api/config-check', methods=['GET'])
 def config_check():
@@ -228,7 +369,6 @@ def initialize_database():
 
         # 使用Supabase REST API进行检查
         from supabase_client import get_supabase_manager
-        from models_supabase import SettingSupabase, UserSupabase
 
         manager = get_supabase_manager()
 
@@ -244,20 +384,20 @@ def initialize_database():
 
         # 检查管理员密码设置
         try:
-            admin_password = SettingSupabase.get('admin_password')
+            admin_password = repository.get_setting('admin_password')
             if not admin_password:
                 print("创建管理员密码设置...")
                 initial_password = app.config['ADMIN_PASSWORD']
-                SettingSupabase.set_password('admin_password', initial_password)
+                repository.set_setting_password('admin_password', initial_password)
                 print(f"管理员密码已初始化: {initial_password}")
             else:
                 print("管理员密码已存在")
 
             # 检查用户数据
-            users = UserSupabase.get_all()
-            if len(users) == 0:
+            user_count = repository.count_users()
+            if user_count == 0:
                 print("创建测试用户...")
-                test_user = UserSupabase.create(
+                test_user = repository.create_user(
                     username='testuser',
                     email='test@example.com',
                     password='123456',
@@ -268,7 +408,7 @@ def initialize_database():
                 else:
                     print("测试用户创建失败")
             else:
-                print(f"数据库已有 {len(users)} 个用户")
+                print(f"数据库已有 {user_count} 个用户")
 
         except Exception as api_error:
             print(f"Supabase API操作错误: {api_error}")
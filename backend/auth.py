@@ -11,8 +11,17 @@ from flask_jwt_extended import JWTManager, jwt_required, create_access_token, ge
 from marshmallow import Schema, fields, ValidationError
 import re
 
-from models import db, User, CreditTransaction
-from models_supabase import UserSupabase, RedemptionCodeSupabase
+from repository import repository
+from pagination import InvalidCursor
+from passwords import PasswordHasherBusy
+from supabase_client import DuplicateKeyError
+from idempotency import idempotent
+from code_filter import code_filter
+from rate_limit import rate_limit
+from tokens import (
+    create_user_token, decode_request_token, is_token_revoked, claims_to_user,
+    revocation_list, TOKEN_VERSION_CLAIM
+)
 
 # 创建认证蓝图
 auth_bp = Blueprint('auth', __name__, url_prefix='/api/auth')
@@ -44,32 +53,54 @@ def validate_password(password):
     return True, ""
 
 # 认证装饰器
-def auth_required(f):
-    """需要登录的装饰器"""
-    @wraps(f)
-    @jwt_required()
-    def decorated_function(*args, **kwargs):
-        try:
-            current_user_id = int(get_jwt_identity())  # 转换为整数
-            # 使用Supabase获取用户信息
-            from supabase_client import get_supabase_manager
-            manager = get_supabase_manager()
-            result = manager.client.table('users').select('*').eq('id', current_user_id).execute()
-
-            if not result.data:
-                return jsonify({'error': '用户不存在'}), 401
-
-            current_user_data = result.data[0]
-            if not current_user_data.get('is_active', True):
-                return jsonify({'error': '用户已被禁用'}), 401
-
-            return f(current_user_data, *args, **kwargs)
-        except Exception as e:
-            return jsonify({'error': '认证失败'}), 401
-    return decorated_function
+def auth_required(f=None, *, fresh=False, stateless=False):
+    """需要登录的装饰器
+
+    用户信息优先从进程内缓存读取；fresh=True 或请求头带
+    Cache-Control: no-cache 时强制从数据库读取最新数据。
+    stateless=True 时直接使用令牌声明（id/username/is_active）鉴权，
+    不读取用户数据，适用于只需要用户ID的接口
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated_function(*args, **kwargs):
+            # 令牌缺失或无效时由JWT错误处理器返回401
+            claims = decode_request_token()
+            if is_token_revoked(claims):
+                return jsonify({'error': '登录已失效，请重新登录'}), 401
+
+            try:
+                if stateless:
+                    current_user_data = claims_to_user(claims)
+                    if current_user_data:
+                        return func(current_user_data, *args, **kwargs)
+
+                current_user_id = int(claims['sub'])  # 转换为整数
+                force_fresh = fresh or 'no-cache' in request.headers.get('Cache-Control', '')
+                # 获取用户信息（带缓存）
+                current_user_data = repository.get_user(current_user_id, fresh=force_fresh)
+
+                if not current_user_data:
+                    return jsonify({'error': '用户不存在'}), 401
+
+                if not current_user_data.get('is_active', True):
+                    return jsonify({'error': '用户已被禁用'}), 401
+
+                if claims.get(TOKEN_VERSION_CLAIM, 0) < current_user_data.get('token_version', 0):
+                    return jsonify({'error': '登录已失效，请重新登录'}), 401
+
+                return func(current_user_data, *args, **kwargs)
+            except Exception as e:
+                return jsonify({'error': '认证失败'}), 401
+        return decorated_function
+
+    if f is not None:
+        return decorator(f)
+    return decorator
 
 # 路由定义
 @auth_bp.route('/register', methods=['POST'])
+@rate_limit('register')
 def register():
     """用户注册"""
     try:
@@ -90,29 +121,24 @@ def register():
         if not is_valid:
             return jsonify({'error': msg}), 400
         
-        # 检查用户名和邮箱是否已存在
-        if UserSupabase.get_by_username(username):
+        # 创建新用户（用户名和邮箱的唯一性由数据库约束保证，一次插入完成）
+        try:
+            user_data = repository.create_user(
+                username=username,
+                email=email,
+                password=password,
+                credits=10  # 新用户赠送10积分
+            )
+        except DuplicateKeyError as e:
+            if e.field == 'email':
+                return jsonify({'error': '邮箱已被注册'}), 400
             return jsonify({'error': '用户名已存在'}), 400
 
-        if UserSupabase.get_by_email(email):
-            return jsonify({'error': '邮箱已被注册'}), 400
-
-        # 创建新用户
-        user_data = UserSupabase.create(
-            username=username,
-            email=email,
-            password=password,
-            credits=10  # 新用户赠送10积分
-        )
-
         if not user_data:
             return jsonify({'error': '用户创建失败'}), 500
 
         # 生成访问令牌
-        access_token = create_access_token(
-            identity=str(user_data['id']),
-            expires_delta=timedelta(days=7)
-        )
+        access_token = create_user_token(user_data)
 
         return jsonify({
             'message': '注册成功',
@@ -129,11 +155,14 @@ def register():
         
     except ValidationError as e:
         return jsonify({'error': '输入数据格式错误', 'details': e.messages}), 400
+    except PasswordHasherBusy:
+        return jsonify({'error': '注册人数较多，请稍后重试'}), 503
     except Exception as e:
         current_app.logger.error(f"注册错误: {str(e)}")
         return jsonify({'error': '注册失败，请稍后重试'}), 500
 
 @auth_bp.route('/login', methods=['POST'])
+@rate_limit('login')
 def login():
     """用户登录"""
     try:
@@ -148,25 +177,25 @@ def login():
         user_data = None
         if '@' in login_input:
             # 邮箱登录
-            user_data = UserSupabase.get_by_email(login_input.lower())
+            user_data = repository.get_user_by_email(login_input.lower())
         else:
             # 用户名登录
-            user_data = UserSupabase.get_by_username(login_input)
+            user_data = repository.get_user_by_username(login_input)
 
-        if not user_data or not UserSupabase.check_password(user_data, password):
+        if not user_data or not repository.check_password(user_data, password):
             return jsonify({'error': '用户名/邮箱或密码错误'}), 401
 
         if not user_data.get('is_active', True):
             return jsonify({'error': '账户已被禁用'}), 401
 
+        # bcrypt成本因子配置变化时透明升级密码哈希
+        repository.upgrade_password_hash(user_data, password)
+
         # 更新最后登录时间
-        UserSupabase.update_last_login(user_data['id'])
+        repository.update_last_login(user_data['id'])
 
         # 生成访问令牌
-        access_token = create_access_token(
-            identity=str(user_data['id']),
-            expires_delta=timedelta(days=7)
-        )
+        access_token = create_user_token(user_data)
 
         return jsonify({
             'message': '登录成功',
@@ -183,6 +212,8 @@ def login():
         
     except ValidationError as e:
         return jsonify({'error': '输入数据格式错误', 'details': e.messages}), 400
+    except PasswordHasherBusy:
+        return jsonify({'error': '登录人数较多，请稍后重试'}), 503
     except Exception as e:
         current_app.logger.error(f"登录错误: {str(e)}")
         return jsonify({'error': '登录失败，请稍后重试'}), 500
@@ -207,7 +238,7 @@ def get_profile(current_user_data):
         return jsonify({'error': '获取用户信息失败'}), 500
 
 @auth_bp.route('/change-password', methods=['POST'])
-@auth_required
+@auth_required(fresh=True)
 def change_password(current_user):
     """用户修改密码"""
     try:
@@ -229,29 +260,40 @@ def change_password(current_user):
         if new_password != confirm_password:
             return jsonify({'error': '两次输入的新密码不一致'}), 400
 
-        # 验证当前密码
-        if not current_user.check_password(current_password):
+        # 验证当前密码（缓存的用户记录不含密码哈希，单独读取）
+        credentials = repository.get_user_credentials(current_user['id'])
+        if not repository.check_password(credentials, current_password):
             return jsonify({'error': '当前密码错误'}), 400
 
         # 检查新密码是否与当前密码相同
-        if current_user.check_password(new_password):
+        if repository.check_password(credentials, new_password):
             return jsonify({'error': '新密码不能与当前密码相同'}), 400
 
-        # 设置新密码
-        current_user.set_password(new_password)
+        # 设置新密码并提升令牌版本，使旧令牌全部失效
+        token_version = current_user.get('token_version', 0) + 1
+        if not repository.set_password(current_user['id'], new_password, token_version=token_version):
+            return jsonify({'error': '修改密码失败'}), 500
+        revocation_list.revoke(current_user['id'], token_version)
 
         # 记录操作日志
-        current_app.logger.info(f"用户 {current_user.username} 修改了密码")
-
-        db.session.commit()
+        current_app.logger.info(f"用户 {current_user['username']} 修改了密码")
 
         return jsonify({
             'message': '密码修改成功',
-            'user': current_user.to_dict()
+            'access_token': create_user_token({**current_user, 'token_version': token_version}),
+            'user': {
+                'id': current_user['id'],
+                'username': current_user['username'],
+                'email': current_user['email'],
+                'credits': current_user['credits'],
+                'created_at': current_user['created_at'],
+                'last_login': current_user.get('last_login')
+            }
         }), 200
 
+    except PasswordHasherBusy:
+        return jsonify({'error': '服务繁忙，请稍后重试'}), 503
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(f"修改密码错误: {str(e)}")
         return jsonify({'error': '修改密码失败'}), 500
 
@@ -273,7 +315,9 @@ def logout():
         return jsonify({'error': '登出失败'}), 500
 
 @auth_bp.route('/redeem', methods=['POST'])
+@rate_limit('redeem')
 @auth_required
+@idempotent('redeem')
 def redeem_code(current_user):
     """兑换积分码"""
     try:
@@ -283,64 +327,91 @@ def redeem_code(current_user):
         
         code = data['code'].strip().upper()  # 转换为大写
         
-        # 查找兑换码
-        from models import RedemptionCode
-        redemption_code = RedemptionCode.query.filter_by(code=code).first()
-        
-        if not redemption_code:
+        # 不存在的兑换码直接拒绝，不访问数据库
+        if not code_filter.might_exist(code):
             return jsonify({'error': '兑换码不存在'}), 404
         
-        # 验证兑换码有效性
-        is_valid, message = redemption_code.is_valid()
-        if not is_valid:
-            return jsonify({'error': message}), 400
-        
-        # 执行兑换
-        transaction = redemption_code.redeem(current_user)
-        db.session.commit()
+        # 条件更新兑换码并增加积分（一次数据库调用，并发兑换同一个码只有一个成功）
+        outcome = repository.redeem_code(code, current_user['id'])
+        status = outcome.get('status')
+        if status == 'not_found':
+            return jsonify({'error': '兑换码不存在'}), 404
+        if status == 'used':
+            return jsonify({'error': '兑换码已被使用'}), 400
+        if status == 'expired':
+            return jsonify({'error': '兑换码已过期'}), 400
         
         return jsonify({
-            'message': f'兑换成功！获得 {redemption_code.credits_value} 积分',
-            'credits_added': redemption_code.credits_value,
-            'current_credits': current_user.credits,
-            'transaction': transaction.to_dict()
+            'message': f"兑换成功！获得 {outcome['credits_added']} 积分",
+            'credits_added': outcome['credits_added'],
+            'current_credits': outcome['credits'],
+            'transaction': {
+                'transaction_type': 'recharge',
+                'credits_amount': outcome['credits_added']
+            }
         }), 200
         
     except ValidationError as e:
         return jsonify({'error': '输入数据格式错误', 'details': e.messages}), 400
-    except ValueError as e:
-        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(f"兑换码错误: {str(e)}")
         return jsonify({'error': '兑换失败，请稍后重试'}), 500
 
 @auth_bp.route('/transactions', methods=['GET'])
-@auth_required
+@auth_required(stateless=True)
 def get_transactions(current_user):
-    """获取用户积分交易记录"""
+    """获取用户积分交易记录（游标分页：?cursor=上一页返回的next_cursor）"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = min(request.args.get('per_page', 20, type=int), 100)
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        cursor = request.args.get('cursor')
+        with_total = request.args.get('include_total', '').lower() in ('1', 'true')
+        
+        page = repository.transactions_page(
+            current_user['id'], limit=per_page, cursor=cursor, with_total=with_total
+        )
+        
+        pagination = {
+            'per_page': per_page,
+            'next_cursor': page['next_cursor'],
+            'has_next': page['next_cursor'] is not None
+        }
+        if with_total:
+            pagination['total_estimate'] = page['total']
+        
+        return jsonify({
+            'transactions': page['items'],
+            'pagination': pagination
+        }), 200
         
-        transactions = CreditTransaction.query.filter_by(user_id=current_user.id)\
-            .order_by(CreditTransaction.created_at.desc())\
-            .paginate(page=page, per_page=per_page, error_out=False)
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"获取交易记录错误: {str(e)}")
+        return jsonify({'error': '获取交易记录失败'}), 500
+
+@auth_bp.route('/transactions/archived', methods=['GET'])
+@auth_required(stateless=True)
+def get_archived_transactions(current_user):
+    """获取已归档的历史交易记录（超过保留期、已移出交易记录表的部分；游标分页同 /transactions）"""
+    try:
+        from ledger_archive import archived_page
+
+        per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+        page = archived_page(current_user['id'], limit=per_page, cursor=request.args.get('cursor'))
         
         return jsonify({
-            'transactions': [t.to_dict() for t in transactions.items],
+            'transactions': page['items'],
             'pagination': {
-                'page': page,
                 'per_page': per_page,
-                'total': transactions.total,
-                'pages': transactions.pages,
-                'has_next': transactions.has_next,
-                'has_prev': transactions.has_prev
+                'next_cursor': page['next_cursor'],
+                'has_next': page['next_cursor'] is not None
             }
         }), 200
         
+    except InvalidCursor as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
-        current_app.logger.error(f"获取交易记录错误: {str(e)}")
+        current_app.logger.error(f"获取归档交易记录错误: {str(e)}")
         return jsonify({'error': '获取交易记录失败'}), 500
 
 # JWT错误处理
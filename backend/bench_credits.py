@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+积分并发扣减压力测试
+N个并发客户端同时对同一用户扣减积分，验证不会超扣（最终余额与交易记录数一致），
+并报告每秒完成的扣减操作数
+
+用法:
+    python bench_credits.py --backend sql                      # 使用REPOSITORY_DATABASE_URL或DATABASE_URL对应的数据库
+    python bench_credits.py --backend sql --database-url sqlite:////tmp/bench.db
+    python bench_credits.py --backend supabase --debits 500 --clients 32
+"""
+
+import argparse
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_sql(debits, clients, balance, database_url=None):
+    """通过数据访问层的直连后端扣减积分（SqlRepository / PostgresRepository.adjust_credits，与线上路径相同）"""
+    from sqlalchemy import delete, func, select
+    from cache import user_cache
+    from repository_sql import create_sql_repository, users, transactions
+
+    repository = create_sql_repository(
+        database_url or os.getenv('REPOSITORY_DATABASE_URL') or os.getenv('DATABASE_URL')
+    )
+    name = f'bench_{uuid.uuid4().hex[:8]}'
+    user_id = repository.create_user(name, f'{name}@bench.local', 'bench-password', credits=balance)['id']
+
+    def debit(_):
+        try:
+            return repository.adjust_credits(user_id, -1, 'consume', '压力测试扣减') is not None
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(debit, range(debits)))
+    elapsed = time.perf_counter() - start
+
+    final_credits = repository.get_user(user_id, fresh=True)['credits']
+    with repository.engine.begin() as conn:
+        ledger = conn.execute(
+            select(func.count()).select_from(transactions)
+            .where(transactions.c.user_id == user_id, transactions.c.transaction_type == 'consume')
+        ).scalar()
+        conn.execute(delete(transactions).where(transactions.c.user_id == user_id))
+        conn.execute(delete(users).where(users.c.id == user_id))
+    user_cache.delete(user_id)
+    return results, elapsed, final_credits, ledger
+
+
+def run_supabase(debits, clients, balance):
+    """通过adjust_credits RPC扣减积分"""
+    from models_supabase import UserSupabase
+    from supabase_client import get_supabase_manager
+
+    manager = get_supabase_manager()
+    name = f'bench_{uuid.uuid4().hex[:8]}'
+    user = UserSupabase.create(name, f'{name}@bench.local', 'bench-password', credits=balance)
+    user_id = user['id']
+
+    def debit(_):
+        try:
+            return UserSupabase.consume_credits(user_id, 1, '压力测试扣减')
+        except Exception:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(debit, range(debits)))
+    elapsed = time.perf_counter() - start
+
+    final_credits = UserSupabase.get_by_id(user_id, fresh=True)['credits']
+    ledger = manager.client.table('credit_transactions').select('id', count='exact') \
+        .eq('user_id', user_id).eq('transaction_type', 'consume').execute().count
+    manager.client.table('credit_transactions').delete().eq('user_id', user_id).execute()
+    manager.client.table('users').delete().eq('id', user_id).execute()
+    return results, elapsed, final_credits, ledger
+
+
+def main():
+    parser = argparse.ArgumentParser(description='积分并发扣减压力测试')
+    parser.add_argument('--backend', choices=['sql', 'supabase'], default='sql', help='测试的数据访问路径')
+    parser.add_argument('--debits', type=int, default=200, help='扣减次数（每次1积分）')
+    parser.add_argument('--clients', type=int, default=16, help='并发客户端数')
+    parser.add_argument('--balance', type=int, default=None, help='初始余额（默认为扣减次数的一半）')
+    parser.add_argument('--database-url', default=None, help='sql后端的数据库地址（默认REPOSITORY_DATABASE_URL或DATABASE_URL）')
+    args = parser.parse_args()
+
+    balance = args.balance if args.balance is not None else args.debits // 2
+    if args.backend == 'sql':
+        results, elapsed, final_credits, ledger = run_sql(args.debits, args.clients, balance, args.database_url)
+    else:
+        results, elapsed, final_credits, ledger = run_supabase(args.debits, args.clients, balance)
+
+    succeeded = sum(1 for r in results if r)
+    refused = sum(1 for r in results if r is False)
+    errors = sum(1 for r in results if r is None)
+    expected_success = min(balance, args.debits - errors)
+
+    print(f"后端: {args.backend}, 初始余额: {balance}, 扣减: {args.debits}, 并发客户端: {args.clients}")
+    print(f"成功: {succeeded}, 余额不足: {refused}, 错误: {errors}")
+    print(f"最终余额: {final_credits}, 扣减交易记录: {ledger}")
+    print(f"吞吐量: {args.debits / elapsed:.1f} 次/秒 ({elapsed:.2f}s)")
+
+    ok = (final_credits >= 0
+          and final_credits == balance - succeeded
+          and ledger == succeeded
+          and succeeded == expected_success)
+    print("✅ 未出现超扣" if ok else "❌ 余额或交易记录不一致")
+    return ok
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+登录吞吐量基准测试
+在不同bcrypt成本因子下，通过密码哈希线程池并发验证密码，报告每秒登录数
+
+用法:
+    python bench_login.py                    # 默认测试成本 8 10 12
+    python bench_login.py 10 12 14 --logins 200 --clients 16
+"""
+
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import passwords
+from passwords import password_hasher, PasswordHasherBusy
+
+
+def bench_cost(rounds, logins, clients):
+    """在指定成本因子下并发执行logins次密码验证"""
+    password_hash = passwords.hash_password('bench-password', rounds=rounds)
+
+    def login(_):
+        try:
+            return passwords.check_password('bench-password', password_hash)
+        except PasswordHasherBusy:
+            return None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(login, range(logins)))
+    elapsed = time.perf_counter() - start
+
+    ok = sum(1 for r in results if r)
+    rejected = sum(1 for r in results if r is None)
+    return ok, rejected, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='登录吞吐量基准测试')
+    parser.add_argument('costs', nargs='*', type=int, default=[8, 10, 12], help='bcrypt成本因子')
+    parser.add_argument('--logins', type=int, default=100, help='每个成本因子的登录次数')
+    parser.add_argument('--clients', type=int, default=8, help='并发客户端数')
+    args = parser.parse_args()
+
+    print(f"哈希线程数: {password_hasher.workers}, 排队上限: {password_hasher.queue_limit}, "
+          f"并发客户端: {args.clients}")
+    print(f"{'成本':>4} {'登录/秒':>10} {'单次(ms)':>10} {'成功':>6} {'拒绝':>6}")
+
+    for rounds in args.costs:
+        ok, rejected, elapsed = bench_cost(rounds, args.logins, args.clients)
+        rate = ok / elapsed if elapsed > 0 else 0
+        per_login = elapsed / max(ok, 1) * 1000 * min(args.clients, password_hasher.workers)
+        print(f"{rounds:>4} {rate:>10.1f} {per_login:>10.1f} {ok:>6} {rejected:>6}")
+
+    return True
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+查询列裁剪效果测试
+对用户和交易记录的常用查询，分别以 select('*') 和实际使用的列执行，
+报告每次请求的响应大小和解码时分配的内存
+
+用法:
+    python bench_payload.py                       # 需要配置SUPABASE_URL和SUPABASE_SERVICE_KEY
+    python bench_payload.py --rows 500 --iterations 50
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tracemalloc
+
+from supabase_client import get_supabase_manager, USER_COLUMNS
+from models_supabase import CreditTransactionSupabase
+
+
+def measure(query_factory, iterations):
+    """执行查询，返回 (响应JSON字节数, 每次请求分配内存的中位数)"""
+    payload = 0
+    allocations = []
+    for _ in range(iterations):
+        tracemalloc.start()
+        data = query_factory().execute().data
+        allocations.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        payload = len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+    return payload, statistics.median(allocations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查询列裁剪效果测试')
+    parser.add_argument('--rows', type=int, default=100, help='每次查询读取的行数')
+    parser.add_argument('--iterations', type=int, default=20, help='每种查询的执行次数')
+    args = parser.parse_args()
+
+    manager = get_supabase_manager()
+    if not manager.is_connected():
+        print("❌ Supabase未连接，请检查SUPABASE_URL和SUPABASE_SERVICE_KEY")
+        return False
+
+    queries = {
+        'users': ('users', USER_COLUMNS),
+        'credit_transactions': ('credit_transactions', CreditTransactionSupabase.PAGE_COLUMNS),
+    }
+    for name, (table, columns) in queries.items():
+        print(f"{name}（每次 {args.rows} 行，{args.iterations} 次）")
+        baseline = None
+        for label, selected in (('*', '*'), ('裁剪后', columns)):
+            payload, allocated = measure(
+                lambda: manager.client.table(table).select(selected).order('id').limit(args.rows),
+                args.iterations
+            )
+            change = f"  ({(payload / baseline[0] - 1) * 100:+.0f}% / {(allocated / baseline[1] - 1) * 100:+.0f}%)" if baseline else ''
+            print(f"  {label:<6} 响应 {payload / 1024:8.1f} KB   内存分配 {allocated / 1024:8.1f} KB{change}")
+            baseline = baseline or (payload, allocated)
+    return True
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
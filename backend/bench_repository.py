@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+数据访问后端延迟对比
+对每个后端（supabase / postgres / sqlite）依次执行请求热路径上的操作，
+报告每种操作的P50/P95延迟（毫秒）和吞吐量；--clients 大于1时多个线程同时执行，
+可比较SQLite单机模式（单写连接+只读连接池）与REST路径在并发下的表现
+
+用法:
+    python bench_repository.py --backends sqlite
+    python bench_repository.py --backends supabase,postgres --iterations 200
+    python bench_repository.py --backends supabase,sqlite --clients 16
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def run_backend(name, iterations, database_url, clients=1):
+    """对一个后端执行各项操作，返回 {操作: ([耗时毫秒], 总耗时秒)}"""
+    from repository import create_repository
+
+    if name == 'sqlite' and not database_url:
+        database_url = f"sqlite:///{os.path.join(tempfile.gettempdir(), 'bench_repository.db')}"
+    repo = create_repository(name, database_url if name != 'supabase' else None)
+    if name == 'sqlite':
+        # 本地SQLite需要先建表
+        from models import db
+        db.metadata.create_all(repo.engine)
+
+    user_name = f'bench_{uuid.uuid4().hex[:8]}'
+    user = repo.create_user(user_name, f'{user_name}@bench.local', 'bench-password', credits=iterations * 10)
+    user_id = user['id']
+    repo.set_setting('bench_setting', user_name)
+
+    operations = {
+        'get_user': lambda: repo.get_user(user_id, fresh=True),
+        'adjust_credits': lambda: repo.adjust_credits(user_id, -1, 'consume', '延迟测试扣减'),
+        'hold_release': lambda: repo.release_hold(repo.place_hold(user_id, 1, '延迟测试预留', 60)['hold_id']),
+        'transactions_page': lambda: repo.transactions_page(user_id, limit=20),
+        'get_setting': lambda: repo.get_setting('bench_setting'),
+    }
+
+    def timed(call):
+        start = time.perf_counter()
+        call()
+        return (time.perf_counter() - start) * 1000
+
+    timings = {}
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for operation, call in operations.items():
+            list(pool.map(lambda _: call(), range(clients)))  # 预热（建立连接）
+            start = time.perf_counter()
+            samples = list(pool.map(lambda _: timed(call), range(iterations)))
+            timings[operation] = (samples, time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据访问后端延迟对比')
+    parser.add_argument('--backends', default='supabase,postgres,sqlite', help='逗号分隔的后端列表')
+    parser.add_argument('--iterations', type=int, default=100, help='每种操作的执行次数')
+    parser.add_argument('--clients', type=int, default=1, help='并发执行的线程数')
+    parser.add_argument('--database-url', default=None, help='postgres/sqlite后端的数据库地址（默认读取环境变量）')
+    args = parser.parse_args()
+
+    ok = True
+    for name in [b.strip() for b in args.backends.split(',') if b.strip()]:
+        try:
+            timings = run_backend(name, args.iterations, args.database_url, args.clients)
+        except Exception as e:
+            print(f"❌ 后端 {name} 测试失败: {e}")
+            ok = False
+            continue
+
+        print(f"后端: {name}, 每项操作 {args.iterations} 次, 并发 {args.clients}")
+        for operation, (samples, elapsed) in timings.items():
+            print(f"  {operation:<18} P50 {statistics.median(samples):8.2f} ms   P95 {percentile(samples, 0.95):8.2f} ms"
+                  f"   {args.iterations / elapsed:8.0f} 次/秒")
+    return ok
+
+
+if __name__ == '__main__':
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,512 @@
+# -*- coding: utf-8 -*-
+"""
+缓存后端
+为用户、设置缓存和限流计数、幂等键等提供统一接口，支持TTL、原子自增和比较并设置(CAS)：
+
+- memory://                 进程内缓存（单worker部署）
+- sqlite:///path/to/file.db 本机共享文件缓存（同一主机上的多个gunicorn worker共享）
+- redis://host:port/db      Redis协议缓存（多节点共享，可用 redis_standin.py 在本地测试）
+
+通过环境变量 CACHE_URL 选择后端。限流计数和幂等键使用各自独立、有容量上限的存储
+（进程内为独立的LRU，SQLite为独立的表），大量写入其他缓存条目不会把它们挤出
+"""
+import abc
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(abc.ABC):
+    """缓存后端接口
+
+    值必须可以JSON序列化；ttl单位为秒，None表示使用后端默认TTL
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """获取缓存值，过期或不存在时返回None"""
+
+    @abc.abstractmethod
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入缓存"""
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        """删除缓存条目"""
+
+    @abc.abstractmethod
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """原子自增并返回新值；键不存在时从0开始，并以ttl作为过期时间"""
+
+    @abc.abstractmethod
+    def cas(self, key: str, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        """比较并设置：当前值等于expected时写入value（expected为None表示键必须不存在）"""
+
+    def incr_and_get(self, key: str, other_key: str, amount: int = 1,
+                     ttl: Optional[float] = None) -> Tuple[int, Optional[Any]]:
+        """原子自增key并读取other_key，返回 (key的新值, other_key的值)（用于滑动窗口计数）"""
+        return self.incr(key, amount, ttl), self.get(other_key)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """键不存在时写入，返回是否写入成功"""
+        return self.cas(key, None, value, ttl)
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计信息"""
+        return {}
+
+
+class TTLCache(CacheBackend):
+    """进程内缓存：带TTL和容量上限的LRU缓存（线程安全）"""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_locked(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _set_locked(self, key: Hashable, value: Any, ttl: Optional[float]) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._get_locked(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._set_locked(key, value, ttl)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key: Hashable, amount: int = 1, ttl: Optional[float] = None) -> int:
+        with self._lock:
+            current = self._get_locked(key)
+            if current is None:
+                value = amount
+                self._set_locked(key, value, ttl)
+            else:
+                value = current + amount
+                # 保留原有过期时间
+                self._data[key] = (self._data[key][0], value)
+            return value
+
+    def cas(self, key: Hashable, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        with self._lock:
+            if self._get_locked(key) != expected:
+                return False
+            self._set_locked(key, value, ttl)
+            return True
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class SQLiteCache(CacheBackend):
+    """本机共享文件缓存：同一主机上的多个worker进程通过WAL模式的SQLite文件共享数据
+
+    table 为存放条目的表名，同一文件中的不同表各自按 maxsize 清理
+    """
+
+    def __init__(self, path: str, ttl: float = 30.0, maxsize: int = 100000, table: str = 'cache'):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.table = table
+        self._local = threading.local()
+        self._ops = 0
+        self._ops_lock = threading.Lock()
+        self._connection().execute(
+            f'CREATE TABLE IF NOT EXISTS {table} '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _expires_at(self, ttl: Optional[float]) -> float:
+        return time.time() + (self.ttl if ttl is None else ttl)
+
+    def _maybe_purge(self, conn: sqlite3.Connection) -> None:
+        """定期清理过期条目，并在超出容量时删除最早过期的条目"""
+        with self._ops_lock:
+            self._ops += 1
+            if self._ops % 1000:
+                return
+        conn.execute(f'DELETE FROM {self.table} WHERE expires_at < ?', (time.time(),))
+        conn.execute(
+            f'DELETE FROM {self.table} WHERE key IN '
+            f'(SELECT key FROM {self.table} ORDER BY expires_at DESC LIMIT -1 OFFSET ?)',
+            (self.maxsize,)
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._connection().execute(
+            f'SELECT value FROM {self.table} WHERE key = ? AND expires_at >= ?', (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        conn = self._connection()
+        conn.execute(
+            f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), self._expires_at(ttl))
+        )
+        self._maybe_purge(conn)
+
+    def delete(self, key: str) -> None:
+        self._connection().execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute(
+            f'INSERT INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET '
+            'value = CASE WHEN expires_at < ? THEN excluded.value ELSE CAST(value AS INTEGER) + ? END, '
+            'expires_at = CASE WHEN expires_at < ? THEN excluded.expires_at ELSE expires_at END '
+            'RETURNING value',
+            (key, amount, self._expires_at(ttl), now, amount, now)
+        ).fetchone()
+        self._maybe_purge(conn)
+        return int(row[0])
+
+    def cas(self, key: str, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                f'SELECT value FROM {self.table} WHERE key = ? AND expires_at >= ?', (key, time.time())
+            ).fetchone()
+            current = json.loads(row[0]) if row else None
+            if current != expected:
+                conn.execute('ROLLBACK')
+                return False
+            conn.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), self._expires_at(ttl))
+            )
+            conn.execute('COMMIT')
+            return True
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def stats(self) -> Dict[str, Any]:
+        size = self._connection().execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.path, 'table': self.table, 'size': size,
+                'maxsize': self.maxsize, 'ttl': self.ttl}
+
+
+class RedisError(Exception):
+    """Redis服务端返回的错误"""
+    pass
+
+
+class RedisCache(CacheBackend):
+    """Redis协议（RESP2）缓存，使用标准库socket实现，带连接池
+
+    只使用 GET/SET/DEL/INCRBY/WATCH/MULTI/EXEC 等基础命令，
+    可以连接Redis、Valkey、KeyDB或本地的 redis_standin.py
+    """
+
+    def __init__(self, host: str = 'localhost', port: int = 6379, db: int = 0,
+                 password: Optional[str] = None, ttl: float = 30.0,
+                 prefix: str = 'kcc:', pool_size: int = 8, timeout: float = 2.0):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.ttl = ttl
+        self.prefix = prefix
+        self.timeout = timeout
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    # --- 连接和协议 ---
+    def _connect(self):
+        """建立连接，返回 (socket, 读缓冲) 二元组"""
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile('rb'))
+        if self.password:
+            self._command(conn, 'AUTH', self.password)
+        if self.db:
+            self._command(conn, 'SELECT', self.db)
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn) -> None:
+        try:
+            conn[1].close()
+            conn[0].close()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _encode(*args) -> bytes:
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError('Redis连接已关闭')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2].decode('utf-8')
+        if prefix == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RedisError(f'无法解析的响应: {line!r}')
+
+    def _command(self, conn, *args):
+        conn[0].sendall(self._encode(*args))
+        return self._read_reply(conn[1])
+
+    def _pipeline(self, conn, *commands):
+        conn[0].sendall(b''.join(self._encode(*command) for command in commands))
+        return [self._read_reply(conn[1]) for _ in commands]
+
+    def _execute(self, fn):
+        """在池中的连接上执行操作，连接异常时丢弃该连接"""
+        conn = self._acquire()
+        try:
+            result = fn(conn)
+        except (OSError, ConnectionError):
+            self._close(conn)
+            raise
+        self._release(conn)
+        return result
+
+    def _key(self, key: str) -> str:
+        return f'{self.prefix}{key}'
+
+    def _ttl_ms(self, ttl: Optional[float]) -> int:
+        return max(1, int((self.ttl if ttl is None else ttl) * 1000))
+
+    # --- 缓存接口 ---
+    def get(self, key: str) -> Optional[Any]:
+        raw = self._execute(lambda conn: self._command(conn, 'GET', self._key(key)))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._execute(lambda conn: self._command(
+            conn, 'SET', self._key(key), json.dumps(value), 'PX', self._ttl_ms(ttl)))
+
+    def delete(self, key: str) -> None:
+        self._execute(lambda conn: self._command(conn, 'DEL', self._key(key)))
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        # SET NX PX 在键不存在时以0和TTL创建，INCRBY保留已有TTL；两条命令一次发送
+        redis_key = self._key(key)
+        _, value = self._execute(lambda conn: self._pipeline(
+            conn,
+            ('SET', redis_key, 0, 'PX', self._ttl_ms(ttl), 'NX'),
+            ('INCRBY', redis_key, amount)
+        ))
+        return value
+
+    def incr_and_get(self, key, other_key, amount=1, ttl=None):
+        # 自增和读取在一次往返中发送
+        redis_key = self._key(key)
+        _, value, other = self._execute(lambda conn: self._pipeline(
+            conn,
+            ('SET', redis_key, 0, 'PX', self._ttl_ms(ttl), 'NX'),
+            ('INCRBY', redis_key, amount),
+            ('GET', self._key(other_key))
+        ))
+        return value, json.loads(other) if other is not None else None
+
+    def cas(self, key: str, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        redis_key = self._key(key)
+
+        def compare_and_set(conn):
+            self._command(conn, 'WATCH', redis_key)
+            raw = self._command(conn, 'GET', redis_key)
+            current = json.loads(raw) if raw is not None else None
+            if current != expected:
+                self._command(conn, 'UNWATCH')
+                return False
+            _, _, result = self._pipeline(
+                conn,
+                ('MULTI',),
+                ('SET', redis_key, json.dumps(value), 'PX', self._ttl_ms(ttl)),
+                ('EXEC',)
+            )
+            # EXEC返回nil表示WATCH的键已被其他客户端修改
+            return result is not None
+
+        return self._execute(compare_and_set)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        result = self._execute(lambda conn: self._command(
+            conn, 'SET', self._key(key), json.dumps(value), 'PX', self._ttl_ms(ttl), 'NX'))
+        return result is not None
+
+    def stats(self) -> Dict[str, Any]:
+        return {'backend': 'redis', 'host': self.host, 'port': self.port, 'db': self.db, 'ttl': self.ttl}
+
+
+class NamespacedCache:
+    """带命名空间和默认TTL的缓存视图，多个缓存共享同一个后端"""
+
+    def __init__(self, backend: CacheBackend, namespace: str, ttl: float):
+        self.backend = backend
+        self.namespace = namespace
+        self.ttl = ttl
+
+    def _key(self, key) -> str:
+        return f'{self.namespace}:{key}'
+
+    def get(self, key) -> Optional[Any]:
+        return self.backend.get(self._key(key))
+
+    def set(self, key, value: Any, ttl: Optional[float] = None) -> None:
+        self.backend.set(self._key(key), value, self.ttl if ttl is None else ttl)
+
+    def delete(self, key) -> None:
+        self.backend.delete(self._key(key))
+
+    def incr(self, key, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return self.backend.incr(self._key(key), amount, self.ttl if ttl is None else ttl)
+
+    def add(self, key, value: Any, ttl: Optional[float] = None) -> bool:
+        return self.backend.add(self._key(key), value, self.ttl if ttl is None else ttl)
+
+    def cas(self, key, expected: Any, value: Any, ttl: Optional[float] = None) -> bool:
+        return self.backend.cas(self._key(key), expected, value, self.ttl if ttl is None else ttl)
+
+    def update(self, key, fields: Dict[str, Any], retries: int = 3) -> bool:
+        """合并更新字典类型的缓存条目（基于CAS），条目不存在或并发冲突时删除条目"""
+        for _ in range(retries):
+            current = self.get(key)
+            if not isinstance(current, dict):
+                return False
+            if self.cas(key, current, {**current, **fields}):
+                return True
+        # 多次冲突时直接失效，下次读取时从数据库加载
+        self.delete(key)
+        return False
+
+
+def create_cache_backend(url: str, table: str = 'cache', maxsize: Optional[int] = None) -> CacheBackend:
+    """根据URL创建缓存后端
+
+    table 和 maxsize 用于创建独立的存储：SQLite后端使用同一文件中的另一张表，
+    进程内后端为另一个LRU；Redis后端的淘汰由服务端的 maxmemory-policy 决定
+    """
+    parsed = urllib.parse.urlparse(url)
+    default_ttl = float(os.getenv('CACHE_DEFAULT_TTL', 300))
+
+    if parsed.scheme == 'sqlite':
+        return SQLiteCache(parsed.path, ttl=default_ttl, maxsize=maxsize or 100000, table=table)
+    if parsed.scheme == 'redis':
+        return RedisCache(
+            host=parsed.hostname or 'localhost',
+            port=parsed.port or 6379,
+            db=int(parsed.path.lstrip('/') or 0),
+            password=parsed.password,
+            ttl=default_ttl
+        )
+    return TTLCache(maxsize=maxsize or int(os.getenv('CACHE_MAX_ENTRIES', 10000)), ttl=default_ttl)
+
+
+CACHE_URL = os.getenv('CACHE_URL', 'memory://')
+
+# 全局缓存后端，供用户、设置等缓存共享
+cache_backend = create_cache_backend(CACHE_URL)
+
+# 限流计数：独立存储，缓存条目增多时不会淘汰计数（否则持续的暴力尝试会被重新放行）
+rate_limit_backend = create_cache_backend(
+    CACHE_URL, table='rate_limit', maxsize=int(os.getenv('RATE_LIMIT_MAX_ENTRIES', 100000))
+)
+
+# 幂等键：独立存储，处理中标记在到期前不会被其他缓存条目挤出（否则重复请求会再次执行）
+idempotency_backend = create_cache_backend(
+    CACHE_URL, table='idempotency', maxsize=int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', 20000))
+)
+
+# 用户缓存：按用户ID缓存users表记录，供auth_required使用
+user_cache = NamespacedCache(cache_backend, 'user', ttl=float(os.getenv('USER_CACHE_TTL', 30)))
+
+# 设置缓存：缓存settings表的值（如管理员密码哈希）
+setting_cache = NamespacedCache(cache_backend, 'setting', ttl=float(os.getenv('SETTING_CACHE_TTL', 60)))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+兑换码布隆过滤器
+内存中保存全部兑换码的布隆过滤器，兑换时先检查，不存在的兑换码（输错、猜码）
+直接拒绝，不访问数据库。布隆过滤器没有漏报，只有少量误报（误报的请求照常查询数据库）
+
+以数据库中最大的兑换码ID作为版本号（不依赖共享缓存，任何进程、CLI生成的码都能发现），
+每个worker最多每 CODE_FILTER_VERSION_SECONDS 秒查询一次；发现版本变化后在后台线程重建过滤器（请求不等待）。
+只有过滤器与版本号一致且未超过刷新间隔时才拒绝未命中的兑换码；过滤器尚未建立、
+版本已变化或版本号读取失败时，未命中的请求照常查询数据库。
+其他进程刚生成的码在版本号重新查询前（最多 CODE_FILTER_VERSION_SECONDS 秒）可能被误拒
+"""
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from typing import Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# 过滤器的目标误报率
+CODE_FILTER_ERROR_RATE = float(os.getenv('CODE_FILTER_ERROR_RATE', 0.001))
+# 即使版本号未变化，也按该间隔（秒）重建，包含直接写入数据库的兑换码
+CODE_FILTER_REFRESH_SECONDS = float(os.getenv('CODE_FILTER_REFRESH_SECONDS', 600))
+# 版本号（最大兑换码ID）在本进程内缓存的秒数
+CODE_FILTER_VERSION_SECONDS = float(os.getenv('CODE_FILTER_VERSION_SECONDS', 2))
+# 重建失败后等待多久（秒）再重试
+CODE_FILTER_RETRY_SECONDS = 30
+
+
+class BloomFilter:
+    """定长位数组的布隆过滤器（双重哈希）"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1000)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+
+class CodeFilter:
+    """兑换码存在性过滤器"""
+
+    def __init__(self, error_rate: float, refresh_seconds: float, version_seconds: float):
+        self.error_rate = error_rate
+        self.refresh_seconds = refresh_seconds
+        self.version_seconds = version_seconds
+        self._bloom: Optional[BloomFilter] = None
+        self._version = None
+        self._built_at = 0.0
+        self._current_version = None
+        self._version_checked_at = 0.0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.passed = 0
+
+    def _read_version(self):
+        """从数据库读取版本号（最大兑换码ID），读取失败时返回None"""
+        from repository import repository
+        try:
+            return repository.max_code_id()
+        except Exception as e:
+            logger.error(f"读取兑换码版本失败: {e}")
+            return None
+
+    def _db_version(self):
+        """当前版本号，在本进程内缓存 version_seconds 秒"""
+        now = time.monotonic()
+        if now - self._version_checked_at >= self.version_seconds:
+            self._current_version = self._read_version()
+            self._version_checked_at = now
+        return self._current_version
+
+    def rebuild(self) -> int:
+        """从数据库逐页加载全部兑换码重建过滤器，返回兑换码数量"""
+        from repository import repository
+        version = repository.max_code_id()  # 先读版本号，加载期间新增的码会让版本再次变化
+        # 兑换码数量不超过最大ID，按其预留一倍容量给之后新增的码；兑换码逐页加入，不在内存中保存列表
+        bloom = BloomFilter(version * 2, self.error_rate)
+        for code in repository.iter_codes():
+            bloom.add(code)
+        self._bloom, self._version, self._built_at = bloom, version, time.time()
+        logger.info(f"兑换码过滤器已重建: {bloom.count} 个兑换码")
+        return bloom.count
+
+    def _rebuild_in_background(self) -> None:
+        """在后台线程重建过滤器（已有重建在进行或刚失败过时跳过）"""
+        if time.time() < self._retry_at or not self._lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.rebuild()
+            except Exception as e:
+                logger.error(f"重建兑换码过滤器失败: {e}")
+                self._retry_at = time.time() + CODE_FILTER_RETRY_SECONDS
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, name='code-filter-rebuild', daemon=True).start()
+
+    def _ensure_fresh(self) -> bool:
+        """过滤器与版本号一致且未过期时返回True；否则触发后台重建并返回False"""
+        version = self._db_version()
+        expired = time.time() - self._built_at > self.refresh_seconds
+        if self._bloom is not None and version is not None and version == self._version and not expired:
+            return True
+        # 版本号读取失败时不反复重建，等刷新间隔到期
+        if expired or version is not None:
+            self._rebuild_in_background()
+        return False
+
+    def might_exist(self, code: str) -> bool:
+        """兑换码可能存在时返回True；返回False时一定不存在"""
+        fresh = self._ensure_fresh()
+        bloom = self._bloom
+        # 过滤器可能缺少其他进程新生成的码，未命中时交给数据库判断
+        if bloom is None or not fresh or code in bloom:
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+
+    def added(self, codes: Iterable[str]) -> None:
+        """生成兑换码后调用：加入本进程的过滤器，并在下次检查时重新读取版本号
+
+        其他worker在版本号缓存到期后发现变化并重建；本进程同样按新版本号重建，
+        以包含其他进程同时生成的码
+        """
+        bloom = self._bloom
+        if bloom is not None:
+            for code in codes:
+                bloom.add(code)
+        self._version_checked_at = 0.0
+
+    def stats(self):
+        """过滤器统计信息"""
+        bloom = self._bloom
+        return {
+            'version': self._version,
+            'codes': bloom.count if bloom else None,
+            'bits': bloom.size if bloom else None,
+            'hash_count': bloom.hash_count if bloom else None,
+            'rejected': self.rejected,
+            'passed': self.passed
+        }
+
+
+code_filter = CodeFilter(CODE_FILTER_ERROR_RATE, CODE_FILTER_REFRESH_SECONDS, CODE_FILTER_VERSION_SECONDS)
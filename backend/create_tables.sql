@@ -9,13 +9,25 @@ CREATE TABLE IF NOT EXISTS users (
     password_hash VARCHAR(128) NOT NULL,
     credits INTEGER DEFAULT 0 NOT NULL,
     is_active BOOLEAN DEFAULT TRUE NOT NULL,
+    token_version INTEGER DEFAULT 0 NOT NULL,
+    held_credits INTEGER DEFAULT 0 NOT NULL,
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
-    last_login TIMESTAMP
+    last_login TIMESTAMP,
+    tokens_revoked_at TIMESTAMP              -- 最近一次递增令牌版本或禁用的时间（吊销列表只加载令牌有效期内的）
 );
 
 -- 为用户表创建索引
-CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
-CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
+-- username/email 的UNIQUE约束自带索引；管理后台的子串搜索使用pg_trgm三元组索引
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING GIN (email gin_trgm_ops);
+-- 管理后台用户列表的游标分页排序（排序列, id）
+CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_credits_id ON users(credits DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_last_login_id ON users(last_login DESC NULLS LAST, id DESC);
+-- 令牌吊销列表按吊销时间加载
+CREATE INDEX IF NOT EXISTS idx_users_tokens_revoked_at
+    ON users(tokens_revoked_at, id) WHERE tokens_revoked_at IS NOT NULL;
 
 -- 2. 创建兑换码表
 CREATE TABLE IF NOT EXISTS redemption_codes (
@@ -32,6 +44,10 @@ CREATE TABLE IF NOT EXISTS redemption_codes (
 
 -- 为兑换码表创建索引
 CREATE INDEX IF NOT EXISTS idx_redemption_codes_code ON redemption_codes(code);
+-- 用户详情中已使用兑换码的分页（只索引已使用的兑换码）
+CREATE INDEX IF NOT EXISTS idx_redemption_codes_used_by
+    ON redemption_codes(used_by_user_id, used_at DESC, id DESC)
+    WHERE used_by_user_id IS NOT NULL;
 
 -- 3. 创建积分交易记录表
 CREATE TABLE IF NOT EXISTS credit_transactions (
@@ -44,7 +60,12 @@ CREATE TABLE IF NOT EXISTS credit_transactions (
 );
 
 -- 为积分交易记录表创建索引
-CREATE INDEX IF NOT EXISTS idx_credit_transactions_user_id ON credit_transactions(user_id);
+-- 游标分页 (created_at DESC, id) 的覆盖索引
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_user_created
+    ON credit_transactions(user_id, created_at DESC, id)
+    INCLUDE (transaction_type, credits_amount, description);
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_user_id_id ON credit_transactions(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_created_at ON credit_transactions(created_at);
 
 -- 4. 创建系统设置表
 CREATE TABLE IF NOT EXISTS settings (
@@ -52,14 +73,867 @@ CREATE TABLE IF NOT EXISTS settings (
     value VARCHAR(200) NOT NULL
 );
 
--- 5. 插入初始管理员密码设置
+-- 5. 批量更新最后登录时间（登录时间先在应用内缓冲，再按周期批量写入）
+CREATE OR REPLACE FUNCTION batch_update_last_login(updates JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH batch AS (
+        SELECT (item->>'id')::INTEGER AS id,
+               (item->>'last_login')::TIMESTAMP AS last_login
+        FROM jsonb_array_elements(updates) AS item
+    ), updated AS (
+        UPDATE users
+        SET last_login = batch.last_login
+        FROM batch
+        WHERE users.id = batch.id
+          AND (users.last_login IS NULL OR users.last_login < batch.last_login)
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM updated;
+$$;
+
+-- 启用/禁用用户，禁用时令牌版本加1并记录吊销时间；返回更新后的用户（不含密码哈希），用户不存在时返回NULL
+CREATE OR REPLACE FUNCTION set_user_active(p_user_id INTEGER, p_is_active BOOLEAN)
+RETURNS JSONB
+LANGUAGE sql
+AS $$
+    UPDATE users
+    SET is_active = p_is_active,
+        token_version = CASE WHEN p_is_active THEN token_version ELSE token_version + 1 END,
+        tokens_revoked_at = CASE WHEN p_is_active THEN tokens_revoked_at ELSE CURRENT_TIMESTAMP END
+    WHERE id = p_user_id
+    RETURNING to_jsonb(users) - 'password_hash';
+$$;
+
+-- 6. 原子积分调整：一条语句内条件更新余额并写入交易记录，返回新余额（余额不足时返回NULL，扣减不能动用已预留的积分）
+CREATE OR REPLACE FUNCTION adjust_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_transaction_type VARCHAR,
+    p_description VARCHAR
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH updated AS (
+        UPDATE users
+        SET credits = credits + p_amount
+        WHERE id = p_user_id AND (p_amount >= 0 OR credits - held_credits + p_amount >= 0)
+        RETURNING id, credits
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, p_transaction_type, p_amount, p_description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
+
+-- 批量积分调整：一次调用内对一组用户做一条集合UPDATE和一条多行流水INSERT，返回每个用户的结果
+-- 目标为 p_user_ids 与（p_username_prefix 非空时）该前缀的活跃用户的并集；
+-- 先按ID顺序锁定目标行，并发的批量调整不会互相死锁。扣减时余额不足的用户跳过，
+-- status 为 applied / insufficient / not_found
+CREATE OR REPLACE FUNCTION bulk_adjust_credits(
+    p_user_ids INTEGER[],
+    p_username_prefix VARCHAR,
+    p_amount INTEGER,
+    p_transaction_type VARCHAR,
+    p_description VARCHAR
+)
+RETURNS TABLE (user_id INTEGER, status TEXT, credits INTEGER)
+LANGUAGE sql
+AS $$
+    WITH targets AS (
+        SELECT DISTINCT target_id FROM (
+            SELECT unnest(COALESCE(p_user_ids, '{}'::INTEGER[])) AS target_id
+            UNION ALL
+            SELECT id FROM users
+            WHERE p_username_prefix IS NOT NULL AND p_username_prefix <> '' AND is_active
+              AND username LIKE replace(replace(replace(p_username_prefix, '\', '\\'), '%', '\%'), '_', '\_') || '%'
+        ) t
+    ), locked AS (
+        SELECT u.id FROM users u JOIN targets t ON t.target_id = u.id
+        ORDER BY u.id
+        FOR UPDATE OF u
+    ), updated AS (
+        UPDATE users u
+        SET credits = u.credits + p_amount
+        FROM locked l
+        WHERE u.id = l.id AND (p_amount >= 0 OR u.credits - u.held_credits + p_amount >= 0)
+        RETURNING u.id, u.credits
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, p_transaction_type, p_amount, p_description FROM updated
+    )
+    SELECT t.target_id,
+           CASE WHEN up.id IS NOT NULL THEN 'applied'
+                WHEN l.id IS NOT NULL THEN 'insufficient'
+                ELSE 'not_found' END,
+           up.credits
+    FROM targets t
+    LEFT JOIN updated up ON up.id = t.target_id
+    LEFT JOIN locked l ON l.id = t.target_id
+    ORDER BY t.target_id;
+$$;
+
+-- 7. 积分预留（生成前预留，成功后结算，失败时释放，超时自动失效）
+CREATE TABLE IF NOT EXISTS credit_holds (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    amount INTEGER NOT NULL CHECK (amount > 0),
+    status VARCHAR(10) DEFAULT 'held' NOT NULL,  -- held / captured / released / expired
+    description VARCHAR(200) NOT NULL,
+    transaction_type VARCHAR(20) DEFAULT 'consume' NOT NULL,  -- 结算时写入流水的类型（生成创作为 generation）
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    settled_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_holds_user_held ON credit_holds(user_id) WHERE status = 'held';
+CREATE INDEX IF NOT EXISTS idx_credit_holds_expires_held ON credit_holds(expires_at) WHERE status = 'held';
+
+-- 预留积分：先释放该用户已过期的预留，再在可用余额足够时增加held_credits；
+-- 返回 {'hold_id', 'credits', 'held_credits'}（预留后的余额，余额不足时hold_id为NULL），用户不存在时返回NULL
+-- p_transaction_type 为结算时写入流水的类型（生成创作为 generation）
+CREATE OR REPLACE FUNCTION hold_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER,
+    p_transaction_type VARCHAR DEFAULT 'consume'
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_expired INTEGER;
+    v_hold_id INTEGER;
+    v_credits INTEGER;
+    v_held INTEGER;
+BEGIN
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE user_id = p_user_id AND status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING amount
+    )
+    SELECT COALESCE(SUM(amount), 0) INTO v_expired FROM expired;
+
+    UPDATE users
+    SET held_credits = held_credits - v_expired + p_amount
+    WHERE id = p_user_id AND credits - (held_credits - v_expired) >= p_amount
+    RETURNING credits, held_credits INTO v_credits, v_held;
+
+    IF NOT FOUND THEN
+        IF v_expired > 0 THEN
+            UPDATE users SET held_credits = held_credits - v_expired WHERE id = p_user_id
+            RETURNING credits, held_credits INTO v_credits, v_held;
+        ELSE
+            SELECT credits, held_credits INTO v_credits, v_held FROM users WHERE id = p_user_id;
+        END IF;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN jsonb_build_object('hold_id', NULL, 'credits', v_credits, 'held_credits', v_held);
+    END IF;
+
+    INSERT INTO credit_holds (user_id, amount, description, transaction_type, expires_at)
+    VALUES (p_user_id, p_amount, p_description, p_transaction_type,
+            CURRENT_TIMESTAMP + make_interval(secs => p_ttl_seconds))
+    RETURNING id INTO v_hold_id;
+    RETURN jsonb_build_object('hold_id', v_hold_id, 'credits', v_credits, 'held_credits', v_held);
+END;
+$$;
+
+-- 旧版接口：只返回预留ID，余额不足时返回NULL
+CREATE OR REPLACE FUNCTION place_credit_hold(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    SELECT (hold_credits(p_user_id, p_amount, p_description, p_ttl_seconds) ->> 'hold_id')::INTEGER;
+$$;
+
+-- 结算预留：扣除积分并写入交易记录，返回新余额；预留已结算/释放/过期时返回NULL
+CREATE OR REPLACE FUNCTION capture_credit_hold(p_hold_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = p_hold_id AND status = 'held'
+        RETURNING user_id, amount, description, transaction_type
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - captured.amount,
+            held_credits = users.held_credits - captured.amount
+        FROM captured
+        WHERE users.id = captured.user_id
+        RETURNING users.id, users.credits, captured.amount, captured.description, captured.transaction_type
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, transaction_type, -amount, description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
+
+-- 释放预留：返回是否释放成功
+CREATE OR REPLACE FUNCTION release_credit_hold(p_hold_id INTEGER)
+RETURNS BOOLEAN
+LANGUAGE sql
+AS $$
+    WITH released AS (
+        UPDATE credit_holds
+        SET status = 'released', settled_at = CURRENT_TIMESTAMP
+        WHERE id = p_hold_id AND status = 'held'
+        RETURNING user_id, amount
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - released.amount
+        FROM released
+        WHERE users.id = released.user_id
+        RETURNING users.id
+    )
+    SELECT EXISTS (SELECT 1 FROM updated);
+$$;
+
+-- 批量释放所有已过期的预留（定时任务），返回释放的预留数
+CREATE OR REPLACE FUNCTION expire_credit_holds()
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING user_id, amount
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount, COUNT(*) AS holds
+        FROM expired
+        GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    )
+    SELECT COALESCE(SUM(holds), 0)::INTEGER FROM per_user;
+$$;
+
+-- 批量结算：按用户合并扣减余额，每个预留按其交易类型写一条流水，返回结算的预留数
+-- 发件箱提交晚于预留有效期时预留已被标记为expired（held_credits已退回），这类从未结算的预留同样结算：
+-- 可用余额足够时直接扣减credits；不足时保持expired，由调用方按返回数量记录差额
+CREATE OR REPLACE FUNCTION capture_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_held INTEGER;
+    v_expired INTEGER;
+BEGIN
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount, description, transaction_type
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM captured GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount,
+            held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, transaction_type, -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_held FROM captured;
+
+    -- 先锁定过期预留，重复提交同一批次时只有一个事务能结算
+    PERFORM 1 FROM credit_holds
+    WHERE id = ANY(p_hold_ids) AND status = 'expired'
+    ORDER BY id
+    FOR UPDATE;
+
+    WITH per_user AS (
+        SELECT user_id, SUM(amount) AS amount
+        FROM credit_holds
+        WHERE id = ANY(p_hold_ids) AND status = 'expired'
+        GROUP BY user_id
+    ), charged AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id AND users.credits - users.held_credits >= per_user.amount
+        RETURNING users.id
+    ), captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'expired' AND user_id IN (SELECT id FROM charged)
+        RETURNING user_id, amount, description, transaction_type
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, transaction_type, -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_expired FROM captured;
+
+    RETURN v_held + v_expired;
+END;
+$$;
+
+-- 批量释放：返回释放的预留数
+CREATE OR REPLACE FUNCTION release_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH released AS (
+        UPDATE credit_holds
+        SET status = 'released', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM released GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    )
+    SELECT COUNT(*)::INTEGER FROM released;
+$$;
+
+-- 8. 积分流水快照（余额 = 最近一次快照 + 之后的流水，users.credits 为同步更新的余额投影）
+CREATE TABLE IF NOT EXISTS credit_balance_snapshots (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    balance INTEGER NOT NULL,
+    last_transaction_id INTEGER NOT NULL,  -- 快照已包含的最后一条流水ID
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_snapshots_user
+    ON credit_balance_snapshots(user_id, last_transaction_id DESC);
+CREATE INDEX IF NOT EXISTS idx_credit_snapshots_last_transaction
+    ON credit_balance_snapshots(last_transaction_id);
+
+-- 新用户的初始积分写入流水（注册、批量导入仍然只需一次INSERT）
+CREATE OR REPLACE FUNCTION record_initial_credits()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.credits <> 0 THEN
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        VALUES (NEW.id, 'signup', NEW.credits, '注册初始积分');
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS users_initial_credits ON users;
+CREATE TRIGGER users_initial_credits
+    AFTER INSERT ON users
+    FOR EACH ROW EXECUTE FUNCTION record_initial_credits();
+
+-- 按流水计算余额：最近一次快照 + 之后的流水
+CREATE OR REPLACE FUNCTION credit_ledger_balance(p_user_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+STABLE
+AS $$
+    WITH snapshot AS (
+        SELECT balance, last_transaction_id
+        FROM credit_balance_snapshots
+        WHERE user_id = p_user_id
+        ORDER BY last_transaction_id DESC
+        LIMIT 1
+    )
+    SELECT (
+        COALESCE((SELECT balance FROM snapshot), 0)
+        + COALESCE((
+            SELECT SUM(credits_amount)
+            FROM credit_transactions
+            WHERE user_id = p_user_id
+              AND id > COALESCE((SELECT last_transaction_id FROM snapshot), 0)
+        ), 0)
+    )::INTEGER;
+$$;
+
+-- 为有新流水的用户写入快照，返回写入数量
+-- 只包含 p_settle_seconds 之前写入的流水：ID按分配顺序递增，但并发事务可能乱序提交，
+-- 留出时间窗口保证快照边界以下的流水都已提交。多个worker同时调用时只有一个执行
+CREATE OR REPLACE FUNCTION write_credit_snapshots(p_settle_seconds INTEGER DEFAULT 300)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from INTEGER;
+    v_to INTEGER;
+    v_count INTEGER;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('write_credit_snapshots')) THEN
+        RETURN 0;
+    END IF;
+
+    -- 上次快照边界以下的流水都已计入各用户的快照
+    SELECT COALESCE(MAX(last_transaction_id), 0) INTO v_from FROM credit_balance_snapshots;
+    SELECT COALESCE(
+        (SELECT MIN(id) - 1 FROM credit_transactions
+         WHERE created_at >= CURRENT_TIMESTAMP - make_interval(secs => p_settle_seconds)),
+        (SELECT MAX(id) FROM credit_transactions),
+        0
+    ) INTO v_to;
+
+    INSERT INTO credit_balance_snapshots (user_id, balance, last_transaction_id)
+    SELECT deltas.user_id, COALESCE(latest.balance, 0) + deltas.delta, deltas.last_id
+    FROM (
+        SELECT t.user_id, SUM(t.credits_amount) AS delta, MAX(t.id) AS last_id
+        FROM credit_transactions t
+        WHERE t.id > v_from AND t.id <= v_to
+          AND t.id > COALESCE((
+              SELECT s.last_transaction_id FROM credit_balance_snapshots s
+              WHERE s.user_id = t.user_id
+              ORDER BY s.last_transaction_id DESC LIMIT 1
+          ), 0)
+        GROUP BY t.user_id
+    ) deltas
+    LEFT JOIN LATERAL (
+        SELECT s.balance FROM credit_balance_snapshots s
+        WHERE s.user_id = deltas.user_id
+        ORDER BY s.last_transaction_id DESC LIMIT 1
+    ) latest ON TRUE;
+
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+-- 对账：返回余额投影与流水不一致的用户
+-- 默认只检查上次快照之后有流水的用户，p_all = TRUE 时检查全部用户
+CREATE OR REPLACE FUNCTION reconcile_credit_balances(p_all BOOLEAN DEFAULT FALSE)
+RETURNS TABLE (user_id INTEGER, credits INTEGER, ledger_credits INTEGER)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH candidates AS (
+        SELECT u.id, u.credits, credit_ledger_balance(u.id) AS ledger_credits
+        FROM users u
+        WHERE p_all OR u.id IN (
+            SELECT t.user_id FROM credit_transactions t
+            WHERE t.id > (SELECT COALESCE(MAX(last_transaction_id), 0) FROM credit_balance_snapshots)
+        )
+    )
+    SELECT id, credits, ledger_credits FROM candidates WHERE credits <> ledger_credits;
+$$;
+
+-- 按流水修复用户的余额投影，返回修复后的余额；修复不写流水，差额直接计入 total_credits
+CREATE OR REPLACE FUNCTION repair_credit_balance(p_user_id INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_previous INTEGER;
+    v_credits INTEGER;
+BEGIN
+    SELECT credits INTO v_previous FROM users WHERE id = p_user_id FOR UPDATE;
+    UPDATE users
+    SET credits = credit_ledger_balance(p_user_id)
+    WHERE id = p_user_id
+    RETURNING credits INTO v_credits;
+
+    IF v_credits <> v_previous THEN
+        INSERT INTO app_stats (name, shard, value)
+        VALUES ('total_credits', stats_shard(), v_credits - v_previous)
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN v_credits;
+END;
+$$;
+
+-- 积分流水归档：超过保留期的流水计入快照后写入压缩文件（见 ledger_archive.py），清单记录在此表中
+CREATE TABLE IF NOT EXISTS credit_transaction_archives (
+    id SERIAL PRIMARY KEY,
+    partition_date DATE NOT NULL,              -- 文件中流水的日期（created_at::date）
+    path VARCHAR(255) NOT NULL UNIQUE,         -- 相对于归档目录的路径
+    first_transaction_id INTEGER NOT NULL,
+    last_transaction_id INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    user_ids JSONB NOT NULL,                   -- 文件中出现的用户ID（按需读取时跳过无关文件）
+    generations INTEGER DEFAULT 0 NOT NULL,    -- 以下两列用于重建统计（rebuild_usage_stats）
+    credits_consumed BIGINT DEFAULT 0 NOT NULL,
+    bytes BIGINT NOT NULL,
+    sha256 VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_transaction_archives_date
+    ON credit_transaction_archives(partition_date);
+
+-- 记录一批已写入文件的流水并从流水表删除，返回删除数量（在同一事务中完成）
+-- 删除范围与读取时相同：p_first_id <= id <= p_last_id 且 created_at < p_before；
+-- 范围超出快照边界、或删除数量与文件中的行数不一致时回滚，流水保持原样
+CREATE OR REPLACE FUNCTION archive_credit_transactions(
+    p_first_id INTEGER,
+    p_last_id INTEGER,
+    p_before TIMESTAMP,
+    p_archives JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_boundary INTEGER;
+    v_expected INTEGER;
+    v_deleted INTEGER;
+BEGIN
+    SELECT COALESCE(MAX(last_transaction_id), 0) INTO v_boundary FROM credit_balance_snapshots;
+    IF p_last_id > v_boundary THEN
+        RAISE EXCEPTION '流水 % 尚未计入余额快照（快照边界 %）', p_last_id, v_boundary;
+    END IF;
+
+    INSERT INTO credit_transaction_archives (partition_date, path, first_transaction_id, last_transaction_id,
+                                             row_count, user_ids, generations, credits_consumed, bytes, sha256)
+    SELECT a.partition_date, a.path, a.first_transaction_id, a.last_transaction_id,
+           a.row_count, a.user_ids, a.generations, a.credits_consumed, a.bytes, a.sha256
+    FROM jsonb_to_recordset(p_archives) AS a(
+        partition_date DATE, path VARCHAR, first_transaction_id INTEGER, last_transaction_id INTEGER,
+        row_count INTEGER, user_ids JSONB, generations INTEGER, credits_consumed BIGINT, bytes BIGINT, sha256 VARCHAR
+    )
+    ON CONFLICT (path) DO UPDATE
+    SET first_transaction_id = EXCLUDED.first_transaction_id,
+        last_transaction_id = EXCLUDED.last_transaction_id,
+        row_count = EXCLUDED.row_count,
+        user_ids = EXCLUDED.user_ids,
+        generations = EXCLUDED.generations,
+        credits_consumed = EXCLUDED.credits_consumed,
+        bytes = EXCLUDED.bytes,
+        sha256 = EXCLUDED.sha256,
+        created_at = CURRENT_TIMESTAMP;
+
+    SELECT COALESCE(SUM((a ->> 'row_count')::INTEGER), 0) INTO v_expected
+    FROM jsonb_array_elements(p_archives) a;
+
+    DELETE FROM credit_transactions
+    WHERE id BETWEEN p_first_id AND p_last_id AND created_at < p_before;
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+    IF v_deleted <> v_expected THEN
+        RAISE EXCEPTION '删除的流水数 % 与归档文件中的 % 条不一致', v_deleted, v_expected;
+    END IF;
+    RETURN v_deleted;
+END;
+$$;
+
+-- 删除已被更新快照取代的旧快照（只保留每个用户最近一次），返回删除数量
+-- 余额计算和快照写入只使用每个用户最近一次快照
+CREATE OR REPLACE FUNCTION prune_credit_snapshots(p_max_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH pruned AS (
+        DELETE FROM credit_balance_snapshots s
+        WHERE s.last_transaction_id <= p_max_id
+          AND EXISTS (
+              SELECT 1 FROM credit_balance_snapshots n
+              WHERE n.user_id = s.user_id AND n.last_transaction_id > s.last_transaction_id
+          )
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM pruned;
+$$;
+
+-- 9. 原子兑换：条件标记兑换码已使用并增加积分、写入流水
+CREATE OR REPLACE FUNCTION redeem_code(p_code VARCHAR, p_user_id INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_code redemption_codes%ROWTYPE;
+    v_credits INTEGER;
+BEGIN
+    UPDATE redemption_codes
+    SET is_used = TRUE, used_by_user_id = p_user_id, used_at = CURRENT_TIMESTAMP
+    WHERE code = p_code
+      AND is_used = FALSE
+      AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+    RETURNING * INTO v_code;
+
+    IF NOT FOUND THEN
+        SELECT * INTO v_code FROM redemption_codes WHERE code = p_code;
+        IF NOT FOUND THEN
+            RETURN jsonb_build_object('status', 'not_found');
+        ELSIF v_code.is_used THEN
+            RETURN jsonb_build_object('status', 'used');
+        END IF;
+        RETURN jsonb_build_object('status', 'expired');
+    END IF;
+
+    UPDATE users SET credits = credits + v_code.credits_value
+    WHERE id = p_user_id
+    RETURNING credits INTO v_credits;
+    IF NOT FOUND THEN
+        -- 回滚兑换码的更新
+        RAISE EXCEPTION 'user % not found', p_user_id;
+    END IF;
+
+    INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+    VALUES (p_user_id, 'recharge', v_code.credits_value,
+            LEFT('兑换码充值: ' || v_code.code || COALESCE(' (' || v_code.description || ')', ''), 200));
+
+    RETURN jsonb_build_object(
+        'status', 'redeemed',
+        'credits_added', v_code.credits_value,
+        'credits', v_credits
+    );
+END;
+$$;
+
+-- 10. 统计计数器与每日用量汇总（由触发器在写入时增量维护，仪表盘读取不再扫描全表）
+-- 计数按连接分片（pg_backend_pid() % 16），并发写入不会争抢同一行；读取时按名称汇总各分片
+CREATE TABLE IF NOT EXISTS app_stats (
+    name VARCHAR(40) NOT NULL,
+    shard SMALLINT NOT NULL,
+    value BIGINT DEFAULT 0 NOT NULL,
+    PRIMARY KEY (name, shard)
+);
+
+CREATE TABLE IF NOT EXISTS daily_usage (
+    day DATE NOT NULL,
+    shard SMALLINT NOT NULL,
+    generations INTEGER DEFAULT 0 NOT NULL,
+    credits_consumed BIGINT DEFAULT 0 NOT NULL,
+    redemptions INTEGER DEFAULT 0 NOT NULL,
+    credits_redeemed BIGINT DEFAULT 0 NOT NULL,
+    signups INTEGER DEFAULT 0 NOT NULL,
+    PRIMARY KEY (day, shard)
+);
+
+CREATE OR REPLACE FUNCTION stats_shard()
+RETURNS SMALLINT
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT (pg_backend_pid() % 16)::SMALLINT;
+$$;
+
+-- 语句级触发器通过转换表一次汇总整条语句影响的行，批量导入和批量生成兑换码只更新一次计数
+CREATE OR REPLACE FUNCTION users_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM new_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+        INSERT INTO daily_usage (day, shard, signups)
+        SELECT created_at::date, stats_shard(), COUNT(*) FROM new_rows GROUP BY 1
+        ON CONFLICT (day, shard) DO UPDATE SET signups = daily_usage.signups + EXCLUDED.signups;
+    ELSE
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), -d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM old_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION redemption_codes_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), d.delta
+        FROM (SELECT COUNT(*) AS codes, COUNT(*) FILTER (WHERE is_used) AS used FROM new_rows) s,
+             LATERAL (VALUES ('codes', s.codes), ('used_codes', s.used)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT 'used_codes', stats_shard(), delta
+        FROM (SELECT (SELECT COUNT(*) FROM new_rows WHERE is_used)
+                   - (SELECT COUNT(*) FROM old_rows WHERE is_used) AS delta) s
+        WHERE delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+        -- 本条语句中由未使用变为已使用的兑换码，计入兑换当天
+        INSERT INTO daily_usage (day, shard, redemptions, credits_redeemed)
+        SELECT COALESCE(n.used_at, CURRENT_TIMESTAMP)::date, stats_shard(), COUNT(*), SUM(n.credits_value)
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.is_used AND NOT o.is_used
+        GROUP BY 1
+        ON CONFLICT (day, shard) DO UPDATE
+        SET redemptions = daily_usage.redemptions + EXCLUDED.redemptions,
+            credits_redeemed = daily_usage.credits_redeemed + EXCLUDED.credits_redeemed;
+    ELSE
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), -d.delta
+        FROM (SELECT COUNT(*) AS codes, COUNT(*) FILTER (WHERE is_used) AS used FROM old_rows) s,
+             LATERAL (VALUES ('codes', s.codes), ('used_codes', s.used)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 流水只追加：生成次数按 generation 类型的流水计数，消耗积分为 consume 和 generation 流水之和；
+-- total_credits 计入除注册初始积分以外的全部流水（初始积分由用户插入触发器计入）
+CREATE OR REPLACE FUNCTION credit_transactions_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO app_stats (name, shard, value)
+    SELECT d.name, stats_shard(), d.delta
+    FROM (SELECT COUNT(*) AS transactions,
+                 COUNT(*) FILTER (WHERE transaction_type = 'generation') AS generations,
+                 COALESCE(SUM(credits_amount) FILTER (WHERE transaction_type <> 'signup'), 0) AS credits
+          FROM new_rows) s,
+         LATERAL (VALUES ('transactions', s.transactions), ('generations', s.generations),
+                         ('total_credits', s.credits)) AS d(name, delta)
+    WHERE d.delta <> 0
+    ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed)
+    SELECT created_at::date, stats_shard(),
+           COUNT(*) FILTER (WHERE transaction_type = 'generation'),
+           -SUM(credits_amount)
+    FROM new_rows
+    WHERE transaction_type IN ('consume', 'generation')
+    GROUP BY 1
+    ON CONFLICT (day, shard) DO UPDATE
+    SET generations = daily_usage.generations + EXCLUDED.generations,
+        credits_consumed = daily_usage.credits_consumed + EXCLUDED.credits_consumed;
+    RETURN NULL;
+END;
+$$;
+
+-- 转换表触发器每个只能对应一种事件
+DROP TRIGGER IF EXISTS users_stats_insert ON users;
+CREATE TRIGGER users_stats_insert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_usage_stats();
+-- 余额的变化由流水触发器计入 total_credits，users 上不设 UPDATE 触发器（预留、登录时间等更新不写统计）
+DROP TRIGGER IF EXISTS users_stats_delete ON users;
+CREATE TRIGGER users_stats_delete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_usage_stats();
+
+DROP TRIGGER IF EXISTS redemption_codes_stats_insert ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_insert AFTER INSERT ON redemption_codes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+DROP TRIGGER IF EXISTS redemption_codes_stats_update ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_update AFTER UPDATE ON redemption_codes
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+DROP TRIGGER IF EXISTS redemption_codes_stats_delete ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_delete AFTER DELETE ON redemption_codes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+
+DROP TRIGGER IF EXISTS credit_transactions_stats_insert ON credit_transactions;
+CREATE TRIGGER credit_transactions_stats_insert AFTER INSERT ON credit_transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION credit_transactions_usage_stats();
+
+-- 仪表盘读取：各计数的分片汇总（最多16行 × 计数种类）
+CREATE OR REPLACE FUNCTION get_app_stats()
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE(jsonb_object_agg(name, total), '{}'::jsonb)
+    FROM (SELECT name, SUM(value) AS total FROM app_stats GROUP BY name) s;
+$$;
+
+-- 按天的用量序列（用于趋势图）
+CREATE OR REPLACE FUNCTION get_daily_usage(p_from DATE, p_to DATE)
+RETURNS TABLE (day DATE, generations BIGINT, credits_consumed BIGINT, redemptions BIGINT,
+               credits_redeemed BIGINT, signups BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT d.day, SUM(d.generations), SUM(d.credits_consumed), SUM(d.redemptions),
+           SUM(d.credits_redeemed), SUM(d.signups)
+    FROM daily_usage d
+    WHERE d.day BETWEEN p_from AND p_to
+    GROUP BY d.day
+    ORDER BY d.day;
+$$;
+
+-- 从基础表重新计算全部计数和每日汇总（首次部署回填、或怀疑计数漂移时运行）
+-- 计算期间以SHARE模式锁定三张表，阻塞写入但不阻塞读取
+CREATE OR REPLACE FUNCTION rebuild_usage_stats()
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOCK TABLE users, redemption_codes, credit_transactions, credit_transaction_archives IN SHARE MODE;
+    DELETE FROM app_stats;
+    DELETE FROM daily_usage;
+
+    INSERT INTO app_stats (name, shard, value)
+    SELECT 'users', 0, COUNT(*) FROM users
+    UNION ALL SELECT 'total_credits', 0, COALESCE(SUM(credits), 0) FROM users
+    UNION ALL SELECT 'codes', 0, COUNT(*) FROM redemption_codes
+    UNION ALL SELECT 'used_codes', 0, COUNT(*) FROM redemption_codes WHERE is_used
+    UNION ALL SELECT 'transactions', 0,
+              (SELECT COUNT(*) FROM credit_transactions)
+              + (SELECT COALESCE(SUM(row_count), 0) FROM credit_transaction_archives)
+    UNION ALL SELECT 'generations', 0,
+              (SELECT COUNT(*) FROM credit_transactions WHERE transaction_type = 'generation')
+              + (SELECT COALESCE(SUM(generations), 0) FROM credit_transaction_archives);
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed, redemptions, credits_redeemed, signups)
+    SELECT day, 0, SUM(generations), SUM(credits_consumed), SUM(redemptions), SUM(credits_redeemed), SUM(signups)
+    FROM (
+        SELECT created_at::date AS day,
+               COUNT(*) FILTER (WHERE transaction_type = 'generation') AS generations,
+               -SUM(credits_amount) AS credits_consumed,
+               0 AS redemptions, 0 AS credits_redeemed, 0 AS signups
+        FROM credit_transactions WHERE transaction_type IN ('consume', 'generation') GROUP BY 1
+        UNION ALL
+        SELECT partition_date, SUM(generations), SUM(credits_consumed), 0, 0, 0
+        FROM credit_transaction_archives GROUP BY 1
+        UNION ALL
+        SELECT used_at::date, 0, 0, COUNT(*), SUM(credits_value), 0
+        FROM redemption_codes WHERE is_used AND used_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 0, 0, 0, 0, COUNT(*) FROM users GROUP BY 1
+    ) t
+    GROUP BY day;
+
+    RETURN get_app_stats();
+END;
+$$;
+
+-- 11. 插入初始管理员密码设置
 -- 注意：这里使用的是bcrypt加密的 'admin123' 密码
 -- 实际部署时应该更改为更安全的密码
 INSERT INTO settings (key, value) VALUES 
 ('admin_password', '$2b$12$LQv3c1yqBWVHxkd0LHAkCOYz6TtxMQJqhN8/LewdBdXfs2Sk4u2EK')
 ON CONFLICT (key) DO NOTHING;
 
--- 6. 创建一些示例兑换码（可选）
+-- 12. 创建一些示例兑换码（可选）
 INSERT INTO redemption_codes (code, credits_value, description) VALUES 
 ('WELCOME2024', 100, '新用户欢迎积分'),
 ('TESTCODE123', 50, '测试兑换码')
@@ -72,4 +946,14 @@ SELECT 'redemption_codes', COUNT(*) FROM redemption_codes
 UNION ALL
 SELECT 'credit_transactions', COUNT(*) FROM credit_transactions
 UNION ALL
+SELECT 'credit_holds', COUNT(*) FROM credit_holds
+UNION ALL
+SELECT 'credit_balance_snapshots', COUNT(*) FROM credit_balance_snapshots
+UNION ALL
+SELECT 'credit_transaction_archives', COUNT(*) FROM credit_transaction_archives
+UNION ALL
+SELECT 'app_stats', COUNT(*) FROM app_stats
+UNION ALL
+SELECT 'daily_usage', COUNT(*) FROM daily_usage
+UNION ALL
 SELECT 'settings', COUNT(*) FROM settings;
@@ -14,8 +14,10 @@ import urllib.parse
 import time
 from functools import wraps
 
-from models import db, User
+from repository import repository, GENERATION_TRANSACTION
+from ledger_outbox import ledger_outbox
 from auth import auth_required
+from idempotency import idempotent
 
 # --- 蓝图和配置 ---
 credits_bp = Blueprint('credits', __name__, url_prefix='/credits')
@@ -23,45 +25,80 @@ CREDIT_COSTS = {
     'generate_image': 1,
     'generate_colors': 1,
 }
+# 积分预留的有效期（秒），需大于一次生成（含重试）的最长耗时
+CREDIT_HOLD_TTL = int(os.getenv('CREDIT_HOLD_TTL', 600))
 
 # --- 核心服务逻辑 ---
-def check_credits_and_consume(user, service_type):
-    """检查并消费积分"""
-    amount = CREDIT_COSTS.get(service_type, 1)
-    if user.credits < amount:
-        raise ValueError(f"积分余额不足，需要 {amount} 积分，当前为 {user.credits} 积分")
+class InsufficientCredits(ValueError):
+    """可用积分不足"""
     
-    description = f"使用服务: {service_type}"
-    transaction = user.consume_credits(amount, description)
-    return transaction, amount
+    def __init__(self, required, available):
+        super().__init__(f"积分余额不足，需要 {required} 积分，当前可用 {available} 积分")
+        self.required = required
+        self.available = available
+
+def place_credit_hold(user, amount, description, transaction_type='consume'):
+    """在调用服务前预留积分，返回 {'hold_id', 'credits', 'held_credits'}（预留时数据库中的余额）；
+    可用余额不足时抛出InsufficientCredits，数据库错误原样抛出"""
+    hold = repository.place_hold(user['id'], amount, description, CREDIT_HOLD_TTL, transaction_type)
+    if hold is None:
+        raise InsufficientCredits(amount, 0)
+    if hold['hold_id'] is None:
+        raise InsufficientCredits(amount, max(hold['credits'] - hold['held_credits'], 0))
+    return hold
+
+def capture_credit_hold(user, hold, amount):
+    """结算预留：写入本地发件箱后由后台线程批量提交，返回预计的剩余积分（预留时的余额减去本次消费）"""
+    ledger_outbox.capture(hold['hold_id'], user['id'])
+    remaining = hold['credits'] - amount
+    repository.update_cached_credits(user['id'], remaining)
+    return remaining
+
+def release_credit_hold(user, hold_id):
+    """释放预留（写入发件箱失败时直接释放，仍失败则等预留超时自动失效）"""
+    try:
+        ledger_outbox.release(hold_id, user['id'])
+    except Exception as e:
+        current_app.logger.error(f"登记释放积分预留 {hold_id} 失败: {e}")
+        try:
+            repository.release_hold(hold_id)
+        except Exception as e:
+            current_app.logger.error(f"释放积分预留 {hold_id} 失败: {e}")
 
 def require_credits(service_type):
-    """装饰器：在执行函数前检查并消费积分"""
+    """装饰器：执行前预留积分，成功后结算，失败时释放"""
     def decorator(f):
         @wraps(f)
         @auth_required
         def wrapper(current_user, *args, **kwargs):
+            amount = CREDIT_COSTS.get(service_type, 1)
+            try:
+                hold = place_credit_hold(current_user, amount, f"使用服务: {service_type}")
+            except InsufficientCredits as e:
+                return jsonify({'error': str(e)}), 400
+            except Exception as e:
+                current_app.logger.error(f"预留积分时出错: {e}")
+                return jsonify({'error': '服务暂时不可用'}), 503
+            
+            captured = False
             try:
-                _, amount = check_credits_and_consume(current_user, service_type)
-                
                 result = f(current_user, *args, **kwargs)
                 response, status_code = result
                 if 200 <= status_code < 300:
-                    db.session.commit()
-                    current_app.logger.info(f"用户 {current_user.username} 成功消费 {amount} 积分。")
+                    capture_credit_hold(current_user, hold, amount)
+                    captured = True
+                    current_app.logger.info(f"用户 {current_user['username']} 成功消费 {amount} 积分。")
                 else:
-                    db.session.rollback()
-                    current_app.logger.warning(f"服务执行失败，为用户 {current_user.username} 回滚积分。")
+                    current_app.logger.warning(f"服务执行失败，为用户 {current_user['username']} 释放预留积分。")
                 
                 return result
-            except ValueError as e:
-                db.session.rollback()
-                return jsonify({'error': str(e)}), 400
             except Exception as e:
-                db.session.rollback()
                 current_app.logger.error(f"处理积分或服务时出错: {e}")
                 traceback.print_exc()
                 return jsonify({'error': '服务暂时不可用'}), 500
+            finally:
+                if not captured:
+                    release_credit_hold(current_user, hold['hold_id'])
         return wrapper
     return decorator
 
@@ -185,6 +222,7 @@ def generate_placeholder_svg(prompt):
 # --- 稳定版图片生成 ---
 @credits_bp.route('/generate-creation', methods=['POST'])
 @auth_required
+@idempotent('generate_creation')
 def generate_creation(current_user):
     """稳定版：原子化地生成图片和配色方案"""
     print("=== 开始处理图片生成请求 ===")  # 使用print确保输出
@@ -202,12 +240,24 @@ def generate_creation(current_user):
         return jsonify({"error": "图片描述太短，请至少输入2个字符"}), 400
 
     total_cost = CREDIT_COSTS.get('generate_image', 1)  # 只扣除图片生成费用，配色推荐免费
-    if current_user.credits < total_cost:
+    # 预留积分后再调用上游服务：并发请求不会同时通过余额检查，调用期间不占用数据库事务
+    try:
+        hold = place_credit_hold(current_user, total_cost, f"生成创作: {prompt[:50]}", GENERATION_TRANSACTION)
+    except InsufficientCredits as e:
         return jsonify({
-            'error': f"积分余额不足，需要 {total_cost} 积分，当前余额 {current_user.credits} 积分",
-            'current_credits': current_user.credits,
+            'error': str(e),
+            'current_credits': e.available,
             'required_credits': total_cost
         }), 400
+    except Exception as e:
+        current_app.logger.error(f"预留积分时出错: {e}")
+        return jsonify({
+            'error': '积分服务暂时不可用，请稍后重试。您的积分未被扣除。',
+            'required_credits': total_cost
+        }), 503
+    # 失败时预留会被释放，响应中返回预留时读取的余额（缓存的用户信息可能已过期）
+    current_credits = hold['credits']
+    captured = False
 
     try:
         api_endpoint = os.getenv("IMAGE_API_ENDPOINT", "https://api.gptgod.online/v1/chat/completions")
@@ -217,7 +267,7 @@ def generate_creation(current_user):
             current_app.logger.error("IMAGE_API_KEY未配置")
             return jsonify({
                 'error': '图片生成服务未配置，请联系管理员。您的积分未被扣除。',
-                'current_credits': current_user.credits,
+                'current_credits': current_credits,
                 'required_credits': total_cost
             }), 500
 
@@ -290,11 +340,10 @@ def generate_creation(current_user):
                         # 让前端决定是否能够加载图片
 
                     # 无论验证结果如何，都尝试返回图片（降级策略）
-                    current_app.logger.info("开始扣除积分")
-                    description = f"生成创作: {prompt[:50]}"
-                    current_user.consume_credits(total_cost, description)
-                    db.session.commit()
-                    current_app.logger.info(f"积分扣除成功，剩余积分: {current_user.credits}")
+                    current_app.logger.info("开始结算预留积分")
+                    new_credits = capture_credit_hold(current_user, hold, total_cost)
+                    captured = True
+                    current_app.logger.info(f"积分扣除成功，剩余积分: {new_credits}")
 
                     colors = random.choice([
                         ["#FF6B6B", "#4ECDC4", "#45B7D1", "#96CEB4", "#FFEAA7"],
@@ -307,7 +356,14 @@ def generate_creation(current_user):
                     response_data = {
                         "imageUrl": image_url,
                         "colors": colors,
-                        "user": current_user.to_dict()
+                        "user": {
+                            'id': current_user['id'],
+                            'username': current_user['username'],
+                            'email': current_user['email'],
+                            'credits': new_credits,
+                            'created_at': current_user['created_at'],
+                            'last_login': current_user.get('last_login')
+                        }
                     }
 
                     # 如果URL验证失败，添加警告信息
@@ -326,7 +382,7 @@ def generate_creation(current_user):
 
                         return jsonify({
                             'error': error_msg,
-                            'current_credits': current_user.credits,
+                            'current_credits': current_credits,
                             'required_credits': total_cost,
                             'debug_info': {
                                 'response_length': len(response.text),
@@ -342,7 +398,7 @@ def generate_creation(current_user):
                 if attempt == max_retries - 1:
                     return jsonify({
                         'error': f'图片生成超时（已重试{max_retries}次），OpenAI服务响应较慢，请稍后重试。您的积分未被扣除。',
-                        'current_credits': current_user.credits,
+                        'current_credits': current_credits,
                         'required_credits': total_cost
                     }), 504
                 # 指数退避：第一次重试等待5秒，第二次等待10秒
@@ -355,7 +411,7 @@ def generate_creation(current_user):
                 if attempt == max_retries - 1:
                     return jsonify({
                         'error': '图片生成服务暂时不可用，请稍后重试',
-                        'current_credits': current_user.credits,
+                        'current_credits': current_credits,
                         'required_credits': total_cost
                     }), 503
                 time.sleep(1)
@@ -364,7 +420,7 @@ def generate_creation(current_user):
         # 所有重试都失败，返回错误信息而不是占位符
         return jsonify({
             'error': '图片生成服务暂时不可用，请稍后重试。您的积分未被扣除。',
-            'current_credits': current_user.credits,
+            'current_credits': current_credits,
             'required_credits': total_cost
         }), 503
 
@@ -373,9 +429,12 @@ def generate_creation(current_user):
         traceback.print_exc()
         return jsonify({
             'error': f'服务暂时不可用: {str(e)}',
-            'current_credits': current_user.credits,
+            'current_credits': current_credits,
             'required_credits': total_cost
         }), 500
+    finally:
+        if not captured:
+            release_credit_hold(current_user, hold['hold_id'])
 
 
 @credits_bp.route('/generate-colors', methods=['POST'])
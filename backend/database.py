@@ -92,10 +92,26 @@ def reset_database():
     print("数据库重置完成")
 
 def get_database_stats():
-    """获取数据库统计信息"""
-    from models import db, User, RedemptionCode, CreditTransaction
+    """获取数据库统计信息
+
+    优先读取触发器维护的 app_stats 计数；没有计数时（如未安装触发器的本地SQLite库）
+    回退为直接统计各表
+    """
+    from models import db, User, RedemptionCode, CreditTransaction, AppStat
     
     try:
+        counters = dict(
+            db.session.query(AppStat.name, db.func.sum(AppStat.value)).group_by(AppStat.name).all()
+        )
+        if counters:
+            return {
+                'users': int(counters.get('users', 0)),
+                'redemption_codes': int(counters.get('codes', 0)),
+                'used_codes': int(counters.get('used_codes', 0)),
+                'transactions': int(counters.get('transactions', 0)),
+                'total_credits_in_system': int(counters.get('total_credits', 0))
+            }
+        
         stats = {
             'users': User.query.count(),
             'redemption_codes': RedemptionCode.query.count(),
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+数据导出
+通过 repository.iter_pages 按ID游标分页读取（Supabase后端每页一次REST请求，下一页在输出当前页时并发预取），
+逐页转换为NDJSON或CSV文本块，可选gzip压缩；内存占用只与页大小有关，与表大小无关。
+管理后台导出接口（admin.py）和 flask export 命令（app.py）共用
+"""
+import csv
+import io
+import itertools
+import json
+import os
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from repository import repository, EXPORT_COLUMNS
+
+# 每页读取的行数（Supabase默认单次最多返回1000行）
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE', 1000))
+
+# 可导出的表：名称 -> 导出的列；用户不导出密码哈希
+EXPORTS = EXPORT_COLUMNS
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_columns(kind: str) -> List[str]:
+    """导出的列名列表（CSV表头）"""
+    return list(EXPORTS[kind])
+
+
+def iter_ndjson(pages: Iterable[List[Dict[str, Any]]]) -> Iterator[str]:
+    """每页转换为一个NDJSON文本块（每行一个JSON对象）"""
+    for page in pages:
+        yield ''.join(json.dumps(row, ensure_ascii=False, separators=(',', ':')) + '\n' for row in page)
+
+
+def iter_csv(pages: Iterable[List[Dict[str, Any]]], fieldnames: List[str]) -> Iterator[str]:
+    """每页转换为一个CSV文本块（第一块为表头）"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    for page in pages:
+        writer.writerows(page)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_export(kind: str, fmt: str, filters: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """导出的文本块
+
+    第一页在调用时立即读取（不是在迭代时），数据库不可用等早期错误在开始输出响应前抛出
+    """
+    pages = iter(repository.iter_pages(kind, filters, page_size=EXPORT_PAGE_SIZE))
+    first_page = next(pages, None)
+    pages = itertools.chain([first_page] if first_page is not None else [], pages)
+    if fmt == 'csv':
+        return iter_csv(pages, export_columns(kind))
+    return iter_ndjson(pages)
+
+
+def encode_chunks(chunks: Iterable[str], compress: bool = False) -> Iterator[bytes]:
+    """文本块编码为UTF-8字节，compress=True时边读边gzip压缩（输出为标准.gz格式）"""
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filename(kind: str, fmt: str, compress: bool, timestamp: str) -> str:
+    """下载文件名，如 users_20240101_120000.ndjson.gz"""
+    return f"{kind}_{timestamp}.{fmt}{'.gz' if compress else ''}"
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+幂等键
+客户端在 Idempotency-Key 请求头中携带随机键，同一用户在有效期内用同一个键重复提交时，
+不再重复执行（上游生成、数据库写入），而是等待首个请求完成或直接重放其响应。
+
+键保存在共享缓存后端的独立存储中（见 cache.py），多个worker之间可见；存储容量有上限，
+过期和最久未使用的键会被淘汰，其他缓存条目不占用其容量
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from typing import Any, Dict
+
+from flask import request, jsonify, make_response
+
+from cache import NamespacedCache, idempotency_backend
+
+logger = logging.getLogger(__name__)
+
+# 已完成请求的响应保留时间（秒）
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 3600))
+# 处理中标记的保留时间（秒），需大于最长的请求耗时；进程崩溃时标记到期后可重新提交
+IDEMPOTENCY_PENDING_TTL = float(os.getenv('IDEMPOTENCY_PENDING_TTL', 300))
+# 重复请求等待首个请求完成的最长时间（秒）
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 150))
+IDEMPOTENCY_POLL_INTERVAL = 0.5
+MAX_KEY_LENGTH = 128
+
+idempotency_store = NamespacedCache(idempotency_backend, 'idem', ttl=IDEMPOTENCY_TTL)
+
+
+class IdempotencyStats:
+    """幂等键统计：重放和等待的次数即避免的重复执行次数"""
+
+    def __init__(self):
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, scope: str, outcome: str) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(scope, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for scope, counts in self._counts.items():
+                result[scope] = dict(counts)
+                result[scope]['avoided'] = counts.get('replayed', 0) + counts.get('waited', 0)
+            return result
+
+
+idempotency_stats = IdempotencyStats()
+
+
+def _fingerprint() -> str:
+    """请求体摘要，防止同一个键被用于不同的请求"""
+    return hashlib.sha256(request.get_data() or b'').hexdigest()
+
+
+def _replay(entry: Dict[str, Any]):
+    response = make_response(entry['body'], entry['status'])
+    response.mimetype = entry.get('mimetype', 'application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(scope: str):
+    """幂等装饰器，放在认证装饰器之下（第一个参数为当前用户）
+
+    未携带 Idempotency-Key 时正常执行；成功和客户端错误（2xx/4xx）的响应被保存并重放，
+    服务端错误（5xx）和异常不保存，客户端可以用同一个键重试
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(current_user, *args, **kwargs):
+            key = request.headers.get('Idempotency-Key', '').strip()
+            if not key:
+                return f(current_user, *args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'error': 'Idempotency-Key过长'}), 400
+
+            user_id = current_user['id'] if isinstance(current_user, dict) else current_user.id
+            store_key = f'{scope}:{user_id}:{key}'
+            fingerprint = _fingerprint()
+
+            deadline = time.monotonic() + IDEMPOTENCY_WAIT
+            waited = False
+            while True:
+                try:
+                    claimed = idempotency_store.add(
+                        store_key, {'state': 'pending', 'fingerprint': fingerprint},
+                        ttl=IDEMPOTENCY_PENDING_TTL
+                    )
+                    entry = None if claimed else idempotency_store.get(store_key)
+                except Exception as e:
+                    # 存储异常时按无幂等键处理，不影响正常请求
+                    logger.error(f"幂等键存储失败: {e}")
+                    return f(current_user, *args, **kwargs)
+
+                if claimed:
+                    break
+                if entry is not None:
+                    if entry.get('fingerprint') != fingerprint:
+                        idempotency_stats.record(scope, 'mismatched')
+                        return jsonify({'error': 'Idempotency-Key已用于其他请求'}), 422
+                    if entry['state'] == 'done':
+                        idempotency_stats.record(scope, 'waited' if waited else 'replayed')
+                        return _replay(entry)
+                # 首个请求仍在处理中时等待；首个请求失败删除标记后重新认领
+                if time.monotonic() >= deadline:
+                    idempotency_stats.record(scope, 'in_progress')
+                    return jsonify({'error': '相同的请求正在处理中，请稍后查看结果'}), 409
+                if entry is not None:
+                    waited = True
+                    time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+            idempotency_stats.record(scope, 'executed')
+            try:
+                response = make_response(f(current_user, *args, **kwargs))
+            except Exception:
+                idempotency_store.delete(store_key)
+                raise
+
+            try:
+                if response.status_code < 500:
+                    idempotency_store.set(store_key, {
+                        'state': 'done',
+                        'fingerprint': fingerprint,
+                        'status': response.status_code,
+                        'mimetype': response.mimetype,
+                        'body': response.get_data(as_text=True)
+                    })
+                else:
+                    idempotency_store.delete(store_key)
+            except Exception as e:
+                logger.error(f"保存幂等响应失败: {e}")
+            return response
+        return decorated_function
+    return decorator
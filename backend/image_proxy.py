@@ -50,16 +50,21 @@ def download_image(url, filename):
         return False
 
 def get_cached_image_path(url):
-    """获取缓存图片路径"""
+    """获取缓存图片路径（按文件修改时间判断是否过期，过期或不存在时重新下载）
+
+    一次stat同时判断文件是否存在和缓存时间，不额外查询缓存后端
+    """
     ensure_cache_dir()
     
     filename = get_cache_filename(url)
     file_path = os.path.join(CACHE_DIR, filename)
     
-    if os.path.exists(file_path):
-        file_age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(file_path))
-        if file_age < CACHE_DURATION:
-            return file_path
+    try:
+        cached_at = datetime.fromtimestamp(os.stat(file_path).st_mtime)
+    except FileNotFoundError:
+        cached_at = None
+    if cached_at is not None and datetime.now() - cached_at < CACHE_DURATION:
+        return file_path
     
     if download_image(url, filename):
         return file_path
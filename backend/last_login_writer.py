@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+最后登录时间的延迟批量写入
+登录时只在内存中记录时间，由后台线程按固定间隔合并成一次批量更新，
+去掉登录路径上的一次数据库写操作；进程退出时写入剩余数据
+"""
+import atexit
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class LastLoginWriter:
+    """last_login 写缓冲区"""
+
+    def __init__(self, flush_interval: float = 10.0, max_pending: int = 10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Dict[int, str] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.flushed = 0
+        self.failed_flushes = 0
+
+    def record(self, user_id: int, last_login: str = None) -> None:
+        """记录一次登录（同一用户只保留最新时间）"""
+        last_login = last_login or datetime.now().isoformat()
+        with self._lock:
+            self._pending[user_id] = last_login
+            pending = len(self._pending)
+        self._ensure_started()
+
+        # 积压过多时提前写入，避免内存无限增长
+        if pending >= self.max_pending:
+            self.flush()
+
+    def flush(self) -> int:
+        """把缓冲区中的登录时间一次性写入数据库，返回写入条数"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+
+            from repository import repository
+            updates = [{'id': user_id, 'last_login': last_login} for user_id, last_login in batch.items()]
+            try:
+                repository.batch_update_last_login(updates)
+            except Exception as e:
+                # 写入失败时放回缓冲区（保留较新的时间），下个周期重试
+                logger.error(f"批量更新最后登录时间失败: {e}")
+                self.failed_flushes += 1
+                with self._lock:
+                    for user_id, last_login in batch.items():
+                        if self._pending.get(user_id, '') < last_login:
+                            self._pending[user_id] = last_login
+                return 0
+
+            self.flushed += len(updates)
+            return len(updates)
+
+    def _ensure_started(self) -> None:
+        """首次记录时启动后台刷新线程"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='last-login-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self) -> None:
+        """停止后台线程并写入剩余数据"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval)
+        self.flush()
+
+    def stats(self):
+        """缓冲区统计信息"""
+        with self._lock:
+            pending = len(self._pending)
+        return {'pending': pending, 'flushed': self.flushed, 'failed_flushes': self.failed_flushes}
+
+
+last_login_writer = LastLoginWriter(
+    flush_interval=float(os.getenv('LAST_LOGIN_FLUSH_SECONDS', 10)),
+    max_pending=int(os.getenv('LAST_LOGIN_MAX_PENDING', 10000))
+)
+
+# 进程退出时写入剩余的登录时间
+atexit.register(last_login_writer.stop)
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+积分流水归档
+credit_transactions 只追加，表和索引随时间无限增长。超过保留期（ARCHIVE_RETENTION_DAYS）的流水：
+    1. 先写入余额快照（余额 = 最近一次快照 + 之后的流水，归档范围不超过快照边界，余额和对账不受影响）
+    2. 按ID顺序分批读取，每批按日期写入压缩的NDJSON文件（zstd，未安装zstandard时为gzip）：
+           ARCHIVE_DIR/credit_transactions/date=2024-01-05/<首条ID>-<末条ID>.ndjson.zst
+    3. 文件落盘（fsync文件和所在目录）并重新读取校验大小和SHA-256后，才在一个事务内记录文件清单
+       （credit_transaction_archives）并删除这一批流水，删除数量与文件行数不一致时回滚；
+       中途失败时已写入的文件在下次归档同一批时被覆盖
+全部批次完成后删除已被取代的旧快照。热表只保留保留期内的流水，删除后的空间由autovacuum回收复用。
+已归档的历史通过 iter_archived / archived_page 按需读取（只打开包含该用户的文件，并校验SHA-256）。
+归档文件是这些流水唯一的副本：ARCHIVE_DIR 没有默认值，必须显式设置为持久化磁盘上的目录，
+未设置时拒绝归档（Render的实例磁盘在重新部署时会被清空，需挂载持久化磁盘，见 render.yaml）
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterator, List, Optional
+
+from exports import iter_ndjson
+from pagination import encode_cursor, decode_cursor
+from repository import repository, GENERATION_TRANSACTION, CONSUME_TRANSACTIONS
+
+try:
+    import zstandard
+except ImportError:  # 未安装时使用gzip压缩
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# 归档目录（必须位于持久化磁盘上，没有默认值）
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', 180))
+# 每批读取、写入文件并删除的行数（一批在内存中压缩，按日期拆分为多个文件）
+ARCHIVE_BATCH_ROWS = int(os.getenv('ARCHIVE_BATCH_ROWS', 20000))
+ARCHIVE_COMPRESSION = os.getenv('ARCHIVE_COMPRESSION', 'zstd' if zstandard else 'gzip').lower()
+# 每次读取的行数（Supabase默认单次最多返回1000行）
+ARCHIVE_PAGE_SIZE = 1000
+
+# 压缩格式 -> 文件扩展名
+EXTENSIONS = {'zstd': '.zst', 'gzip': '.gz'}
+ZSTD_LEVEL = 10
+GZIP_LEVEL = 9
+
+
+def compress(data: bytes, compression: str) -> bytes:
+    if compression == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd压缩需要安装zstandard（pip install zstandard），或设置 ARCHIVE_COMPRESSION=gzip")
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def decompress(data: bytes, path: str) -> bytes:
+    """按文件扩展名解压"""
+    if path.endswith(EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise RuntimeError(f"读取 {path} 需要安装zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class ArchiveDirNotConfigured(RuntimeError):
+    """未设置 ARCHIVE_DIR"""
+
+
+def archive_path(path: str) -> str:
+    """清单中的相对路径（以/分隔）对应的文件路径"""
+    if not ARCHIVE_DIR:
+        raise ArchiveDirNotConfigured("未设置 ARCHIVE_DIR：归档文件是流水唯一的副本，需指定持久化磁盘上的目录")
+    return os.path.join(ARCHIVE_DIR, *path.split('/'))
+
+
+def _fsync_dir(path: str) -> None:
+    """把目录项（新建和改名的文件）写入磁盘；Windows不支持打开目录，跳过"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def retention_cutoff(retention_days: int = ARCHIVE_RETENTION_DAYS) -> datetime:
+    """保留期的起点（retention_days天前的零点），此前写入的流水可以归档"""
+    return datetime.combine(date.today() - timedelta(days=retention_days), time.min)
+
+
+def write_partition(partition_date: str, rows: List[Dict[str, Any]], compression: str) -> Dict[str, Any]:
+    """把同一天的流水写入一个文件（先写临时文件再改名），返回清单记录"""
+    data = compress(''.join(iter_ndjson([rows])).encode('utf-8'), compression)
+    path = f"credit_transactions/date={partition_date}/{rows[0]['id']}-{rows[-1]['id']}.ndjson{EXTENSIONS[compression]}"
+    full_path = archive_path(path)
+    directory = os.path.dirname(full_path)
+    os.makedirs(directory, exist_ok=True)
+    with open(full_path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(full_path + '.tmp', full_path)
+    # 改名后的目录项同样落盘（新建的日期目录逐级到 ARCHIVE_DIR），断电后文件不会丢失
+    for parent in (directory, os.path.dirname(directory), ARCHIVE_DIR):
+        _fsync_dir(parent)
+
+    # 重新读取校验，确认落盘的内容与将要写入清单的一致后才允许删除流水
+    sha256 = hashlib.sha256(data).hexdigest()
+    with open(full_path, 'rb') as f:
+        written = f.read()
+    if len(written) != len(data) or hashlib.sha256(written).hexdigest() != sha256:
+        raise IOError(f"归档文件写入校验失败: {path}")
+
+    consumed = [row for row in rows if row['transaction_type'] in CONSUME_TRANSACTIONS]
+    return {
+        'partition_date': partition_date,
+        'path': path,
+        'first_transaction_id': rows[0]['id'],
+        'last_transaction_id': rows[-1]['id'],
+        'row_count': len(rows),
+        'user_ids': sorted({row['user_id'] for row in rows}),
+        # 与 credit_transactions_usage_stats 触发器的统计口径一致
+        'generations': sum(1 for row in rows if row['transaction_type'] == GENERATION_TRANSACTION),
+        'credits_consumed': -sum(row['credits_amount'] for row in consumed),
+        'bytes': len(data),
+        'sha256': sha256
+    }
+
+
+def _read_batch(before: datetime, max_id: int, after_id: int, batch_rows: int) -> List[Dict[str, Any]]:
+    rows = []
+    while len(rows) < batch_rows:
+        limit = min(ARCHIVE_PAGE_SIZE, batch_rows - len(rows))
+        page = repository.archivable_transactions(
+            before, max_id, after_id=rows[-1]['id'] if rows else after_id, limit=limit
+        )
+        rows.extend(page)
+        if len(page) < limit:
+            break
+    return rows
+
+
+def archive_transactions(retention_days: int = ARCHIVE_RETENTION_DAYS, batch_rows: int = ARCHIVE_BATCH_ROWS,
+                         compression: str = ARCHIVE_COMPRESSION, settle_seconds: int = 300) -> Dict[str, Any]:
+    """归档保留期之前的流水
+
+    返回 {'before', 'snapshots', 'transactions', 'files', 'bytes', 'pruned_snapshots'}；
+    未设置 ARCHIVE_DIR 时抛出 ArchiveDirNotConfigured，不写快照、不删除任何流水
+    """
+    if compression not in EXTENSIONS:
+        raise ValueError(f"不支持的压缩格式: {compression}")
+    if not ARCHIVE_DIR:
+        raise ArchiveDirNotConfigured("未设置 ARCHIVE_DIR，拒绝归档：归档后的流水只保存在该目录中，"
+                                      "需指定持久化磁盘上的目录（实例磁盘在重新部署时会被清空）")
+
+    before = retention_cutoff(retention_days)
+    summary = {
+        'before': before.isoformat(),
+        'snapshots': repository.write_snapshots(settle_seconds),
+        'transactions': 0,
+        'files': 0,
+        'bytes': 0,
+        'pruned_snapshots': 0
+    }
+
+    max_id = repository.archive_boundary(before)
+    after_id = 0
+    while max_id:
+        rows = _read_batch(before, max_id, after_id, batch_rows)
+        if not rows:
+            break
+
+        partitions = defaultdict(list)
+        for row in rows:
+            partitions[row['created_at'][:10]].append(row)
+        archives = [write_partition(day, day_rows, compression) for day, day_rows in sorted(partitions.items())]
+
+        deleted = repository.archive_transactions(rows[0]['id'], rows[-1]['id'], before, archives)
+        summary['transactions'] += deleted
+        summary['files'] += len(archives)
+        summary['bytes'] += sum(archive['bytes'] for archive in archives)
+        logger.info(f"已归档流水 {rows[0]['id']}-{rows[-1]['id']}（{deleted} 条，{len(archives)} 个文件）")
+        after_id = rows[-1]['id']
+
+    if summary['transactions']:
+        summary['pruned_snapshots'] = repository.prune_snapshots(max_id)
+    return summary
+
+
+def read_archive(archive: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """读取一个归档文件中的全部流水（按ID顺序），文件与清单中的SHA-256不一致时抛出 ValueError"""
+    with open(archive_path(archive['path']), 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != archive['sha256']:
+        raise ValueError(f"归档文件校验失败: {archive['path']}")
+    return [json.loads(line) for line in decompress(data, archive['path']).decode('utf-8').splitlines() if line]
+
+
+def iter_archived(user_id: Optional[int] = None, start: Optional[date] = None,
+                  end: Optional[date] = None) -> Iterator[Dict[str, Any]]:
+    """按日期遍历已归档的流水，可按用户和日期范围（包含两端）过滤；按用户过滤时跳过不含该用户的文件"""
+    for archive in repository.transaction_archives(start, end):
+        if user_id is not None and user_id not in archive['user_ids']:
+            continue
+        for row in read_archive(archive):
+            if user_id is None or row['user_id'] == user_id:
+                yield row
+
+
+def archived_page(user_id: int, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """按 (created_at DESC, id) 游标分页读取用户已归档的流水（游标格式与 repository.transactions_page 相同）
+
+    从游标所在的日期往前逐日读取，读够 limit+1 行即停止；返回 {'items', 'next_cursor', 'total'}
+    """
+    after = decode_cursor(cursor, 'datetime')
+
+    by_date = defaultdict(list)
+    for archive in repository.transaction_archives(end=after[0].date() if after else None):
+        if user_id in archive['user_ids']:
+            by_date[archive['partition_date']].append(archive)
+
+    items = []
+    for day in sorted(by_date, reverse=True):
+        rows = [row for archive in by_date[day] for row in read_archive(archive) if row['user_id'] == user_id]
+        if after:
+            rows = [row for row in rows if (datetime.fromisoformat(row['created_at']), -row['id']) < (after[0], -after[1])]
+        rows.sort(key=lambda row: (datetime.fromisoformat(row['created_at']), -row['id']), reverse=True)
+        items.extend(rows)
+        if len(items) > limit:
+            break
+
+    page = items[:limit]
+    next_cursor = None
+    if len(items) > limit:
+        next_cursor = encode_cursor(page[-1]['created_at'], page[-1]['id'])
+    return {'items': page, 'next_cursor': next_cursor, 'total': None}
+
+
+class LedgerArchiveJob:
+    """定期归档保留期之前的积分流水"""
+
+    def __init__(self, interval: float = 0.0, retention_days: int = ARCHIVE_RETENTION_DAYS):
+        self.interval = interval
+        self.retention_days = retention_days
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.archived = 0
+        self.failed_runs = 0
+
+    def run_once(self) -> int:
+        """归档一轮，返回归档的流水数"""
+        try:
+            summary = archive_transactions(self.retention_days)
+        except Exception as e:
+            logger.error(f"归档积分流水失败: {e}")
+            self.failed_runs += 1
+            return 0
+
+        self.runs += 1
+        self.archived += summary['transactions']
+        return summary['transactions']
+
+    def start(self) -> None:
+        """启动后台线程（interval为0或未设置 ARCHIVE_DIR 时不启动）；首次执行在一个间隔之后"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        if not ARCHIVE_DIR:
+            logger.error("设置了 LEDGER_ARCHIVE_SECONDS 但未设置 ARCHIVE_DIR，不启动积分流水归档")
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='ledger-archive', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.run_once()
+
+    def stop(self) -> None:
+        """停止后台线程"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        """任务统计信息"""
+        return {
+            'interval': self.interval,
+            'retention_days': self.retention_days,
+            'runs': self.runs,
+            'archived': self.archived,
+            'failed_runs': self.failed_runs
+        }
+
+
+# 默认不启动（可用 flask archive-credits 定时执行）；只需一个worker设置 LEDGER_ARCHIVE_SECONDS
+ledger_archive_job = LedgerArchiveJob(interval=float(os.getenv('LEDGER_ARCHIVE_SECONDS', 0)))
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+积分结算发件箱
+生成成功/失败后的预留结算和释放操作先写入本地SQLite文件（持久化），
+由后台线程按批次一次RPC提交，失败时保留在发件箱中下个周期重试；
+进程退出时提交剩余操作，进程崩溃后由下次启动的恢复流程重新提交。
+数据库端只结算尚未结算的预留（含提交晚于有效期而过期的预留），重复提交不会重复扣款；
+结算数量少于提交数量时记录警告（unsettled）。
+LEDGER_OUTBOX_PATH 需要位于持久化磁盘上：实例磁盘在重新部署时被清空，未提交的结算随之丢失
+"""
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+CAPTURE = 'capture'
+RELEASE = 'release'
+
+
+class LedgerOutbox:
+    """预留结算/释放操作的本地发件箱"""
+
+    def __init__(self, path: str, flush_interval: float = 2.0, batch_size: int = 200,
+                 claim_timeout: float = 60.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.failed_flushes = 0
+        self.unsettled = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS outbox ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'op TEXT NOT NULL, '
+            'hold_id INTEGER NOT NULL, '
+            'user_id INTEGER NOT NULL, '
+            'created_at REAL NOT NULL, '
+            'claimed_at REAL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'last_error TEXT)'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # 发件箱是结算操作的唯一记录，每次提交都落盘
+            conn.execute('PRAGMA synchronous=FULL')
+            self._local.conn = conn
+        return conn
+
+    def record(self, op: str, hold_id: int, user_id: int) -> None:
+        """写入一条结算/释放操作（返回时已持久化）"""
+        self._connection().execute(
+            'INSERT INTO outbox (op, hold_id, user_id, created_at) VALUES (?, ?, ?, ?)',
+            (op, hold_id, user_id, time.time())
+        )
+        self._ensure_started()
+
+    def capture(self, hold_id: int, user_id: int) -> None:
+        """登记结算预留"""
+        self.record(CAPTURE, hold_id, user_id)
+
+    def release(self, hold_id: int, user_id: int) -> None:
+        """登记释放预留"""
+        self.record(RELEASE, hold_id, user_id)
+
+    def _claim(self) -> List[tuple]:
+        """认领一批未发送的操作；其他进程认领后超时未完成的操作可被重新认领"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, op, hold_id, user_id FROM outbox '
+                'WHERE claimed_at IS NULL OR claimed_at < ? ORDER BY id LIMIT ?',
+                (now - self.claim_timeout, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany('UPDATE outbox SET claimed_at = ? WHERE id = ?',
+                                 [(now, row[0]) for row in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def flush(self) -> int:
+        """提交发件箱中的操作，返回提交成功的条数"""
+        from repository import repository
+
+        sent = 0
+        with self._flush_lock:
+            while True:
+                rows = self._claim()
+                if not rows:
+                    return sent
+
+                batches: Dict[str, List[tuple]] = {CAPTURE: [], RELEASE: []}
+                for row in rows:
+                    batches[row[1]].append(row)
+
+                # 两类操作分别提交，一类失败不影响另一类（失败的只重置这一类，避免另一类被认领锁住直到超时）
+                conn = self._connection()
+                failed = False
+                for op, batch in batches.items():
+                    if not batch:
+                        continue
+                    hold_ids = [row[2] for row in batch]
+                    try:
+                        if op == CAPTURE:
+                            settled = repository.capture_holds(hold_ids)
+                        else:
+                            settled = repository.release_holds(hold_ids)
+                    except Exception as e:
+                        # 保留在发件箱中，下个周期重试
+                        logger.error(f"提交积分{op}操作失败（{len(batch)}条，稍后重试）: {e}")
+                        self.failed_flushes += 1
+                        conn.executemany(
+                            'UPDATE outbox SET claimed_at = NULL, attempts = attempts + 1, last_error = ? '
+                            'WHERE id = ?',
+                            [(str(e)[:500], row[0]) for row in batch]
+                        )
+                        failed = True
+                        continue
+
+                    conn.executemany('DELETE FROM outbox WHERE id = ?', [(row[0],) for row in batch])
+                    sent += len(batch)
+                    with self._lock:
+                        self.sent += len(batch)
+                    if op == CAPTURE and settled < len(hold_ids):
+                        # 已结算的重复提交不会再扣款；已释放、或过期后可用余额不足的预留未扣款，需人工核对
+                        logger.warning(f"积分预留结算数量不足：提交 {len(hold_ids)} 条，结算 {settled} 条"
+                                       f"（预留ID: {hold_ids}）")
+                        with self._lock:
+                            self.unsettled += len(hold_ids) - settled
+
+                # 有失败时本轮不再认领（失败的操作会被立即重新认领），下个周期重试
+                if failed or len(rows) < self.batch_size:
+                    return sent
+
+    def recover(self) -> int:
+        """恢复：提交上次进程崩溃时未发送的操作（含被认领但未完成的）"""
+        self._connection().execute(
+            'UPDATE outbox SET claimed_at = NULL WHERE claimed_at < ?',
+            (time.time() - self.claim_timeout,)
+        )
+        return self.flush()
+
+    def _ensure_started(self) -> None:
+        """首次记录时启动后台提交线程"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='ledger-outbox', daemon=True)
+            self._thread.start()
+
+    def start(self) -> None:
+        """启动后台提交线程，先恢复上次未发送的操作"""
+        if not os.getenv('LEDGER_OUTBOX_PATH'):
+            logger.warning(f"未设置 LEDGER_OUTBOX_PATH，发件箱位于 {self.path}，"
+                           "该目录不在持久化磁盘上时，重新部署会丢失未提交的积分结算")
+        self._ensure_started()
+
+    def _run(self) -> None:
+        self._safe_flush(self.recover)
+        while not self._stop_event.wait(self.flush_interval):
+            self._safe_flush(self.flush)
+
+    def _safe_flush(self, flush) -> None:
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"积分发件箱提交异常: {e}")
+
+    def stop(self) -> None:
+        """停止后台线程并提交剩余操作"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.flush_interval + 5)
+        self._safe_flush(self.flush)
+
+    def stats(self):
+        """发件箱统计信息"""
+        pending, oldest, max_attempts = self._connection().execute(
+            'SELECT COUNT(*), MIN(created_at), MAX(attempts) FROM outbox'
+        ).fetchone()
+        return {
+            'pending': pending,
+            'oldest_age': round(time.time() - oldest, 1) if oldest else 0,
+            'max_attempts': max_attempts or 0,
+            'sent': self.sent,
+            'failed_flushes': self.failed_flushes,
+            'unsettled': self.unsettled
+        }
+
+
+# 发件箱文件需要位于持久化磁盘上（默认的 backend/instance 在Render上重新部署时会被清空）
+ledger_outbox = LedgerOutbox(
+    path=os.getenv('LEDGER_OUTBOX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                      'instance', 'ledger_outbox.db')),
+    flush_interval=float(os.getenv('LEDGER_OUTBOX_FLUSH_SECONDS', 2)),
+    batch_size=int(os.getenv('LEDGER_OUTBOX_BATCH_SIZE', 200))
+)
+
+# 进程退出时提交剩余的结算操作
+atexit.register(ledger_outbox.stop)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+积分余额快照的后台任务
+按固定间隔为有新流水的用户写入余额快照，使余额计算和对账只需扫描快照之后的流水；
+多个worker同时运行时由数据库中的咨询锁保证同一时刻只有一个执行
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class LedgerSnapshotJob:
+    """定期写入积分余额快照"""
+
+    def __init__(self, interval: float = 3600.0, settle_seconds: int = 300):
+        self.interval = interval
+        self.settle_seconds = settle_seconds
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.snapshots = 0
+        self.failed_runs = 0
+
+    def run_once(self) -> int:
+        """写入一轮快照，返回写入数量"""
+        from repository import repository
+        try:
+            written = repository.write_snapshots(self.settle_seconds)
+        except Exception as e:
+            logger.error(f"写入积分余额快照失败: {e}")
+            self.failed_runs += 1
+            return 0
+
+        self.runs += 1
+        self.snapshots += written
+        return written
+
+    def start(self) -> None:
+        """启动后台线程（interval为0时不启动）；首次执行在一个间隔之后"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='ledger-snapshots', daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.run_once()
+
+    def stop(self) -> None:
+        """停止后台线程"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        """任务统计信息"""
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'snapshots': self.snapshots,
+            'failed_runs': self.failed_runs
+        }
+
+
+ledger_snapshot_job = LedgerSnapshotJob(
+    interval=float(os.getenv('LEDGER_SNAPSHOT_SECONDS', 3600)),
+    settle_seconds=int(os.getenv('LEDGER_SNAPSHOT_SETTLE_SECONDS', 300))
+)
@@ -6,7 +6,7 @@
 """
 from datetime import datetime, timedelta
 from flask_sqlalchemy import SQLAlchemy
-import bcrypt
+import passwords
 import secrets
 import string
 import uuid
@@ -23,8 +23,11 @@ class User(db.Model):
     password_hash = db.Column(db.String(128), nullable=False)
     credits = db.Column(db.Integer, default=0, nullable=False)  # 积分余额
     is_active = db.Column(db.Boolean, default=True, nullable=False)
+    token_version = db.Column(db.Integer, default=0, nullable=False)  # 令牌版本，递增后旧令牌失效
+    held_credits = db.Column(db.Integer, default=0, nullable=False)  # 已预留未结算的积分
     created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
     last_login = db.Column(db.DateTime)
+    tokens_revoked_at = db.Column(db.DateTime)  # 最近一次递增令牌版本或禁用的时间
     
     # 关联关系
     credit_transactions = db.relationship('CreditTransaction', backref='user', lazy=True)
@@ -32,15 +35,11 @@ class User(db.Model):
     
     def set_password(self, password):
         """设置密码（加密存储）"""
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        self.password_hash = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
+        self.password_hash = passwords.hash_password(password)
     
     def check_password(self, password):
         """验证密码"""
-        password_bytes = password.encode('utf-8')
-        hash_bytes = self.password_hash.encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hash_bytes)
+        return passwords.check_password(password, self.password_hash)
     
     def add_credits(self, amount, description="积分充值"):
         """增加积分"""
@@ -185,11 +184,16 @@ class CreditTransaction(db.Model):
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    transaction_type = db.Column(db.String(20), nullable=False)  # 'recharge' 或 'consume'
+    transaction_type = db.Column(db.String(20), nullable=False)  # 'recharge'、'consume'、'generation'（生成创作）或 'signup'
     credits_amount = db.Column(db.Integer, nullable=False)  # 正数为充值，负数为消费
     description = db.Column(db.String(200), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
     
+    # 游标分页 (created_at DESC, id) 使用的复合索引
+    __table_args__ = (
+        db.Index('idx_credit_transactions_user_created', 'user_id', created_at.desc(), 'id'),
+    )
+    
     def to_dict(self):
         """转换为字典格式"""
         return {
@@ -201,6 +205,71 @@ class CreditTransaction(db.Model):
             'created_at': self.created_at.isoformat() if self.created_at else None
         }
 
+class CreditBalanceSnapshot(db.Model):
+    """积分余额快照表（余额 = 最近一次快照 + 之后的流水）"""
+    __tablename__ = 'credit_balance_snapshots'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+    last_transaction_id = db.Column(db.Integer, nullable=False)  # 快照已包含的最后一条流水ID
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    
+    __table_args__ = (
+        db.Index('idx_credit_snapshots_user', 'user_id', last_transaction_id.desc()),
+    )
+
+class CreditTransactionArchive(db.Model):
+    """积分流水归档文件清单（已归档的流水从 credit_transactions 删除，见 ledger_archive.py）"""
+    __tablename__ = 'credit_transaction_archives'
+
+    id = db.Column(db.Integer, primary_key=True)
+    partition_date = db.Column(db.Date, nullable=False, index=True)  # 文件中流水的日期
+    path = db.Column(db.String(255), unique=True, nullable=False)  # 相对于归档目录的路径
+    first_transaction_id = db.Column(db.Integer, nullable=False)
+    last_transaction_id = db.Column(db.Integer, nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    user_ids = db.Column(db.JSON, nullable=False)  # 文件中出现的用户ID
+    generations = db.Column(db.Integer, default=0, nullable=False)
+    credits_consumed = db.Column(db.BigInteger, default=0, nullable=False)
+    bytes = db.Column(db.BigInteger, nullable=False)
+    sha256 = db.Column(db.String(64), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+class CreditHold(db.Model):
+    """积分预留表（生成前预留，成功后结算，失败时释放）"""
+    __tablename__ = 'credit_holds'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(10), default='held', nullable=False)  # held/captured/released/expired
+    description = db.Column(db.String(200), nullable=False)
+    transaction_type = db.Column(db.String(20), default='consume', nullable=False)  # 结算时写入流水的类型
+    created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    settled_at = db.Column(db.DateTime)
+
+class AppStat(db.Model):
+    """统计计数表（由数据库触发器增量维护，按连接分片，读取时按名称汇总）"""
+    __tablename__ = 'app_stats'
+    
+    name = db.Column(db.String(40), primary_key=True)
+    shard = db.Column(db.SmallInteger, primary_key=True)
+    value = db.Column(db.BigInteger, default=0, nullable=False)
+
+class DailyUsage(db.Model):
+    """每日用量汇总表（由数据库触发器增量维护）"""
+    __tablename__ = 'daily_usage'
+    
+    day = db.Column(db.Date, primary_key=True)
+    shard = db.Column(db.SmallInteger, primary_key=True)
+    generations = db.Column(db.Integer, default=0, nullable=False)
+    credits_consumed = db.Column(db.BigInteger, default=0, nullable=False)
+    redemptions = db.Column(db.Integer, default=0, nullable=False)
+    credits_redeemed = db.Column(db.BigInteger, default=0, nullable=False)
+    signups = db.Column(db.Integer, default=0, nullable=False)
+
 class Setting(db.Model):
     """系统设置表"""
     __tablename__ = 'settings'
@@ -211,9 +280,7 @@ class Setting(db.Model):
     @staticmethod
     def set_password(password_key, password):
         """设置密码（加密存储）"""
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
+        hashed_password = passwords.hash_password(password)
         
         setting = Setting.query.get(password_key)
         if setting:
@@ -230,6 +297,4 @@ class Setting(db.Model):
         if not setting:
             return False
             
-        password_bytes = password.encode('utf-8')
-        hash_bytes = setting.value.encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hash_bytes)
+        return passwords.check_password(password, setting.value)
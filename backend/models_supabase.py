@@ -5,34 +5,61 @@ Supabase REST API模型扩展
 为现有模型添加Supabase REST API操作方法
 """
 
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, List
-import bcrypt
+from datetime import date, datetime, timedelta
+from typing import Optional, Dict, Any, Iterator, List
 import uuid
-from supabase_client import get_supabase_manager
+import passwords
+from supabase_client import (get_supabase_manager, DuplicateKeyError, raise_for_duplicate, returning,
+                             USER_COLUMNS, CREDENTIAL_COLUMNS, REDEMPTION_CODE_COLUMNS)
+from postgrest.exceptions import APIError
+from cache import user_cache, setting_cache
+from pagination import encode_cursor, decode_cursor
 
 class UserSupabase:
     """用户模型的Supabase扩展"""
     
+    @staticmethod
+    def get_by_id(user_id: int, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        """根据ID获取用户（优先读取缓存，fresh=True时强制从数据库读取）"""
+        if not fresh:
+            cached = user_cache.get(user_id)
+            if cached is not None:
+                return cached
+        
+        manager = get_supabase_manager()
+        result = manager.client.table('users').select(USER_COLUMNS).eq('id', user_id).execute()
+        if not result.data:
+            user_cache.delete(user_id)
+            return None
+        
+        user_data = result.data[0]
+        user_cache.set(user_id, user_data)
+        return user_data
+    
+    @staticmethod
+    def get_credentials(user_id: int) -> Optional[Dict[str, Any]]:
+        """根据ID获取用户及密码哈希（修改密码时验证，不经过缓存）"""
+        manager = get_supabase_manager()
+        result = manager.client.table('users').select(CREDENTIAL_COLUMNS).eq('id', user_id).execute()
+        return result.data[0] if result.data else None
+    
     @staticmethod
     def get_by_username(username: str) -> Optional[Dict[str, Any]]:
-        """根据用户名获取用户"""
+        """根据用户名获取用户及密码哈希（登录验证）"""
         manager = get_supabase_manager()
-        return manager.get_user_by_username(username)
+        return manager.get_user_by_username(username, CREDENTIAL_COLUMNS)
     
     @staticmethod
     def get_by_email(email: str) -> Optional[Dict[str, Any]]:
-        """根据邮箱获取用户"""
+        """根据邮箱获取用户及密码哈希（登录验证）"""
         manager = get_supabase_manager()
-        return manager.get_user_by_email(email)
+        return manager.get_user_by_email(email, CREDENTIAL_COLUMNS)
     
     @staticmethod
     def create(username: str, email: str, password: str, credits: int = 10) -> Optional[Dict[str, Any]]:
         """创建新用户"""
         # 加密密码
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        password_hash = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
+        password_hash = passwords.hash_password(password)
         
         user_data = {
             'username': username,
@@ -47,133 +74,359 @@ class UserSupabase:
         return manager.create_user(user_data)
     
     @staticmethod
-    def check_password(user_data: Dict[str, Any], password: str) -> bool:
-        """验证密码"""
-        if not user_data or 'password_hash' not in user_data:
-            return False
+    def bulk_create(users: List[Dict[str, Any]], batch_size: int = 500) -> Dict[str, Any]:
+        """批量创建用户（用于班级账号导入）
+
+        密码在哈希线程池中并行加密，按批次插入；用户名已存在的行被跳过，
+        批次中出现邮箱冲突时二分拆批定位冲突行
+        返回 {'created': [...], 'skipped': [用户名, ...]}
+        """
+        password_hashes = passwords.hash_passwords(u['password'] for u in users)
+        now = datetime.now().isoformat()
+        rows = [{
+            'username': u['username'],
+            'email': u['email'],
+            'password_hash': password_hash,
+            'credits': u.get('credits', 10),
+            'is_active': True,
+            'created_at': now
+        } for u, password_hash in zip(users, password_hashes)]
+        
+        created = []
+        for start in range(0, len(rows), batch_size):
+            created.extend(UserSupabase._insert_batch(rows[start:start + batch_size]))
         
-        password_bytes = password.encode('utf-8')
-        hash_bytes = user_data['password_hash'].encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hash_bytes)
+        created_names = {row['username'] for row in created}
+        skipped = [row['username'] for row in rows if row['username'] not in created_names]
+        return {'created': created, 'skipped': skipped}
+    
+    @staticmethod
+    def _insert_batch(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """插入一批用户，返回实际插入的行（只返回ID和用户名）"""
+        manager = get_supabase_manager()
+        try:
+            result = returning(
+                manager.client.table('users').upsert(rows, on_conflict='username', ignore_duplicates=True),
+                'id, username'
+            ).execute()
+            return result.data
+        except APIError as e:
+            try:
+                raise_for_duplicate(e)
+            except DuplicateKeyError:
+                if len(rows) == 1:
+                    return []
+                middle = len(rows) // 2
+                return UserSupabase._insert_batch(rows[:middle]) + UserSupabase._insert_batch(rows[middle:])
+            raise
+    
+    @staticmethod
+    def set_password(user_id: int, password: str, token_version: Optional[int] = None) -> bool:
+        """修改密码（加密存储），可同时更新令牌版本以吊销旧令牌"""
+        password_hash = passwords.hash_password(password)
+        
+        update_data = {'password_hash': password_hash}
+        if token_version is not None:
+            update_data['token_version'] = token_version
+            update_data['tokens_revoked_at'] = datetime.now().isoformat()
+        
+        manager = get_supabase_manager()
+        success = manager.update_user(user_id, update_data)
+        user_cache.delete(user_id)
+        return success
     
     @staticmethod
     def update_last_login(user_id: int) -> bool:
-        """更新最后登录时间"""
+        """更新最后登录时间（写入缓冲区，由后台线程批量写库）"""
+        from last_login_writer import last_login_writer
+        last_login = datetime.now().isoformat()
+        last_login_writer.record(user_id, last_login)
+        user_cache.update(user_id, {'last_login': last_login})
+        return True
+    
+    @staticmethod
+    def batch_update_last_login(updates: List[Dict[str, Any]]) -> int:
+        """批量更新最后登录时间（一次RPC），updates: [{'id': ..., 'last_login': ...}]"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('batch_update_last_login', {'updates': updates}).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def adjust_credits(user_id: int, amount: int, transaction_type: str, description: str) -> Optional[int]:
+        """原子调整积分：一次RPC内条件更新余额并写入交易记录
+
+        返回新余额；用户不存在或余额不足时返回None
+        """
         manager = get_supabase_manager()
-        return manager.update_user(user_id, {
-            'last_login': datetime.now().isoformat()
-        })
+        result = manager.client.rpc('adjust_credits', {
+            'p_user_id': user_id,
+            'p_amount': amount,
+            'p_transaction_type': transaction_type,
+            'p_description': description
+        }).execute()
+        
+        new_credits = result.data
+        if new_credits is None:
+            return None
+        
+        user_cache.update(user_id, {'credits': new_credits})
+        return new_credits
     
+    @staticmethod
+    def bulk_adjust_credits(user_ids: List[int], amount: int, transaction_type: str, description: str,
+                            username_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+        """批量调整积分：一次RPC、一个事务内完成全部用户的余额更新和流水写入
+
+        目标为user_ids与username_prefix前缀匹配的活跃用户的并集；扣减时余额不足的用户跳过
+        返回 [{'user_id': ..., 'status': 'applied'/'insufficient'/'not_found', 'credits': 新余额或None}]
+        """
+        manager = get_supabase_manager()
+        result = manager.client.rpc('bulk_adjust_credits', {
+            'p_user_ids': user_ids,
+            'p_username_prefix': username_prefix or None,
+            'p_amount': amount,
+            'p_transaction_type': transaction_type,
+            'p_description': description
+        }).execute()
+
+        results = result.data or []
+        for row in results:
+            if row['status'] == 'applied':
+                user_cache.update(row['user_id'], {'credits': row['credits']})
+        return results
+
     @staticmethod
     def add_credits(user_id: int, amount: int, description: str = "积分充值") -> bool:
         """增加积分"""
         if amount <= 0:
             return False
         
-        manager = get_supabase_manager()
-        
-        # 获取当前用户
-        users = manager.client.table('users').select('credits').eq('id', user_id).execute()
-        if not users.data:
-            return False
-        
-        current_credits = users.data[0]['credits']
-        new_credits = current_credits + amount
-        
-        # 更新积分
-        success = manager.update_user(user_id, {'credits': new_credits})
-        
-        if success:
-            # 记录交易
-            CreditTransactionSupabase.create(
-                user_id=user_id,
-                transaction_type='recharge',
-                credits_amount=amount,
-                description=description
-            )
-        
-        return success
+        return UserSupabase.adjust_credits(user_id, amount, 'recharge', description) is not None
     
     @staticmethod
     def consume_credits(user_id: int, amount: int, description: str = "使用服务") -> bool:
-        """消费积分"""
+        """消费积分（余额不足时返回False）"""
         if amount <= 0:
             return False
         
-        manager = get_supabase_manager()
-        
-        # 获取当前用户
-        users = manager.client.table('users').select('credits').eq('id', user_id).execute()
-        if not users.data:
-            return False
-        
-        current_credits = users.data[0]['credits']
-        if current_credits < amount:
-            return False  # 积分不足
-        
-        new_credits = current_credits - amount
-        
-        # 更新积分
-        success = manager.update_user(user_id, {'credits': new_credits})
-        
-        if success:
-            # 记录交易
-            CreditTransactionSupabase.create(
-                user_id=user_id,
-                transaction_type='consume',
-                credits_amount=-amount,
-                description=description
-            )
-        
-        return success
+        return UserSupabase.adjust_credits(user_id, -amount, 'consume', description) is not None
     
     @staticmethod
     def get_all() -> List[Dict[str, Any]]:
         """获取所有用户"""
         manager = get_supabase_manager()
         return manager.get_all_users()
+    
+    @staticmethod
+    def count() -> int:
+        """用户数量（估算值，不读取用户数据）"""
+        manager = get_supabase_manager()
+        result = manager.client.table('users').select('id', count='estimated', head=True).execute()
+        return result.count or 0
+
+    # 管理后台用户列表只需要的列（不读取password_hash等字段）
+    LIST_COLUMNS = 'id, username, email, credits, is_active, created_at, last_login'
+    # 可排序的列 -> 是否可能为NULL；每个排序都有 (列 DESC, id DESC) 索引
+    SORT_COLUMNS = {'created_at': False, 'credits': False, 'last_login': True}
+
+    @staticmethod
+    def _search_filter(search: str) -> Optional[str]:
+        """用户名/邮箱搜索条件（PostgREST or语法）
+
+        3个字符以上按子串匹配，更短的按前缀匹配；两种ilike都可走pg_trgm的GIN索引，
+        前缀模式会带上词首的填充三元组，短关键词也不会扫描整个索引
+        """
+        # 去掉PostgREST逻辑语法和通配符中的特殊字符
+        term = ''.join(ch for ch in search.strip() if ch not in ',()"\\*%')
+        if not term:
+            return None
+        pattern = f'*{term}*' if len(term) >= 3 else f'{term}*'
+        return f'username.ilike.{pattern},email.ilike.{pattern}'
+
+    @staticmethod
+    def _cursor_filter(sort: str, descending: bool, sort_value: Any, last_id: int) -> str:
+        """游标之后的行（排序值相同时按id继续；可为NULL的列NULL值排在最后）
+
+        sort_value / last_id 是 decode_cursor 校验过类型的值（datetime/int），按类型格式化后拼接
+        """
+        op = 'lt' if descending else 'gt'
+        if sort_value is None:
+            return f'and({sort}.is.null,id.{op}.{last_id})'
+        if isinstance(sort_value, datetime):
+            sort_value = sort_value.isoformat()
+        conditions = [f'{sort}.{op}.{sort_value}', f'and({sort}.eq.{sort_value},id.{op}.{last_id})']
+        if UserSupabase.SORT_COLUMNS[sort]:
+            conditions.append(f'{sort}.is.null')
+        return ','.join(conditions)
+
+    @staticmethod
+    def get_page(limit: int = 20, cursor: Optional[str] = None, sort: str = 'created_at',
+                 descending: bool = True, search: Optional[str] = None,
+                 with_total: bool = False) -> Dict[str, Any]:
+        """按 (排序列, id) 游标分页获取用户列表（管理后台使用）
+
+        sort 可选 created_at / credits / last_login；search 匹配用户名或邮箱。
+        每页只读取 limit+1 行，with_total=True时附带估算的总数（count=estimated）
+        返回 {'items': [...], 'next_cursor': str或None, 'total': int或None}
+        """
+        if sort not in UserSupabase.SORT_COLUMNS:
+            raise ValueError(f"不支持的排序字段: {sort}")
+
+        manager = get_supabase_manager()
+        query = manager.client.table('users')\
+            .select(UserSupabase.LIST_COLUMNS, count='estimated' if with_total else None)
+
+        conditions = []
+        search_filter = UserSupabase._search_filter(search) if search else None
+        if search_filter:
+            conditions.append(search_filter)
+        position = decode_cursor(cursor, 'int' if sort == 'credits' else 'datetime',
+                                 nullable=UserSupabase.SORT_COLUMNS[sort])
+        if position:
+            conditions.append(UserSupabase._cursor_filter(sort, descending, *position))
+        # 搜索和游标条件各是一组or，同时存在时用and组合成一个参数
+        if len(conditions) == 1:
+            query = query.or_(conditions[0])
+        elif conditions:
+            query = query.or_(f'and({",".join(f"or({c})" for c in conditions)})')
+
+        result = query.order(sort, desc=descending, nullsfirst=False)\
+            .order('id', desc=descending).limit(limit + 1).execute()
+        items = result.data[:limit]
+        next_cursor = None
+        if len(result.data) > limit:
+            next_cursor = encode_cursor(items[-1][sort], items[-1]['id'])
+
+        return {
+            'items': items,
+            'next_cursor': next_cursor,
+            'total': result.count if with_total else None
+        }
+
+    @staticmethod
+    def get_detail(user_id: int, transactions_limit: int = 50, codes_limit: int = 20) -> Optional[Dict[str, Any]]:
+        """管理后台用户详情：一次查询同时取回用户、第一页交易记录和第一页已使用的兑换码
+
+        交易记录和兑换码通过PostgREST资源嵌入（外键关联）读取，排序与各自的游标分页一致，
+        返回的 next_cursor 可直接用于 CreditTransactionSupabase.get_page /
+        RedemptionCodeSupabase.get_used_page 翻页；用户不存在时返回None
+        """
+        manager = get_supabase_manager()
+        result = manager.client.table('users')\
+            .select(f'{UserSupabase.LIST_COLUMNS}, '
+                    f'credit_transactions({CreditTransactionSupabase.PAGE_COLUMNS}), '
+                    f'redemption_codes({RedemptionCodeSupabase.USED_COLUMNS})')\
+            .eq('id', user_id)\
+            .order('created_at', desc=True, foreign_table='credit_transactions')\
+            .order('id', foreign_table='credit_transactions')\
+            .limit(transactions_limit + 1, foreign_table='credit_transactions')\
+            .order('used_at', desc=True, foreign_table='redemption_codes')\
+            .order('id', desc=True, foreign_table='redemption_codes')\
+            .limit(codes_limit + 1, foreign_table='redemption_codes')\
+            .execute()
+        if not result.data:
+            return None
+
+        user_data = result.data[0]
+        transactions = user_data.pop('credit_transactions') or []
+        used_codes = user_data.pop('redemption_codes') or []
+        user_data['transactions'] = transactions[:transactions_limit]
+        user_data['transactions_next_cursor'] = None
+        if len(transactions) > transactions_limit:
+            last = transactions[transactions_limit - 1]
+            user_data['transactions_next_cursor'] = encode_cursor(last['created_at'], last['id'])
+        user_data['used_codes'] = used_codes[:codes_limit]
+        user_data['used_codes_next_cursor'] = None
+        if len(used_codes) > codes_limit:
+            last = used_codes[codes_limit - 1]
+            user_data['used_codes_next_cursor'] = encode_cursor(last['used_at'], last['id'])
+        return user_data
+
+class CreditHoldSupabase:
+    """积分预留的Supabase扩展
+
+    调用上游生成服务前预留积分，成功后结算、失败时释放，每一步都是一次RPC，
+    不在网络请求期间保持数据库事务；未结算的预留超时后自动失效
+    """
+    
+    @staticmethod
+    def place(user_id: int, amount: int, description: str, ttl_seconds: int,
+              transaction_type: str = 'consume') -> Optional[Dict[str, Any]]:
+        """预留积分，返回 {'hold_id', 'credits', 'held_credits'}；可用余额（credits - held_credits）不足时hold_id为None"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('hold_credits', {
+            'p_user_id': user_id,
+            'p_amount': amount,
+            'p_description': description,
+            'p_ttl_seconds': ttl_seconds,
+            'p_transaction_type': transaction_type
+        }).execute()
+        return result.data
+    
+    @staticmethod
+    def release(hold_id: int) -> bool:
+        """释放预留"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('release_credit_hold', {'p_hold_id': hold_id}).execute()
+        return bool(result.data)
+    
+    @staticmethod
+    def capture_many(hold_ids: List[int]) -> int:
+        """批量结算预留（一次RPC），返回结算数量；已过期但未结算的预留在可用余额足够时同样结算"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('capture_credit_holds', {'p_hold_ids': hold_ids}).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def release_many(hold_ids: List[int]) -> int:
+        """批量释放预留（一次RPC），返回释放数量"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('release_credit_holds', {'p_hold_ids': hold_ids}).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def expire_stale() -> int:
+        """释放所有已过期的预留，返回释放数量"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('expire_credit_holds', {}).execute()
+        return result.data or 0
 
 class SettingSupabase:
     """设置模型的Supabase扩展"""
     
     @staticmethod
     def get(key: str) -> Optional[str]:
-        """获取设置值"""
+        """获取设置值（带缓存）"""
+        cached = setting_cache.get(key)
+        if cached is not None:
+            return cached
+        
         manager = get_supabase_manager()
-        return manager.get_setting(key)
+        value = manager.get_setting(key)
+        if value is not None:
+            setting_cache.set(key, value)
+        return value
     
     @staticmethod
     def set(key: str, value: str) -> bool:
         """设置值"""
         manager = get_supabase_manager()
-        return manager.set_setting(key, value)
+        success = manager.set_setting(key, value)
+        setting_cache.delete(key)
+        return success
     
     @staticmethod
     def set_password(password_key: str, password: str) -> bool:
         """设置密码（加密存储）"""
-        password_bytes = password.encode('utf-8')
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password_bytes, salt).decode('utf-8')
-        
-        manager = get_supabase_manager()
-        return manager.set_setting(password_key, hashed_password)
+        hashed_password = passwords.hash_password(password)
+        return SettingSupabase.set(password_key, hashed_password)
     
-    @staticmethod
-    def check_password(password_key: str, password: str) -> bool:
-        """验证密码"""
-        manager = get_supabase_manager()
-        hashed_password = manager.get_setting(password_key)
-        
-        if not hashed_password:
-            return False
-        
-        password_bytes = password.encode('utf-8')
-        hash_bytes = hashed_password.encode('utf-8')
-        return bcrypt.checkpw(password_bytes, hash_bytes)
-
 class RedemptionCodeSupabase:
     """兑换码模型的Supabase扩展"""
     
+    # 批量生成时写入后返回的列（导出CSV所需）
+    MINTED_COLUMNS = 'id, code, credits_value, expires_at, description'
+    
     @staticmethod
     def generate_code(length: int = 16) -> str:
         """生成随机兑换码"""
@@ -189,7 +442,7 @@ class RedemptionCodeSupabase:
         
         # 生成唯一兑换码
         code = RedemptionCodeSupabase.generate_code()
-        while manager.get_redemption_code(code):
+        while manager.get_redemption_code(code, 'id'):
             code = RedemptionCodeSupabase.generate_code()
         
         expires_at = None
@@ -207,6 +460,61 @@ class RedemptionCodeSupabase:
         
         return manager.create_redemption_code(code_data)
     
+    @staticmethod
+    def bulk_create(count: int, credits_value: int, description: str = None, expires_days: int = None,
+                    batch_size: int = 1000, max_rounds: int = 5) -> Iterator[List[Dict[str, Any]]]:
+        """批量生成兑换码，按批次返回已插入的兑换码（生成器，可边生成边导出）
+
+        候选码在内存中生成并用集合去重，每批一次upsert（ON CONFLICT DO NOTHING），
+        与已有兑换码冲突而未插入的部分重新生成后补齐，不逐个查询是否存在
+        """
+        manager = get_supabase_manager()
+        now = datetime.now()
+        expires_at = (now + timedelta(days=expires_days)).isoformat() if expires_days else None
+        seen = set()
+        
+        def new_codes(n):
+            codes = []
+            while len(codes) < n:
+                code = RedemptionCodeSupabase.generate_code()
+                if code not in seen:
+                    seen.add(code)
+                    codes.append(code)
+            return codes
+        
+        minted = []
+        try:
+            remaining = count
+            while remaining > 0:
+                wanted = min(batch_size, remaining)
+                inserted = []
+                for _ in range(max_rounds):
+                    rows = [{
+                        'code': code,
+                        'credits_value': credits_value,
+                        'description': description,
+                        'expires_at': expires_at,
+                        'is_used': False,
+                        'created_at': now.isoformat()
+                    } for code in new_codes(wanted - len(inserted))]
+                    result = returning(
+                        manager.client.table('redemption_codes').upsert(rows, on_conflict='code', ignore_duplicates=True),
+                        RedemptionCodeSupabase.MINTED_COLUMNS
+                    ).execute()
+                    inserted.extend(result.data)
+                    if len(inserted) >= wanted:
+                        break
+                else:
+                    raise RuntimeError(f"兑换码冲突过多，已生成 {len(minted) + len(inserted)} 个")
+                
+                remaining -= len(inserted)
+                minted.extend(row['code'] for row in inserted)
+                yield inserted
+        finally:
+            # 通知兑换码过滤器（生成中断时已插入的码同样需要加入）
+            from code_filter import code_filter
+            code_filter.added(minted)
+    
     @staticmethod
     def get_by_code(code: str) -> Optional[Dict[str, Any]]:
         """根据兑换码获取信息"""
@@ -228,47 +536,95 @@ class RedemptionCodeSupabase:
         return True, "兑换码有效"
     
     @staticmethod
-    def redeem(code: str, user_id: int) -> tuple[bool, str]:
-        """兑换积分"""
+    def redeem(code: str, user_id: int) -> Dict[str, Any]:
+        """兑换积分（一次RPC内条件标记兑换码并增加积分、写入流水）
+
+        返回 {'status': 'redeemed', 'credits_added': ..., 'credits': 新余额}，
+        失败时status为 not_found / used / expired
+        """
         manager = get_supabase_manager()
-        
-        # 获取兑换码
-        code_data = manager.get_redemption_code(code)
-        if not code_data:
-            return False, "兑换码不存在"
-        
-        # 检查有效性
-        is_valid, message = RedemptionCodeSupabase.is_valid(code_data)
-        if not is_valid:
-            return False, message
-        
-        # 标记为已使用
-        update_data = {
-            'is_used': True,
-            'used_by_user_id': user_id,
-            'used_at': datetime.now().isoformat()
-        }
-        
-        success = manager.update_redemption_code(code, update_data)
-        if not success:
-            return False, "兑换失败"
-        
-        # 给用户增加积分
-        description = f"兑换码充值: {code}"
-        if code_data.get('description'):
-            description += f" ({code_data['description']})"
-        
-        credits_added = UserSupabase.add_credits(
-            user_id, 
-            code_data['credits_value'], 
-            description
-        )
-        
-        if credits_added:
-            return True, f"成功兑换{code_data['credits_value']}积分"
-        else:
-            return False, "积分充值失败"
+        result = manager.client.rpc('redeem_code', {'p_code': code, 'p_user_id': user_id}).execute()
+        outcome = result.data
+        if outcome.get('status') == 'redeemed':
+            user_cache.update(user_id, {'credits': outcome['credits']})
+        return outcome
     
+    @staticmethod
+    def iter_codes(page_size: int = 1000) -> Iterator[str]:
+        """按ID游标分页遍历全部兑换码（用于重建兑换码过滤器）"""
+        manager = get_supabase_manager()
+        last_id = 0
+        while True:
+            result = manager.client.table('redemption_codes')\
+                .select('id, code')\
+                .gt('id', last_id)\
+                .order('id')\
+                .limit(page_size)\
+                .execute()
+            for row in result.data:
+                yield row['code']
+            if len(result.data) < page_size:
+                return
+            last_id = result.data[-1]['id']
+
+    @staticmethod
+    def max_id() -> int:
+        """最大的兑换码ID（没有兑换码时为0）"""
+        manager = get_supabase_manager()
+        result = manager.client.table('redemption_codes')\
+            .select('id')\
+            .order('id', desc=True)\
+            .limit(1)\
+            .execute()
+        return result.data[0]['id'] if result.data else 0
+
+    @staticmethod
+    def get_page(limit: int = 20, cursor: Optional[str] = None, with_total: bool = False) -> Dict[str, Any]:
+        """按ID倒序（即创建顺序倒序，走主键索引）游标分页获取兑换码（管理后台列表）
+
+        每页只读取 limit+1 行，with_total=True时附带估算的总数（count=estimated）
+        返回 {'items': [...], 'next_cursor': str或None, 'total': int或None}
+        """
+        manager = get_supabase_manager()
+        query = manager.client.table('redemption_codes')\
+            .select(REDEMPTION_CODE_COLUMNS, count='estimated' if with_total else None)
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            query = query.lt('id', position[1])
+
+        result = query.order('id', desc=True).limit(limit + 1).execute()
+        items = result.data[:limit]
+        next_cursor = None
+        if len(result.data) > limit:
+            next_cursor = encode_cursor(items[-1]['created_at'], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor, 'total': result.count if with_total else None}
+
+    # 用户详情中已使用兑换码的列
+    USED_COLUMNS = 'id, code, credits_value, used_at, description'
+
+    @staticmethod
+    def get_used_page(user_id: int, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """按 (used_at DESC, id DESC) 游标分页获取用户使用过的兑换码
+        返回 {'items': [...], 'next_cursor': str或None}
+        """
+        manager = get_supabase_manager()
+        query = manager.client.table('redemption_codes')\
+            .select(RedemptionCodeSupabase.USED_COLUMNS)\
+            .eq('used_by_user_id', user_id)
+
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            used_at, last_id = position
+            used_at = used_at.isoformat()
+            query = query.or_(f'used_at.lt.{used_at},and(used_at.eq.{used_at},id.lt.{last_id})')
+
+        result = query.order('used_at', desc=True).order('id', desc=True).limit(limit + 1).execute()
+        items = result.data[:limit]
+        next_cursor = None
+        if len(result.data) > limit:
+            next_cursor = encode_cursor(items[-1]['used_at'], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor}
+
     @staticmethod
     def get_all() -> List[Dict[str, Any]]:
         """获取所有兑换码"""
@@ -276,36 +632,181 @@ class RedemptionCodeSupabase:
         return manager.get_all_redemption_codes()
 
 class CreditTransactionSupabase:
-    """积分交易记录的Supabase扩展"""
+    """积分交易记录的Supabase扩展
+
+    流水只通过 UserSupabase.adjust_credits（adjust_credits RPC）与余额在同一条语句中写入，
+    余额 = 最近一次快照 + 之后的流水，这里不提供单独插入流水的方法
+    """
+    
+    # 分页查询的列，均包含在 idx_credit_transactions_user_created 覆盖索引中
+    PAGE_COLUMNS = 'id, user_id, transaction_type, credits_amount, description, created_at'
     
     @staticmethod
-    def create(user_id: int, transaction_type: str, credits_amount: int, description: str) -> Optional[Dict[str, Any]]:
-        """创建交易记录"""
+    def get_page(user_id: int, limit: int = 20, cursor: Optional[str] = None,
+                 with_total: bool = False) -> Dict[str, Any]:
+        """按 (created_at DESC, id) 游标分页获取用户的交易记录
+
+        每页只读取 limit+1 行，不使用OFFSET；with_total=True时附带估算的总数
+        （count=estimated，大表时取自查询计划，不执行COUNT(*)）
+        返回 {'items': [...], 'next_cursor': str或None, 'total': int或None}
+        """
         manager = get_supabase_manager()
-        
-        transaction_data = {
-            'user_id': user_id,
-            'transaction_type': transaction_type,
-            'credits_amount': credits_amount,
-            'description': description,
-            'created_at': datetime.now().isoformat()
+        query = manager.client.table('credit_transactions')\
+            .select(CreditTransactionSupabase.PAGE_COLUMNS, count='estimated' if with_total else None)\
+            .eq('user_id', user_id)
+        
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            created_at, last_id = position
+            created_at = created_at.isoformat()
+            query = query.or_(f'created_at.lt.{created_at},and(created_at.eq.{created_at},id.gt.{last_id})')
+        
+        result = query.order('created_at', desc=True).order('id').limit(limit + 1).execute()
+        items = result.data[:limit]
+        next_cursor = None
+        if len(result.data) > limit:
+            next_cursor = encode_cursor(items[-1]['created_at'], items[-1]['id'])
+        
+        return {
+            'items': items,
+            'next_cursor': next_cursor,
+            'total': result.count if with_total else None
         }
-        
-        try:
-            result = manager.client.table('credit_transactions').insert(transaction_data).execute()
-            return result.data[0] if result.data else None
-        except Exception as e:
-            print(f"创建交易记录失败: {e}")
-            return None
+    
+class CreditLedgerSupabase:
+    """积分流水与余额快照的Supabase扩展
+
+    流水（credit_transactions）只追加，是余额的唯一依据；余额 = 最近一次快照 + 之后的流水，
+    快照由后台任务定期写入（见 ledger_snapshots.py）。users.credits 是与流水同步更新的投影，
+    对账时以流水为准修复
+    """
     
     @staticmethod
-    def get_by_user(user_id: int) -> List[Dict[str, Any]]:
-        """获取用户的交易记录"""
+    def balance(user_id: int) -> int:
+        """按流水计算用户余额"""
         manager = get_supabase_manager()
-        
-        try:
-            result = manager.client.table('credit_transactions').select('*').eq('user_id', user_id).order('created_at', desc=True).execute()
-            return result.data
-        except Exception as e:
-            print(f"获取交易记录失败: {e}")
-            return []
+        result = manager.client.rpc('credit_ledger_balance', {'p_user_id': user_id}).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def write_snapshots(settle_seconds: int = 300) -> int:
+        """为有新流水的用户写入快照，返回写入数量（其他worker正在执行时返回0）"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('write_credit_snapshots', {'p_settle_seconds': settle_seconds}).execute()
+        return result.data or 0
+    
+    # 归档文件清单的列
+    ARCHIVE_COLUMNS = 'partition_date, path, first_transaction_id, last_transaction_id, row_count, user_ids, ' \
+                      'generations, credits_consumed, bytes, sha256'
+    
+    @staticmethod
+    def archive_boundary(before: datetime) -> int:
+        """可归档流水的最大ID：不超过快照边界，也不超过before之前最后写入的流水
+        （按created_at索引读取；乱序提交而ID更大的少量流水留到下次归档）
+        """
+        manager = get_supabase_manager()
+        snapshot = manager.client.table('credit_balance_snapshots')\
+            .select('last_transaction_id')\
+            .order('last_transaction_id', desc=True)\
+            .limit(1)\
+            .execute().data
+        latest = manager.client.table('credit_transactions')\
+            .select('id')\
+            .lt('created_at', before.isoformat())\
+            .order('created_at', desc=True)\
+            .order('id', desc=True)\
+            .limit(1)\
+            .execute().data
+        if not snapshot or not latest:
+            return 0
+        return min(snapshot[0]['last_transaction_id'], latest[0]['id'])
+    
+    @staticmethod
+    def archivable(before: datetime, max_id: int, after_id: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+        """按ID顺序读取一页可归档的流水（after_id < id <= max_id 且 created_at < before）"""
+        manager = get_supabase_manager()
+        return manager.client.table('credit_transactions')\
+            .select(CreditTransactionSupabase.PAGE_COLUMNS)\
+            .gt('id', after_id)\
+            .lte('id', max_id)\
+            .lt('created_at', before.isoformat())\
+            .order('id')\
+            .limit(limit)\
+            .execute().data
+    
+    @staticmethod
+    def archive(first_id: int, last_id: int, before: datetime, archives: List[Dict[str, Any]]) -> int:
+        """记录归档文件并删除对应的流水，返回删除数量（数量不一致时数据库回滚并抛出异常）"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('archive_credit_transactions', {
+            'p_first_id': first_id,
+            'p_last_id': last_id,
+            'p_before': before.isoformat(),
+            'p_archives': archives
+        }).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def prune_snapshots(max_id: int) -> int:
+        """删除已被更新快照取代的旧快照，返回删除数量"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('prune_credit_snapshots', {'p_max_id': max_id}).execute()
+        return result.data or 0
+    
+    @staticmethod
+    def archives(start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """归档文件清单（按日期和首条流水ID排序），start/end为包含的日期范围"""
+        manager = get_supabase_manager()
+        query = manager.client.table('credit_transaction_archives').select(CreditLedgerSupabase.ARCHIVE_COLUMNS)
+        if start:
+            query = query.gte('partition_date', start.isoformat())
+        if end:
+            query = query.lte('partition_date', end.isoformat())
+        return query.order('partition_date').order('first_transaction_id').execute().data
+    
+    @staticmethod
+    def reconcile(check_all: bool = False, repair: bool = False) -> List[Dict[str, Any]]:
+        """对账：返回余额投影与流水不一致的用户，repair=True时以流水为准修复"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('reconcile_credit_balances', {'p_all': check_all}).execute()
+        mismatches = result.data or []
+        
+        if repair:
+            for row in mismatches:
+                row['repaired_credits'] = manager.client.rpc(
+                    'repair_credit_balance', {'p_user_id': row['user_id']}
+                ).execute().data
+                user_cache.delete(row['user_id'])
+        return mismatches
+
+class UsageStatsSupabase:
+    """统计计数与每日用量汇总的Supabase扩展
+
+    计数（app_stats）和每日汇总（daily_usage）由数据库触发器在写入时增量维护，
+    读取只汇总少量分片行，与用户数和流水数无关
+    """
+    
+    # get_app_stats 返回的计数名称，尚无数据时补0
+    COUNTERS = ('users', 'total_credits', 'codes', 'used_codes', 'transactions', 'generations')
+    
+    @staticmethod
+    def summary() -> Dict[str, int]:
+        """全部计数 {名称: 值}"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('get_app_stats', {}).execute()
+        data = result.data or {}
+        return {name: int(data.get(name) or 0) for name in UsageStatsSupabase.COUNTERS}
+    
+    @staticmethod
+    def daily(start: str, end: str) -> List[Dict[str, Any]]:
+        """[start, end] 日期范围内（YYYY-MM-DD）按天的用量，没有记录的日期不返回"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('get_daily_usage', {'p_from': start, 'p_to': end}).execute()
+        return result.data or []
+    
+    @staticmethod
+    def rebuild() -> Dict[str, int]:
+        """从基础表重新计算计数和每日汇总（会短暂阻塞写入）"""
+        manager = get_supabase_manager()
+        result = manager.client.rpc('rebuild_usage_stats', {}).execute()
+        return result.data or {}
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+游标分页工具
+按 (排序值, id) 组成的游标翻页，每页只读取 limit+1 行，
+与OFFSET分页不同，第500页与第1页的开销相同
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Any, Optional, Tuple
+
+
+class InvalidCursor(ValueError):
+    """游标格式错误"""
+    pass
+
+
+def encode_cursor(sort_value: Any, row_id: int) -> str:
+    """把最后一行的排序值和ID编码为不透明的游标字符串"""
+    raw = json.dumps([sort_value, row_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: Optional[str], value_type: Optional[str] = None,
+                  nullable: bool = False) -> Optional[Tuple[Any, int]]:
+    """解析游标，空游标返回None（第一页）
+
+    value_type 为 'datetime' 时排序值必须是ISO格式的时间（返回datetime），为 'int' 时必须是整数；
+    nullable=True 时排序值可以为None。格式或类型不符时抛出 InvalidCursor，
+    调用方只使用解析后的值拼接查询条件
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, row_id = json.loads(raw)
+        if isinstance(row_id, bool) or not isinstance(row_id, int):
+            raise TypeError("游标中的ID必须是整数")
+        if sort_value is None:
+            if value_type and not nullable:
+                raise TypeError("游标中的排序值不能为空")
+        elif value_type == 'datetime':
+            sort_value = datetime.fromisoformat(sort_value)
+        elif value_type == 'int':
+            if isinstance(sort_value, bool) or not isinstance(sort_value, int):
+                raise TypeError("游标中的排序值必须是整数")
+        return sort_value, row_id
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("无效的分页游标") from e
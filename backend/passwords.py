@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+密码哈希工具
+bcrypt计算在专用的有界线程池中执行（bcrypt计算时会释放GIL），
+限制同时进行的哈希数量和排队长度，避免登录高峰占满CPU、阻塞其他接口
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional
+
+import bcrypt
+
+# bcrypt成本因子（每加1，计算时间翻倍）
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+# 同时执行哈希的线程数
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+# 排队等待的最大任务数，超出后直接拒绝
+PASSWORD_HASH_QUEUE = int(os.getenv('PASSWORD_HASH_QUEUE', 32))
+# 单个任务（含排队）的最长等待时间（秒）
+PASSWORD_HASH_TIMEOUT = float(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+
+
+class PasswordHasherBusy(Exception):
+    """密码哈希线程池已满"""
+    pass
+
+
+class PasswordHasher:
+    """有界的bcrypt线程池"""
+
+    def __init__(self, workers: int, queue_limit: int, timeout: float):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + queue_limit)
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.rejected = 0
+
+    def run(self, fn, *args):
+        """在线程池中执行fn并等待结果，池满时抛出PasswordHasherBusy"""
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy("密码服务繁忙，请稍后重试")
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+        result = future.result(timeout=self.timeout)
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def map(self, fn, items: Iterable) -> List:
+        """批量执行（用于批量导入），按顺序返回结果
+
+        最多占用workers个槽位并在槽位不足时等待，不会因池满而失败，
+        排队槽位留给交互式的登录请求
+        """
+        results = []
+        window = []
+        for item in items:
+            self._slots.acquire()
+            future = self._executor.submit(fn, *item)
+            future.add_done_callback(lambda _: self._slots.release())
+            window.append(future)
+            if len(window) >= self.workers:
+                results.extend(f.result() for f in window)
+                window = []
+        results.extend(f.result() for f in window)
+        with self._lock:
+            self.completed += len(results)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """线程池统计信息"""
+        return {
+            'workers': self.workers,
+            'queue_limit': self.queue_limit,
+            'rounds': BCRYPT_ROUNDS,
+            'completed': self.completed,
+            'rejected': self.rejected
+        }
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS, PASSWORD_HASH_QUEUE, PASSWORD_HASH_TIMEOUT)
+
+
+def _hashpw(password: str, rounds: int) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=rounds)).decode('utf-8')
+
+
+def _checkpw(password: str, password_hash: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> str:
+    """加密密码"""
+    return password_hasher.run(_hashpw, password, rounds or BCRYPT_ROUNDS)
+
+
+def hash_passwords(password_list: Iterable[str], rounds: Optional[int] = None) -> List[str]:
+    """批量加密密码（并行执行）"""
+    rounds = rounds or BCRYPT_ROUNDS
+    return password_hasher.map(_hashpw, ((password, rounds) for password in password_list))
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """验证密码"""
+    if not password_hash:
+        return False
+    return password_hasher.run(_checkpw, password, password_hash)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """哈希的成本因子与当前配置不一致时需要重新加密（格式: $2b$12$...）"""
+    try:
+        return int(password_hash.split('$')[2]) != BCRYPT_ROUNDS
+    except (AttributeError, IndexError, ValueError):
+        return False
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+按请求统计数据库访问
+记录每个请求执行的SQL语句（SQLAlchemy游标事件，包括Flask-SQLAlchemy和repository的引擎）
+和Supabase REST请求（共享的httpx客户端）的次数、总耗时和最慢的一条：
+    - 写入 Server-Timing 响应头，浏览器开发者工具的Timing面板可直接查看
+    - 总耗时或次数超过阈值时记录日志
+    - 同一形状的语句在一个请求内重复超过阈值时告警（通常是循环中逐条查询的N+1问题）
+语句形状：SQL为参数化后的语句文本；REST为 方法 + 表/函数 + 过滤的列和操作符（不含值）
+"""
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit, parse_qsl
+
+import httpx
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+QUERY_STATS_ENABLED = os.getenv('QUERY_STATS_ENABLED', 'true').lower() == 'true'
+# 请求的数据库总耗时（毫秒）或次数超过阈值时记录日志
+QUERY_LOG_THRESHOLD_MS = float(os.getenv('QUERY_LOG_THRESHOLD_MS', 200))
+QUERY_LOG_THRESHOLD_COUNT = int(os.getenv('QUERY_LOG_THRESHOLD_COUNT', 20))
+# 同一形状的语句在一个请求内执行超过该次数时告警
+QUERY_REPEAT_THRESHOLD = int(os.getenv('QUERY_REPEAT_THRESHOLD', 5))
+
+# 只保留过滤条件的操作符，不保留值
+REST_PLAIN_PARAMS = {'select', 'order', 'limit', 'offset', 'or', 'and', 'on_conflict', 'columns'}
+# 事务控制语句随每个事务出现，计入次数和耗时，但不参与重复检测
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+
+class QueryStats:
+    """一个请求内的数据库访问统计（后台线程中并发执行的查询也计入发起请求的统计）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'sql': 0, 'rest': 0}
+        self.durations = {'sql': 0.0, 'rest': 0.0}
+        self.slowest: Optional[Dict[str, Any]] = None
+        self.shapes: Counter = Counter()
+
+    def record(self, kind: str, shape: str, duration_ms: float) -> None:
+        with self._lock:
+            self.counts[kind] += 1
+            self.durations[kind] += duration_ms
+            self.shapes[(kind, shape)] += 1
+            if self.slowest is None or duration_ms > self.slowest['duration_ms']:
+                self.slowest = {'kind': kind, 'shape': shape, 'duration_ms': duration_ms}
+
+    @property
+    def total_count(self) -> int:
+        return self.counts['sql'] + self.counts['rest']
+
+    @property
+    def total_ms(self) -> float:
+        return self.durations['sql'] + self.durations['rest']
+
+    def repeated(self, threshold: int):
+        """重复次数超过阈值的语句形状 [(类型, 形状, 次数)]"""
+        return [(kind, shape, count) for (kind, shape), count in self.shapes.most_common()
+                if count > threshold and not shape.upper().startswith(TRANSACTION_STATEMENTS)]
+
+    def server_timing(self) -> str:
+        """Server-Timing头的值，如 sql;desc="SQL x3";dur=1.2, rest;desc="REST x1";dur=85.0"""
+        parts = []
+        for kind, label in (('sql', 'SQL'), ('rest', 'REST')):
+            if self.counts[kind]:
+                parts.append(f'{kind};desc="{label} x{self.counts[kind]}";dur={self.durations[kind]:.1f}')
+        return ', '.join(parts)
+
+
+_current: contextvars.ContextVar[Optional[QueryStats]] = contextvars.ContextVar('query_stats', default=None)
+
+
+def current() -> Optional[QueryStats]:
+    """当前请求的统计（请求之外，如后台线程中，返回None）"""
+    return _current.get()
+
+
+def _record(kind: str, shape: str, duration_ms: float) -> None:
+    stats = _current.get()
+    if stats is not None:
+        stats.record(kind, shape, duration_ms)
+
+
+# --- SQLAlchemy ---
+def sql_shape(statement: str) -> str:
+    return re.sub(r'\s+', ' ', statement).strip()[:300]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_stats_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('query_stats_start')
+    if not starts:
+        return
+    duration_ms = (time.perf_counter() - starts.pop()) * 1000
+    _record('sql', sql_shape(statement), duration_ms)
+
+
+def _handle_error(context):
+    # 语句出错时没有after_cursor_execute事件，丢弃对应的开始时间
+    conn = context.connection
+    if conn is not None and conn.info.get('query_stats_start'):
+        conn.info['query_stats_start'].pop()
+
+
+# --- Supabase REST ---
+def rest_shape(request: httpx.Request) -> str:
+    """如 GET users?id=eq&select、POST rpc/adjust_credits"""
+    parsed = urlsplit(str(request.url))
+    path = parsed.path.split('/rest/v1/', 1)[-1]
+    params = []
+    for key, value in parse_qsl(parsed.query, keep_blank_values=True):
+        params.append(key if key in REST_PLAIN_PARAMS else f"{key}={value.split('.', 1)[0]}")
+    return f"{request.method} {path}" + (f"?{'&'.join(sorted(params))}" if params else '')
+
+
+class InstrumentedClient(httpx.Client):
+    """记录每次请求耗时的httpx客户端（包括读取响应体）"""
+
+    def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        if _current.get() is None:
+            return super().send(request, **kwargs)
+        start = time.perf_counter()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            _record('rest', rest_shape(request), (time.perf_counter() - start) * 1000)
+
+
+# --- Flask ---
+def _start_request():
+    _current.set(QueryStats())
+
+
+def _finish_request(response):
+    stats = _current.get()
+    if stats is None or not stats.total_count:
+        return response
+
+    response.headers['Server-Timing'] = stats.server_timing()
+    response.headers['Timing-Allow-Origin'] = '*'
+
+    endpoint = f"{request.method} {request.path}"
+    if stats.total_ms > QUERY_LOG_THRESHOLD_MS or stats.total_count > QUERY_LOG_THRESHOLD_COUNT:
+        slowest = stats.slowest
+        logger.info(
+            f"{endpoint}: SQL {stats.counts['sql']} 条 {stats.durations['sql']:.1f}ms, "
+            f"REST {stats.counts['rest']} 次 {stats.durations['rest']:.1f}ms; "
+            f"最慢 {slowest['kind']} {slowest['duration_ms']:.1f}ms: {slowest['shape']}"
+        )
+    for kind, shape, count in stats.repeated(QUERY_REPEAT_THRESHOLD):
+        logger.warning(f"{endpoint}: 同一{kind}语句执行了 {count} 次（可能是N+1查询）: {shape}")
+    return response
+
+
+def _teardown_request(exc=None):
+    _current.set(None)
+
+
+_listening = False
+
+def init_app(app) -> None:
+    """注册SQLAlchemy事件和请求钩子（QUERY_STATS_ENABLED=false时不统计）"""
+    global _listening
+    if not QUERY_STATS_ENABLED:
+        return
+    if not _listening:
+        # 注册在Engine类上，对所有引擎生效
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+        _listening = True
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
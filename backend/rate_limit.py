@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+滑动窗口限流
+用于登录、注册、管理员登录和兑换接口，按IP和账号/兑换码前缀计数，
+在进行密码哈希和数据库访问之前拒绝超限请求
+
+采用滑动窗口计数器算法：每个键只保存当前窗口和上一窗口两个计数，
+按时间比例加权估算滑动窗口内的请求数，内存占用与请求量无关。
+计数保存在共享缓存后端的独立存储中（见 cache.py），多个worker共享同一组计数
+"""
+import logging
+import os
+import threading
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import request, jsonify
+
+from cache import CacheBackend, rate_limit_backend
+
+logger = logging.getLogger(__name__)
+
+
+# --- 限流器 ---
+class RateLimitRule:
+    """限流规则：在window秒内，同一个键最多limit次请求"""
+
+    def __init__(self, scope: str, limit: int, window: int, key_func: Callable[[], Optional[str]]):
+        self.scope = scope
+        self.limit = limit
+        self.window = window
+        self.key_func = key_func
+
+
+class RateLimiter:
+    """滑动窗口限流器"""
+
+    def __init__(self, storage: CacheBackend):
+        self.storage = storage
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def hit(self, name: str, rules: List[RateLimitRule]) -> Optional[int]:
+        """记录一次请求；超限时返回建议的重试等待秒数，否则返回None
+
+        先原子自增当前窗口的计数，再按自增后的值判断：并发请求各自得到不同的计数，
+        不会在任何一个计数之前都通过检查。被拒绝的请求同样计数（持续的暴力尝试保持被拒绝）
+        """
+        now = time.time()
+        for rule in rules:
+            key = rule.key_func()
+            if not key:
+                continue
+
+            window_index = int(now // rule.window)
+            elapsed = (now % rule.window) / rule.window
+            current_key = f"rl:{name}:{rule.scope}:{key}:{window_index}"
+            previous_key = f"rl:{name}:{rule.scope}:{key}:{window_index - 1}"
+
+            # 计数保留两个窗口，供下一窗口加权使用
+            current_count, previous_count = self.storage.incr_and_get(
+                current_key, previous_key, 1, ttl=rule.window * 2
+            )
+            estimated = (previous_count or 0) * (1 - elapsed) + current_count
+            if estimated > rule.limit:
+                self._record(name, rule.scope, allowed=False)
+                return max(1, int(rule.window * (1 - elapsed)))
+
+        self._record(name, None, allowed=True)
+        return None
+
+    def _record(self, name: str, scope: Optional[str], allowed: bool) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(name, {'allowed': 0, 'rejected': 0})
+            if allowed:
+                stats['allowed'] += 1
+            else:
+                stats['rejected'] += 1
+                stats[f'rejected_by_{scope}'] = stats.get(f'rejected_by_{scope}', 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """各接口的放行/拒绝计数"""
+        with self._lock:
+            return {name: dict(counts) for name, counts in self._stats.items()}
+
+
+rate_limiter = RateLimiter(rate_limit_backend)
+
+
+# --- 限流键 ---
+# 经过的反向代理层数（Render等平台为1），用于从X-Forwarded-For中取真实客户端IP
+PROXY_COUNT = int(os.getenv('RATE_LIMIT_PROXY_COUNT', 1))
+
+def client_ip() -> str:
+    """客户端IP（取代理追加的X-Forwarded-For条目，客户端伪造的前缀条目会被忽略）"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if PROXY_COUNT and forwarded:
+        hops = [hop.strip() for hop in forwarded.split(',')]
+        return hops[-min(PROXY_COUNT, len(hops))]
+    return request.remote_addr or 'unknown'
+
+def json_field(field: str, prefix_length: Optional[int] = None) -> Callable[[], Optional[str]]:
+    """从JSON请求体中取字段值作为限流键（可只取前缀）"""
+    def key_func():
+        data = request.get_json(silent=True) or {}
+        value = data.get(field)
+        if not isinstance(value, str) or not value.strip():
+            return None
+        value = value.strip().lower()
+        return value[:prefix_length] if prefix_length else value
+    return key_func
+
+def token_subject() -> Optional[str]:
+    """已验证令牌中的用户ID（令牌无效时不计数，由认证装饰器拒绝）"""
+    from tokens import decode_request_token
+    try:
+        return str(decode_request_token().get('sub'))
+    except Exception:
+        return None
+
+
+# 学校网络中整班学生共用一个出口IP，IP维度的限额需要留足余量
+RATE_LIMITS = {
+    'login': [
+        RateLimitRule('ip', 120, 60, client_ip),
+        RateLimitRule('account', 10, 300, json_field('login')),
+    ],
+    'register': [
+        RateLimitRule('ip', 60, 3600, client_ip),
+    ],
+    'admin_login': [
+        RateLimitRule('ip', 10, 300, client_ip),
+        RateLimitRule('account', 10, 300, json_field('username')),
+    ],
+    'redeem': [
+        RateLimitRule('ip', 60, 60, client_ip),
+        RateLimitRule('account', 10, 300, token_subject),
+        RateLimitRule('code', 5, 300, json_field('code', prefix_length=6)),
+    ],
+}
+
+
+def rate_limit(name: str):
+    """限流装饰器：超限时直接返回429，不执行后续的哈希和数据库操作"""
+    rules = RATE_LIMITS[name]
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            try:
+                retry_after = rate_limiter.hit(name, rules)
+            except Exception as e:
+                # 计数存储异常时放行，避免限流故障导致服务不可用
+                logger.error(f"限流计数失败: {e}")
+                retry_after = None
+
+            if retry_after is not None:
+                response = jsonify({'error': '请求过于频繁，请稍后再试'})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地Redis协议替身服务
+实现 cache.RedisCache 用到的命令子集（PING/AUTH/SELECT/GET/SET/DEL/INCRBY/
+WATCH/UNWATCH/MULTI/EXEC/DISCARD/FLUSHDB），用于在没有Redis的环境中
+测试多worker共享缓存，不用于生产
+
+用法:
+    python redis_standin.py --port 6390
+    CACHE_URL=redis://localhost:6390/0 python app.py
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+_data = {}           # key -> (value, expires_at 或 None)
+_versions = {}       # key -> 修改版本号，供WATCH检测
+_lock = threading.RLock()
+
+
+def _alive(key):
+    entry = _data.get(key)
+    if entry and entry[1] is not None and entry[1] < time.time():
+        _data.pop(key, None)
+        _bump(key)
+        return None
+    return entry
+
+
+def _bump(key):
+    _versions[key] = _versions.get(key, 0) + 1
+
+
+def _set(args):
+    key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+    expires_at = None
+    if 'PX' in options:
+        expires_at = time.time() + int(args[2 + options.index('PX') + 1]) / 1000
+    if 'EX' in options:
+        expires_at = time.time() + int(args[2 + options.index('EX') + 1])
+    exists = _alive(key) is not None
+    if ('NX' in options and exists) or ('XX' in options and not exists):
+        return None
+    _data[key] = (value, expires_at)
+    _bump(key)
+    return 'OK'
+
+
+def execute(args, session):
+    """执行单条命令，返回Python值（str/int/None/list）或Exception表示错误"""
+    command = args[0].upper()
+    args = args[1:]
+    with _lock:
+        if command in ('PING',):
+            return 'PONG'
+        if command in ('AUTH', 'SELECT'):
+            return 'OK'
+        if command == 'GET':
+            entry = _alive(args[0])
+            return entry[0] if entry else None
+        if command == 'SET':
+            return _set(args)
+        if command == 'DEL':
+            removed = 0
+            for key in args:
+                if _alive(key) is not None:
+                    _data.pop(key)
+                    _bump(key)
+                    removed += 1
+            return removed
+        if command == 'INCRBY':
+            entry = _alive(args[0])
+            try:
+                value = int(entry[0]) + int(args[1]) if entry else int(args[1])
+            except ValueError:
+                return Exception('ERR value is not an integer or out of range')
+            _data[args[0]] = (str(value), entry[1] if entry else None)
+            _bump(args[0])
+            return value
+        if command == 'WATCH':
+            for key in args:
+                session['watched'][key] = _versions.get(key, 0)
+            return 'OK'
+        if command == 'UNWATCH':
+            session['watched'] = {}
+            return 'OK'
+        if command == 'FLUSHDB':
+            for key in list(_data):
+                _bump(key)
+            _data.clear()
+            return 'OK'
+        return Exception(f"ERR unknown command '{command}'")
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """处理一个客户端连接"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:-2])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2].decode('utf-8'))
+        return args
+
+    def write_reply(self, value):
+        if isinstance(value, Exception):
+            self.wfile.write(f'-{value}\r\n'.encode('utf-8'))
+        elif value is None:
+            self.wfile.write(b'$-1\r\n')
+        elif isinstance(value, int):
+            self.wfile.write(f':{value}\r\n'.encode())
+        elif isinstance(value, list):
+            self.wfile.write(f'*{len(value)}\r\n'.encode())
+            for item in value:
+                self.write_reply(item)
+        elif value in ('OK', 'PONG', 'QUEUED'):
+            self.wfile.write(f'+{value}\r\n'.encode())
+        else:
+            data = str(value).encode('utf-8')
+            self.wfile.write(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+
+    def handle(self):
+        session = {'watched': {}, 'queue': None}
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = args[0].upper()
+
+            if command == 'MULTI':
+                session['queue'] = []
+                self.write_reply('OK')
+            elif command == 'DISCARD':
+                session['queue'] = None
+                session['watched'] = {}
+                self.write_reply('OK')
+            elif command == 'EXEC':
+                queued, session['queue'] = session['queue'] or [], None
+                with _lock:
+                    changed = any(_versions.get(key, 0) != version
+                                  for key, version in session['watched'].items())
+                    session['watched'] = {}
+                    if changed:
+                        self.wfile.write(b'*-1\r\n')
+                    else:
+                        self.write_reply([execute(queued_args, session) for queued_args in queued])
+            elif session['queue'] is not None:
+                session['queue'].append(args)
+                self.write_reply('QUEUED')
+            else:
+                self.write_reply(execute(args, session))
+            self.wfile.flush()
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地Redis协议替身服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+
+    with ThreadedServer((args.host, args.port), RespHandler) as server:
+        print(f"Redis替身服务已启动: redis://{args.host}:{args.port}/0")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,553 @@
+# -*- coding: utf-8 -*-
+"""
+数据访问层
+请求热路径（认证、登录、积分预留与结算、兑换、交易记录、设置）统一通过 repository 访问数据，
+不再分别使用 Supabase REST（models_supabase.py）和 SQLAlchemy 模型（models.py）两套路径。
+
+后端由 DATA_BACKEND 环境变量选择：
+    supabase  通过Supabase REST/RPC访问（默认，每次操作一次HTTPS往返）
+    postgres  通过SQLAlchemy连接池直连PostgreSQL，调用与REST相同的数据库函数
+    sqlite    通过SQLAlchemy访问本地SQLite（单机部署和本地开发）
+管理后台和命令行（用户列表与详情、批量导入与调整、批量生成兑换码、导出、统计、对账、健康检查）
+同样经过 repository，直连后端见 repository_sql.py；
+超过保留期的积分流水由 ledger_archive.py 通过这里的归档方法移到压缩文件中
+"""
+import abc
+import logging
+import os
+from datetime import date, datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+import passwords
+from cache import user_cache, setting_cache
+
+logger = logging.getLogger(__name__)
+
+# 管理后台用户列表返回的字段（不含密码哈希和令牌版本，与 UserSupabase.LIST_COLUMNS 一致）
+USER_LIST_FIELDS = ['id', 'username', 'email', 'credits', 'is_active', 'created_at', 'last_login']
+# 用户列表可排序的列 -> 是否可能为NULL（NULL排在最后）；每个排序都有 (列 DESC, id DESC) 索引
+USER_SORT_COLUMNS = {'created_at': False, 'credits': False, 'last_login': True}
+# 可导出的表：名称 -> 导出的列（按ID游标分页读取，见 iter_pages；用户不导出密码哈希）
+EXPORT_COLUMNS = {
+    'users': USER_LIST_FIELDS,
+    'codes': ['id', 'code', 'credits_value', 'is_used', 'used_by_user_id', 'used_at', 'created_at', 'expires_at',
+              'description'],
+    'transactions': ['id', 'user_id', 'transaction_type', 'credits_amount', 'description', 'created_at'],
+}
+# 导出名称 -> 表名
+EXPORT_TABLES = {'users': 'users', 'codes': 'redemption_codes', 'transactions': 'credit_transactions'}
+# 统计计数的名称（usage_summary 的键，与 UsageStatsSupabase.COUNTERS 一致）
+USAGE_COUNTERS = ('users', 'total_credits', 'codes', 'used_codes', 'transactions', 'generations')
+# 生成创作结算时写入的交易类型（生成次数按此计数）；消耗积分统计这两类扣减流水
+GENERATION_TRANSACTION = 'generation'
+CONSUME_TRANSACTIONS = ('consume', GENERATION_TRANSACTION)
+
+
+class Repository(abc.ABC):
+    """数据访问接口
+
+    用户和余额以字典返回（字段与users表一致，时间为ISO格式字符串）；
+    余额变化后同步更新用户缓存
+    """
+
+    name = 'base'
+
+    # --- 用户 ---
+    @abc.abstractmethod
+    def get_user(self, user_id: int, fresh: bool = False) -> Optional[Dict[str, Any]]:
+        """根据ID获取用户（优先读取缓存，fresh=True时强制从数据库读取）"""
+
+    @abc.abstractmethod
+    def get_user_credentials(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """获取用户及密码哈希（不经过缓存；其他读取用户的方法都不返回密码哈希）"""
+
+    @abc.abstractmethod
+    def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        """按用户名获取用户及密码哈希（登录验证）"""
+
+    @abc.abstractmethod
+    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+        """按邮箱获取用户及密码哈希（登录验证）"""
+
+    @abc.abstractmethod
+    def create_user(self, username: str, email: str, password: str, credits: int = 10) -> Optional[Dict[str, Any]]:
+        """创建用户，用户名或邮箱重复时抛出 DuplicateKeyError"""
+
+    @abc.abstractmethod
+    def set_password(self, user_id: int, password: str, token_version: Optional[int] = None) -> bool:
+        """修改密码（加密存储），可同时更新令牌版本以吊销旧令牌"""
+
+    @abc.abstractmethod
+    def set_user_active(self, user_id: int, is_active: bool) -> Optional[Dict[str, Any]]:
+        """启用/禁用用户，禁用时令牌版本加1；返回更新后的用户，用户不存在时返回None"""
+
+    @abc.abstractmethod
+    def token_revocations(self, since: datetime) -> List[Dict[str, Any]]:
+        """since之后递增过令牌版本或被禁用的用户 [{'id', 'token_version', 'is_active'}]（用于加载令牌吊销列表）"""
+
+    @abc.abstractmethod
+    def batch_update_last_login(self, updates: List[Dict[str, Any]]) -> int:
+        """批量更新最后登录时间，updates: [{'id': ..., 'last_login': ...}]"""
+
+    @abc.abstractmethod
+    def adjust_credits(self, user_id: int, amount: int, transaction_type: str, description: str) -> Optional[int]:
+        """原子调整积分并写入流水，返回新余额；用户不存在或可用余额不足时返回None"""
+
+    # --- 用户管理（管理后台、命令行）---
+    @abc.abstractmethod
+    def count_users(self) -> int:
+        """用户数量（Supabase为估算值）"""
+
+    @abc.abstractmethod
+    def users_page(self, limit: int = 20, cursor: Optional[str] = None, sort: str = 'created_at',
+                   descending: bool = True, search: Optional[str] = None,
+                   with_total: bool = False) -> Dict[str, Any]:
+        """按 (排序列, id) 游标分页获取用户列表（字段见 USER_LIST_FIELDS）
+
+        sort 为 USER_SORT_COLUMNS 中的列；search 按用户名或邮箱匹配（3个字符以上为子串，否则为前缀）
+        返回 {'items', 'next_cursor', 'total'}，total只在with_total=True时返回（可能是估算值）
+        """
+
+    @abc.abstractmethod
+    def user_detail(self, user_id: int, transactions_limit: int = 50,
+                    codes_limit: int = 20) -> Optional[Dict[str, Any]]:
+        """用户详情：用户字段加上 ledger_credits（按流水计算的余额）、第一页交易记录
+        transactions / transactions_next_cursor 和已使用的兑换码 used_codes / used_codes_next_cursor；
+        用户不存在时返回None
+        """
+
+    @abc.abstractmethod
+    def bulk_create_users(self, rows: List[Dict[str, Any]], batch_size: int = 500) -> Dict[str, Any]:
+        """批量创建用户（rows: [{'username', 'email', 'password', 'credits'}]），
+        用户名或邮箱已存在的行被跳过；返回 {'created': [{'id', 'username'}], 'skipped': [用户名]}
+        """
+
+    @abc.abstractmethod
+    def bulk_adjust_credits(self, user_ids: List[int], amount: int, transaction_type: str, description: str,
+                            username_prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+        """在一个事务内批量调整积分，目标为user_ids与用户名前缀匹配的活跃用户的并集；
+        返回 [{'user_id', 'status': 'applied'/'insufficient'/'not_found', 'credits'}]（按user_id排序）
+        """
+
+    # --- 积分预留 ---
+    @abc.abstractmethod
+    def place_hold(self, user_id: int, amount: int, description: str, ttl_seconds: int,
+                   transaction_type: str = 'consume') -> Optional[Dict[str, Any]]:
+        """预留积分，返回 {'hold_id', 'credits', 'held_credits'}（预留后的余额）；
+        可用余额不足时hold_id为None，用户不存在时返回None。结算时以transaction_type写入流水"""
+
+    @abc.abstractmethod
+    def release_hold(self, hold_id: int) -> bool:
+        """释放单个预留，返回是否释放"""
+
+    @abc.abstractmethod
+    def capture_holds(self, hold_ids: List[int]) -> int:
+        """批量结算预留，返回结算数量；已过期但未结算的预留在可用余额足够时同样结算，
+        已结算/释放的预留被忽略"""
+
+    @abc.abstractmethod
+    def release_holds(self, hold_ids: List[int]) -> int:
+        """批量释放预留，返回释放数量"""
+
+    @abc.abstractmethod
+    def expire_holds(self) -> int:
+        """释放所有已过期的预留，返回释放数量"""
+
+    # --- 兑换码 ---
+    @abc.abstractmethod
+    def create_code(self, credits_value: int, description: Optional[str] = None,
+                    expires_days: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """生成一个兑换码，返回兑换码记录"""
+
+    @abc.abstractmethod
+    def bulk_create_codes(self, count: int, credits_value: int, description: Optional[str] = None,
+                          expires_days: Optional[int] = None) -> Iterator[List[Dict[str, Any]]]:
+        """批量生成兑换码，按批次返回已插入的兑换码 [{'id', 'code', 'credits_value', 'expires_at', 'description'}]
+        （生成器，可边生成边导出）；结束或中断时已插入的码加入兑换码过滤器
+        """
+
+    @abc.abstractmethod
+    def codes_page(self, limit: int = 20, cursor: Optional[str] = None, with_total: bool = False) -> Dict[str, Any]:
+        """按ID倒序（即创建顺序倒序）游标分页获取兑换码
+
+        返回 {'items', 'next_cursor', 'total'}，total只在with_total=True时返回（可能是估算值）
+        """
+
+    @abc.abstractmethod
+    def used_codes_page(self, user_id: int, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """按 (used_at DESC, id DESC) 游标分页获取用户使用过的兑换码，返回 {'items', 'next_cursor'}"""
+
+    @abc.abstractmethod
+    def iter_codes(self) -> Iterator[str]:
+        """遍历全部兑换码（用于重建兑换码过滤器）"""
+
+    @abc.abstractmethod
+    def max_code_id(self) -> int:
+        """最大的兑换码ID（没有兑换码时为0），兑换码过滤器以此判断是否有新生成的码"""
+
+    @abc.abstractmethod
+    def redeem_code(self, code: str, user_id: int) -> Dict[str, Any]:
+        """兑换积分，返回 {'status': 'redeemed', 'credits_added': ..., 'credits': 新余额}，
+        失败时status为 not_found / used / expired
+        """
+
+    # --- 积分流水 ---
+    @abc.abstractmethod
+    def transactions_page(self, user_id: int, limit: int = 20, cursor: Optional[str] = None,
+                          with_total: bool = False) -> Dict[str, Any]:
+        """按 (created_at DESC, id) 游标分页，返回 {'items', 'next_cursor', 'total'}"""
+
+    @abc.abstractmethod
+    def ledger_balance(self, user_id: int) -> int:
+        """按流水计算的余额"""
+
+    @abc.abstractmethod
+    def write_snapshots(self, settle_seconds: int = 300) -> int:
+        """为有新流水的用户写入余额快照（只包含settle_seconds之前写入的流水），返回写入数量"""
+
+    @abc.abstractmethod
+    def reconcile_credits(self, check_all: bool = False, repair: bool = False) -> List[Dict[str, Any]]:
+        """对账：返回余额投影与流水不一致的用户 [{'user_id', 'credits', 'ledger_credits'}]，
+        repair=True时以流水为准修复（结果中附带 repaired_credits）
+        """
+
+    # --- 统计 ---
+    @abc.abstractmethod
+    def usage_summary(self) -> Dict[str, int]:
+        """全部统计计数 {名称: 值}（名称见 USAGE_COUNTERS）"""
+
+    @abc.abstractmethod
+    def daily_usage(self, start: date, end: date) -> List[Dict[str, Any]]:
+        """[start, end] 日期范围内按天的用量（day为ISO日期字符串），没有记录的日期不返回"""
+
+    @abc.abstractmethod
+    def rebuild_usage_stats(self) -> Dict[str, int]:
+        """从基础表重新计算统计计数和每日汇总，返回重建后的计数"""
+
+    # --- 积分流水归档（见 ledger_archive.py）---
+    @abc.abstractmethod
+    def archive_boundary(self, before: datetime) -> int:
+        """可归档流水的最大ID：已计入余额快照，且不超过before之前最后写入的流水"""
+
+    @abc.abstractmethod
+    def archivable_transactions(self, before: datetime, max_id: int, after_id: int = 0,
+                                limit: int = 1000) -> List[Dict[str, Any]]:
+        """按ID顺序读取一页可归档的流水（after_id < id <= max_id 且 created_at < before）"""
+
+    @abc.abstractmethod
+    def archive_transactions(self, first_id: int, last_id: int, before: datetime,
+                             archives: List[Dict[str, Any]]) -> int:
+        """在一个事务内记录归档文件清单并删除 first_id..last_id 中 created_at < before 的流水，返回删除数量；
+        范围超出快照边界或删除数量与清单行数不一致时回滚并抛出异常
+        """
+
+    @abc.abstractmethod
+    def prune_snapshots(self, max_id: int) -> int:
+        """删除 last_transaction_id <= max_id 且已被更新快照取代的快照，返回删除数量"""
+
+    @abc.abstractmethod
+    def transaction_archives(self, start: Optional[date] = None, end: Optional[date] = None) -> List[Dict[str, Any]]:
+        """归档文件清单（按日期和首条流水ID排序），start/end为包含的日期范围"""
+
+    # --- 设置 ---
+    # --- 导出 ---
+    @abc.abstractmethod
+    def iter_pages(self, kind: str, filters: Optional[Dict[str, Any]] = None,
+                   page_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+        """按ID游标逐页读取可导出的表（kind见 EXPORT_COLUMNS），filters为等值过滤条件 {列名: 值}
+
+        每页使用 id > 上一页最后ID 的条件读取，不使用OFFSET，后面的页与第一页开销相同
+        """
+
+    # --- 健康检查 ---
+    @abc.abstractmethod
+    def ping(self) -> bool:
+        """数据库是否可用"""
+
+    @abc.abstractmethod
+    def get_setting(self, key: str) -> Optional[str]:
+        """读取设置（优先读取缓存）"""
+
+    @abc.abstractmethod
+    def set_setting(self, key: str, value: str) -> bool:
+        """写入设置并使缓存失效"""
+
+    def start(self) -> None:
+        """启动后端的后台任务（如SQLite的WAL检查点），默认没有"""
+
+    # --- 与后端无关的组合操作 ---
+    @staticmethod
+    def check_password(user: Dict[str, Any], password: str) -> bool:
+        """验证用户密码"""
+        if not user or 'password_hash' not in user:
+            return False
+        return passwords.check_password(password, user['password_hash'])
+
+    def upgrade_password_hash(self, user: Dict[str, Any], password: str) -> bool:
+        """登录成功后，若哈希的成本因子与当前配置不一致则按新配置重新加密"""
+        if not passwords.needs_rehash(user.get('password_hash', '')):
+            return False
+        return self.set_password(user['id'], password)
+
+    def update_last_login(self, user_id: int) -> None:
+        """记录登录时间（写入缓冲区，由后台线程调用batch_update_last_login批量写库）"""
+        from last_login_writer import last_login_writer
+        last_login = datetime.now().isoformat()
+        last_login_writer.record(user_id, last_login)
+        user_cache.update(user_id, {'last_login': last_login})
+
+    def update_cached_credits(self, user_id: int, credits: int) -> None:
+        """更新缓存中的余额（结算操作异步提交时，先让后续读取看到预计余额）"""
+        user_cache.update(user_id, {'credits': credits})
+
+    def check_setting_password(self, key: str, password: str) -> bool:
+        """验证以哈希形式保存在设置中的密码（如管理员密码），成本因子变化时透明升级"""
+        hashed_password = self.get_setting(key)
+        if not hashed_password or not passwords.check_password(password, hashed_password):
+            return False
+        if passwords.needs_rehash(hashed_password):
+            self.set_setting_password(key, password)
+        return True
+
+    def set_setting_password(self, key: str, password: str) -> bool:
+        return self.set_setting(key, passwords.hash_password(password))
+
+
+class SupabaseRepository(Repository):
+    """Supabase REST/RPC后端（委托给 models_supabase.py）"""
+
+    name = 'supabase'
+
+    def get_user(self, user_id, fresh=False):
+        from models_supabase import UserSupabase
+        return UserSupabase.get_by_id(user_id, fresh=fresh)
+
+    def get_user_credentials(self, user_id):
+        from models_supabase import UserSupabase
+        return UserSupabase.get_credentials(user_id)
+
+    def get_user_by_username(self, username):
+        from models_supabase import UserSupabase
+        return UserSupabase.get_by_username(username)
+
+    def get_user_by_email(self, email):
+        from models_supabase import UserSupabase
+        return UserSupabase.get_by_email(email)
+
+    def create_user(self, username, email, password, credits=10):
+        from models_supabase import UserSupabase
+        return UserSupabase.create(username, email, password, credits)
+
+    def set_password(self, user_id, password, token_version=None):
+        from models_supabase import UserSupabase
+        return UserSupabase.set_password(user_id, password, token_version=token_version)
+
+    def set_user_active(self, user_id, is_active):
+        from supabase_client import get_supabase_manager
+        # 一条UPDATE内修改状态并递增令牌版本，不会覆盖并发的修改密码
+        manager = get_supabase_manager()
+        result = manager.client.rpc('set_user_active', {'p_user_id': user_id, 'p_is_active': is_active}).execute()
+        user_cache.delete(user_id)
+        return result.data or None
+
+    def token_revocations(self, since, page_size=1000):
+        from supabase_client import get_supabase_manager
+        # 按ID分页读取（PostgREST单次最多返回1000行）
+        manager = get_supabase_manager()
+        rows, last_id = [], 0
+        while True:
+            page = manager.client.table('users')\
+                .select('id,token_version,is_active')\
+                .gte('tokens_revoked_at', since.isoformat())\
+                .gt('id', last_id)\
+                .order('id')\
+                .limit(page_size)\
+                .execute().data
+            rows.extend(page)
+            if len(page) < page_size:
+                return rows
+            last_id = page[-1]['id']
+
+    def batch_update_last_login(self, updates):
+        from models_supabase import UserSupabase
+        return UserSupabase.batch_update_last_login(updates)
+
+    def adjust_credits(self, user_id, amount, transaction_type, description):
+        from models_supabase import UserSupabase
+        return UserSupabase.adjust_credits(user_id, amount, transaction_type, description)
+
+    def count_users(self):
+        from models_supabase import UserSupabase
+        return UserSupabase.count()
+
+    def users_page(self, limit=20, cursor=None, sort='created_at', descending=True, search=None, with_total=False):
+        from models_supabase import UserSupabase
+        return UserSupabase.get_page(limit=limit, cursor=cursor, sort=sort, descending=descending,
+                                     search=search, with_total=with_total)
+
+    def user_detail(self, user_id, transactions_limit=50, codes_limit=20):
+        from models_supabase import UserSupabase, CreditLedgerSupabase
+        from supabase_client import get_supabase_manager
+        # 嵌入查询与按流水计算余额的RPC并发执行，总耗时为一次往返
+        user, ledger_credits = get_supabase_manager().run_concurrently(
+            lambda: UserSupabase.get_detail(user_id, transactions_limit, codes_limit),
+            lambda: CreditLedgerSupabase.balance(user_id)
+        )
+        if user is not None:
+            user['ledger_credits'] = ledger_credits
+        return user
+
+    def bulk_create_users(self, rows, batch_size=500):
+        from models_supabase import UserSupabase
+        return UserSupabase.bulk_create(rows, batch_size=batch_size)
+
+    def bulk_adjust_credits(self, user_ids, amount, transaction_type, description, username_prefix=None):
+        from models_supabase import UserSupabase
+        return UserSupabase.bulk_adjust_credits(user_ids, amount, transaction_type, description,
+                                                username_prefix=username_prefix)
+
+    def place_hold(self, user_id, amount, description, ttl_seconds, transaction_type='consume'):
+        from models_supabase import CreditHoldSupabase
+        return CreditHoldSupabase.place(user_id, amount, description, ttl_seconds, transaction_type)
+
+    def release_hold(self, hold_id):
+        from models_supabase import CreditHoldSupabase
+        return CreditHoldSupabase.release(hold_id)
+
+    def capture_holds(self, hold_ids):
+        from models_supabase import CreditHoldSupabase
+        return CreditHoldSupabase.capture_many(hold_ids)
+
+    def release_holds(self, hold_ids):
+        from models_supabase import CreditHoldSupabase
+        return CreditHoldSupabase.release_many(hold_ids)
+
+    def expire_holds(self):
+        from models_supabase import CreditHoldSupabase
+        return CreditHoldSupabase.expire_stale()
+
+    def create_code(self, credits_value, description=None, expires_days=None):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.create(credits_value, description, expires_days)
+
+    def bulk_create_codes(self, count, credits_value, description=None, expires_days=None):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.bulk_create(count, credits_value, description, expires_days)
+
+    def codes_page(self, limit=20, cursor=None, with_total=False):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.get_page(limit=limit, cursor=cursor, with_total=with_total)
+
+    def used_codes_page(self, user_id, limit=20, cursor=None):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.get_used_page(user_id, limit=limit, cursor=cursor)
+
+    def iter_codes(self):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.iter_codes()
+
+    def max_code_id(self):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.max_id()
+
+    def redeem_code(self, code, user_id):
+        from models_supabase import RedemptionCodeSupabase
+        return RedemptionCodeSupabase.redeem(code, user_id)
+
+    def transactions_page(self, user_id, limit=20, cursor=None, with_total=False):
+        from models_supabase import CreditTransactionSupabase
+        return CreditTransactionSupabase.get_page(user_id, limit=limit, cursor=cursor, with_total=with_total)
+
+    def ledger_balance(self, user_id):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.balance(user_id)
+
+    def write_snapshots(self, settle_seconds=300):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.write_snapshots(settle_seconds)
+
+    def reconcile_credits(self, check_all=False, repair=False):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.reconcile(check_all=check_all, repair=repair)
+
+    def usage_summary(self):
+        from models_supabase import UsageStatsSupabase
+        return UsageStatsSupabase.summary()
+
+    def daily_usage(self, start, end):
+        from models_supabase import UsageStatsSupabase
+        return UsageStatsSupabase.daily(start.isoformat(), end.isoformat())
+
+    def rebuild_usage_stats(self):
+        from models_supabase import UsageStatsSupabase
+        return UsageStatsSupabase.rebuild()
+
+    def archive_boundary(self, before):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.archive_boundary(before)
+
+    def archivable_transactions(self, before, max_id, after_id=0, limit=1000):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.archivable(before, max_id, after_id=after_id, limit=limit)
+
+    def archive_transactions(self, first_id, last_id, before, archives):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.archive(first_id, last_id, before, archives)
+
+    def prune_snapshots(self, max_id):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.prune_snapshots(max_id)
+
+    def transaction_archives(self, start=None, end=None):
+        from models_supabase import CreditLedgerSupabase
+        return CreditLedgerSupabase.archives(start, end)
+
+    def iter_pages(self, kind, filters=None, page_size=1000):
+        from supabase_client import get_supabase_manager
+        table, columns = EXPORT_TABLES[kind], ','.join(EXPORT_COLUMNS[kind])
+        manager = get_supabase_manager()
+
+        def fetch(last_id):
+            query = manager.client.table(table).select(columns).gt('id', last_id)
+            for column, value in (filters or {}).items():
+                query = query.eq(column, value)
+            return query.order('id').limit(page_size).execute().data
+
+        # 每页一次REST请求，输出当前页的同时预取下一页
+        pending = manager.submit(lambda: fetch(0))
+        while True:
+            page = pending.result()
+            if not page:
+                return
+            pending = manager.submit(lambda last_id=page[-1]['id']: fetch(last_id)) if len(page) == page_size else None
+            yield page
+            if pending is None:
+                return
+
+    def ping(self):
+        from supabase_client import get_supabase_manager
+        manager = get_supabase_manager()
+        return manager.is_connected() and manager.test_connection()
+
+    def get_setting(self, key):
+        from models_supabase import SettingSupabase
+        return SettingSupabase.get(key)
+
+    def set_setting(self, key, value):
+        from models_supabase import SettingSupabase
+        return SettingSupabase.set(key, value)
+
+
+def create_repository(backend: Optional[str] = None, database_url: Optional[str] = None) -> Repository:
+    """按名称创建后端实例（supabase / postgres / sqlite）"""
+    backend = (backend or os.getenv('DATA_BACKEND', 'supabase')).lower()
+    if backend == 'supabase':
+        return SupabaseRepository()
+    if backend in ('postgres', 'sqlite'):
+        from repository_sql import create_sql_repository
+        return create_sql_repository(database_url or os.getenv('REPOSITORY_DATABASE_URL') or os.getenv('DATABASE_URL'))
+    raise ValueError(f"不支持的数据后端: {backend}")
+
+
+repository = create_repository()
+logger.info(f"数据访问后端: {repository.name}")
@@ -0,0 +1,1067 @@
+# -*- coding: utf-8 -*-
+"""
+SQLAlchemy直连后端
+通过持久连接池访问数据库，每次操作不再经过HTTPS往返：
+    SqlRepository       可移植实现（SQLite、以及没有安装数据库函数的PostgreSQL），
+                        多条语句在一个事务内执行，余额更新使用条件UPDATE ... RETURNING；
+                        SQLite使用单个写连接和只读连接池（见 sqlite_engine.py）
+    PostgresRepository  积分相关操作调用 create_tables.sql 中的数据库函数（与Supabase RPC相同），
+                        每个操作一次往返
+表结构取自 models.py，连接池独立于Flask应用上下文，后台线程（流水发件箱、登录时间写入）也可直接使用
+"""
+import json
+import logging
+import os
+import secrets
+import string
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import and_, bindparam, create_engine, delete, func, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+import passwords
+from cache import user_cache, setting_cache
+from models import (User, RedemptionCode, CreditTransaction, CreditHold, CreditBalanceSnapshot,
+                    CreditTransactionArchive, Setting)
+from pagination import encode_cursor, decode_cursor
+from repository import (Repository, EXPORT_COLUMNS, USER_LIST_FIELDS, USER_SORT_COLUMNS, USAGE_COUNTERS,
+                        GENERATION_TRANSACTION, CONSUME_TRANSACTIONS)
+from supabase_client import DuplicateKeyError, USER_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+users = User.__table__
+codes = RedemptionCode.__table__
+transactions = CreditTransaction.__table__
+holds = CreditHold.__table__
+snapshots = CreditBalanceSnapshot.__table__
+archive_files = CreditTransactionArchive.__table__
+settings = Setting.__table__
+
+# 连接池大小（每个worker进程一个连接池）
+REPOSITORY_POOL_SIZE = int(os.getenv('REPOSITORY_POOL_SIZE', 5))
+REPOSITORY_MAX_OVERFLOW = int(os.getenv('REPOSITORY_MAX_OVERFLOW', 10))
+
+# 用户记录的列（与 supabase_client.USER_COLUMNS 一致，不含password_hash）
+USER_FIELDS = [users.c[name.strip()] for name in USER_COLUMNS.split(',')]
+CREDENTIAL_FIELDS = USER_FIELDS + [users.c.password_hash]
+# 管理后台用户列表的列
+LIST_FIELDS = [users.c[name] for name in USER_LIST_FIELDS]
+
+# 交易记录分页的列（与 CreditTransactionSupabase.PAGE_COLUMNS 一致）
+PAGE_COLUMNS = [transactions.c.id, transactions.c.user_id, transactions.c.transaction_type,
+                transactions.c.credits_amount, transactions.c.description, transactions.c.created_at]
+
+# 可导出的表：名称 -> (表, 导出的列)
+EXPORT_FIELDS = {
+    kind: (table, [table.c[name] for name in EXPORT_COLUMNS[kind]])
+    for kind, table in (('users', users), ('codes', codes), ('transactions', transactions))
+}
+CODE_FIELDS = EXPORT_FIELDS['codes'][1]
+
+# 用户详情中已使用兑换码的列、批量生成后返回的列（与 RedemptionCodeSupabase.USED_COLUMNS / MINTED_COLUMNS 一致）
+USED_CODE_FIELDS = [codes.c.id, codes.c.code, codes.c.credits_value, codes.c.used_at, codes.c.description]
+MINTED_FIELDS = [codes.c.id, codes.c.code, codes.c.credits_value, codes.c.expires_at, codes.c.description]
+
+# 生成创作的扣减流水（与 credit_transactions_usage_stats 触发器的统计口径一致）
+GENERATION = transactions.c.transaction_type == GENERATION_TRANSACTION
+
+# 归档文件清单的列（与 CreditLedgerSupabase.ARCHIVE_COLUMNS 一致）
+ARCHIVE_FIELDS = [archive_files.c[name] for name in (
+    'partition_date', 'path', 'first_transaction_id', 'last_transaction_id', 'row_count', 'user_ids',
+    'generations', 'credits_consumed', 'bytes', 'sha256'
+)]
+
+
+def _like_escape(term: str) -> str:
+    """转义LIKE通配符（配合 escape='\\' 使用）"""
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _new_code(length: int = 16) -> str:
+    """随机兑换码"""
+    alphabet = string.ascii_uppercase + string.digits
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
+
+
+def _to_dict(row) -> Optional[Dict[str, Any]]:
+    """查询结果行转为字典，日期和时间转为ISO字符串（与Supabase REST返回的格式一致）"""
+    if row is None:
+        return None
+    return {key: value.isoformat() if isinstance(value, date) else value
+            for key, value in row._mapping.items()}
+
+
+class SqlRepository(Repository):
+    """可移植的SQLAlchemy后端"""
+
+    name = 'sqlite'
+
+    def __init__(self, engine, read_engine=None):
+        # 写操作使用engine；只读查询使用read_engine（SQLite单机模式为只读连接池，其余与engine相同）
+        self.engine = engine
+        self.read_engine = read_engine or engine
+        self.checkpoint_job = None
+
+    def start(self):
+        if self.checkpoint_job is not None:
+            self.checkpoint_job.start()
+
+    # --- 用户 ---
+    def _fetch_user(self, conn, *conditions, columns=USER_FIELDS):
+        return _to_dict(conn.execute(select(*columns).where(*conditions)).first())
+
+    def get_user(self, user_id, fresh=False):
+        if not fresh:
+            cached = user_cache.get(user_id)
+            if cached is not None:
+                return cached
+        with self.read_engine.connect() as conn:
+            user = self._fetch_user(conn, users.c.id == user_id)
+        if user is None:
+            user_cache.delete(user_id)
+            return None
+        user_cache.set(user_id, user)
+        return user
+
+    def get_user_credentials(self, user_id):
+        with self.read_engine.connect() as conn:
+            return self._fetch_user(conn, users.c.id == user_id, columns=CREDENTIAL_FIELDS)
+
+    def get_user_by_username(self, username):
+        with self.read_engine.connect() as conn:
+            return self._fetch_user(conn, users.c.username == username, columns=CREDENTIAL_FIELDS)
+
+    def get_user_by_email(self, email):
+        with self.read_engine.connect() as conn:
+            return self._fetch_user(conn, users.c.email == email, columns=CREDENTIAL_FIELDS)
+
+    def create_user(self, username, email, password, credits=10):
+        values = {
+            'username': username,
+            'email': email,
+            'password_hash': passwords.hash_password(password),
+            'credits': credits,
+            'is_active': True,
+            'token_version': 0,
+            'held_credits': 0,
+            'created_at': datetime.now()
+        }
+        try:
+            with self.engine.begin() as conn:
+                user = _to_dict(conn.execute(insert(users).values(**values).returning(*USER_FIELDS)).first())
+                self._record_initial_credits(conn, [user])
+        except IntegrityError as e:
+            with self.read_engine.connect() as conn:
+                taken = conn.execute(select(users.c.id).where(users.c.username == username)).first()
+            raise DuplicateKeyError('username' if taken else 'email', str(e.orig)) from e
+        return user
+
+    def _record_initial_credits(self, conn, created):
+        """新用户的初始积分写入流水（PostgreSQL由 users_initial_credits 触发器完成）"""
+        now = datetime.now()
+        rows = [{
+            'user_id': user['id'], 'transaction_type': 'signup', 'credits_amount': user['credits'],
+            'description': '注册初始积分', 'created_at': now
+        } for user in created if user['credits']]
+        if rows:
+            conn.execute(insert(transactions), rows)
+
+    def set_password(self, user_id, password, token_version=None):
+        values = {'password_hash': passwords.hash_password(password)}
+        if token_version is not None:
+            values['token_version'] = token_version
+            values['tokens_revoked_at'] = datetime.now()
+        with self.engine.begin() as conn:
+            updated = conn.execute(update(users).where(users.c.id == user_id).values(**values)).rowcount
+        user_cache.delete(user_id)
+        return updated > 0
+
+    def set_user_active(self, user_id, is_active):
+        values = {'is_active': is_active}
+        if not is_active:
+            values['token_version'] = users.c.token_version + 1
+            values['tokens_revoked_at'] = datetime.now()
+        with self.engine.begin() as conn:
+            user = _to_dict(conn.execute(
+                update(users).where(users.c.id == user_id).values(**values).returning(*USER_FIELDS)
+            ).first())
+        user_cache.delete(user_id)
+        return user
+
+    def token_revocations(self, since):
+        with self.read_engine.connect() as conn:
+            rows = conn.execute(
+                select(users.c.id, users.c.token_version, users.c.is_active)
+                .where(users.c.tokens_revoked_at >= since)
+            )
+            return [dict(row._mapping) for row in rows]
+
+    def batch_update_last_login(self, updates):
+        if not updates:
+            return 0
+        # 只写入比数据库中更新的时间（与 batch_update_last_login 数据库函数一致）
+        statement = update(users)\
+            .where(users.c.id == bindparam('user_id'),
+                   or_(users.c.last_login.is_(None), users.c.last_login < bindparam('login_at')))\
+            .values(last_login=bindparam('login_at'))
+        with self.engine.begin() as conn:
+            conn.execute(statement, [
+                {'user_id': row['id'], 'login_at': datetime.fromisoformat(row['last_login'])} for row in updates
+            ])
+        return len(updates)
+
+    def adjust_credits(self, user_id, amount, transaction_type, description):
+        conditions = [users.c.id == user_id]
+        if amount < 0:
+            # 扣减不能动用已预留的积分
+            conditions.append(users.c.credits - users.c.held_credits + amount >= 0)
+        with self.engine.begin() as conn:
+            new_credits = conn.execute(
+                update(users)
+                .where(*conditions)
+                .values(credits=users.c.credits + amount)
+                .returning(users.c.credits)
+            ).scalar()
+            if new_credits is None:
+                return None
+            conn.execute(insert(transactions).values(
+                user_id=user_id, transaction_type=transaction_type,
+                credits_amount=amount, description=description, created_at=datetime.now()
+            ))
+        user_cache.update(user_id, {'credits': new_credits})
+        return new_credits
+
+    # --- 用户管理 ---
+    def count_users(self):
+        with self.read_engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(users)).scalar()
+
+    def users_page(self, limit=20, cursor=None, sort='created_at', descending=True, search=None, with_total=False):
+        if sort not in USER_SORT_COLUMNS:
+            raise ValueError(f"不支持的排序字段: {sort}")
+        column, nullable = users.c[sort], USER_SORT_COLUMNS[sort]
+
+        conditions = []
+        term = (search or '').strip()
+        if term:
+            # 与 UserSupabase._search_filter 相同：3个字符以上按子串匹配，更短的按前缀匹配
+            pattern = f'%{_like_escape(term)}%' if len(term) >= 3 else f'{_like_escape(term)}%'
+            conditions.append(or_(users.c.username.ilike(pattern, escape='\\'),
+                                  users.c.email.ilike(pattern, escape='\\')))
+        total_conditions = list(conditions)
+
+        position = decode_cursor(cursor, 'int' if sort == 'credits' else 'datetime', nullable=nullable)
+        if position:
+            # 游标之后的行（排序值相同时按id继续；可为NULL的列NULL值排在最后）
+            sort_value, last_id = position
+            after = (lambda a, b: a < b) if descending else (lambda a, b: a > b)
+            if sort_value is None:
+                conditions.append(and_(column.is_(None), after(users.c.id, last_id)))
+            else:
+                following = [after(column, sort_value), and_(column == sort_value, after(users.c.id, last_id))]
+                if nullable:
+                    following.append(column.is_(None))
+                conditions.append(or_(*following))
+
+        order = (column.desc() if descending else column.asc()).nulls_last()
+        query = select(*LIST_FIELDS).where(*conditions)\
+            .order_by(order, users.c.id.desc() if descending else users.c.id).limit(limit + 1)
+        with self.read_engine.connect() as conn:
+            rows = [_to_dict(row) for row in conn.execute(query)]
+            total = None
+            if with_total:
+                total = conn.execute(select(func.count()).select_from(users).where(*total_conditions)).scalar()
+
+        items = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(items[-1][sort], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor, 'total': total}
+
+    def user_detail(self, user_id, transactions_limit=50, codes_limit=20):
+        with self.read_engine.connect() as conn:
+            user = self._fetch_user(conn, users.c.id == user_id, columns=LIST_FIELDS)
+            if user is None:
+                return None
+            user['ledger_credits'] = self._ledger_balance(conn, user_id)
+        # 分页与 transactions_page / used_codes_page 相同，返回的游标可直接用于翻页
+        transactions_page = self.transactions_page(user_id, limit=transactions_limit)
+        used_codes_page = self.used_codes_page(user_id, limit=codes_limit)
+        user.update({
+            'transactions': transactions_page['items'],
+            'transactions_next_cursor': transactions_page['next_cursor'],
+            'used_codes': used_codes_page['items'],
+            'used_codes_next_cursor': used_codes_page['next_cursor']
+        })
+        return user
+
+    def bulk_create_users(self, rows, batch_size=500):
+        password_hashes = passwords.hash_passwords(row['password'] for row in rows)
+        now = datetime.now()
+        values = [{
+            'username': row['username'],
+            'email': row['email'],
+            'password_hash': password_hash,
+            'credits': row.get('credits', 10),
+            'is_active': True,
+            'token_version': 0,
+            'held_credits': 0,
+            'created_at': now
+        } for row, password_hash in zip(rows, password_hashes)]
+
+        created = []
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            with self.engine.begin() as conn:
+                # 用户名或邮箱已存在的行先排除，其余一次插入
+                taken = conn.execute(select(users.c.username, users.c.email).where(or_(
+                    users.c.username.in_([row['username'] for row in batch]),
+                    users.c.email.in_([row['email'] for row in batch])
+                ))).all()
+                taken_names = {row.username for row in taken}
+                taken_emails = {row.email for row in taken}
+                batch = [row for row in batch if row['username'] not in taken_names and row['email'] not in taken_emails]
+                if batch:
+                    inserted = self._insert_users(conn, batch)
+                    self._record_initial_credits(conn, inserted)
+                    created.extend({'id': user['id'], 'username': user['username']} for user in inserted)
+
+        created_names = {user['username'] for user in created}
+        skipped = [row['username'] for row in values if row['username'] not in created_names]
+        return {'created': created, 'skipped': skipped}
+
+    def _insert_users(self, conn, rows):
+        """插入一批用户，返回插入的行；与并发注册冲突时逐行插入（每行一个保存点）并跳过冲突行"""
+        try:
+            with conn.begin_nested():
+                return [_to_dict(row) for row in conn.execute(insert(users).returning(*USER_FIELDS), rows)]
+        except IntegrityError:
+            pass
+        inserted = []
+        for row in rows:
+            try:
+                with conn.begin_nested():
+                    inserted.append(_to_dict(conn.execute(insert(users).values(**row).returning(*USER_FIELDS)).first()))
+            except IntegrityError:
+                continue
+        return inserted
+
+    def bulk_adjust_credits(self, user_ids, amount, transaction_type, description, username_prefix=None):
+        # 与 bulk_adjust_credits 数据库函数相同：指定的ID与前缀匹配的活跃用户取并集，一个事务内更新
+        conditions = []
+        if amount < 0:
+            conditions.append(users.c.credits - users.c.held_credits + amount >= 0)
+        with self.engine.begin() as conn:
+            targets = set(user_ids)
+            if username_prefix:
+                targets.update(conn.execute(
+                    select(users.c.id).where(users.c.is_active.is_(True),
+                                             users.c.username.like(f'{_like_escape(username_prefix)}%', escape='\\'))
+                ).scalars())
+            applied = dict(conn.execute(
+                update(users).where(users.c.id.in_(targets), *conditions)
+                .values(credits=users.c.credits + amount).returning(users.c.id, users.c.credits)
+            ).all()) if targets else {}
+            # 未更新的用户中仍存在的是可用余额不足
+            existing = set(conn.execute(
+                select(users.c.id).where(users.c.id.in_(targets - applied.keys()))
+            ).scalars()) if len(applied) < len(targets) else set()
+            if applied:
+                now = datetime.now()
+                conn.execute(insert(transactions), [{
+                    'user_id': user_id, 'transaction_type': transaction_type, 'credits_amount': amount,
+                    'description': description, 'created_at': now
+                } for user_id in applied])
+
+        results = []
+        for user_id in sorted(targets):
+            if user_id in applied:
+                user_cache.update(user_id, {'credits': applied[user_id]})
+                results.append({'user_id': user_id, 'status': 'applied', 'credits': applied[user_id]})
+            else:
+                results.append({'user_id': user_id, 'status': 'insufficient' if user_id in existing else 'not_found',
+                                'credits': None})
+        return results
+
+    # --- 积分预留 ---
+    def _expire(self, conn, *conditions) -> int:
+        """把已过期的预留标记为expired并退回held_credits，返回过期数量"""
+        now = datetime.now()
+        expired = conn.execute(
+            update(holds)
+            .where(holds.c.status == 'held', holds.c.expires_at < now, *conditions)
+            .values(status='expired', settled_at=now)
+            .returning(holds.c.user_id, holds.c.amount)
+        ).all()
+        self._release_held(conn, expired)
+        return len(expired)
+
+    def _release_held(self, conn, rows) -> None:
+        """按用户合并退回预留的积分"""
+        per_user: Dict[int, int] = {}
+        for user_id, amount in rows:
+            per_user[user_id] = per_user.get(user_id, 0) + amount
+        for user_id, amount in per_user.items():
+            conn.execute(update(users).where(users.c.id == user_id)
+                         .values(held_credits=users.c.held_credits - amount))
+
+    def place_hold(self, user_id, amount, description, ttl_seconds, transaction_type='consume'):
+        now = datetime.now()
+        with self.engine.begin() as conn:
+            self._expire(conn, holds.c.user_id == user_id)
+            placed = conn.execute(
+                update(users)
+                .where(users.c.id == user_id, users.c.credits - users.c.held_credits >= amount)
+                .values(held_credits=users.c.held_credits + amount)
+                .returning(users.c.credits, users.c.held_credits)
+            ).first()
+            if placed is None:
+                balance = conn.execute(
+                    select(users.c.credits, users.c.held_credits).where(users.c.id == user_id)
+                ).first()
+                if balance is None:
+                    return None
+                return {'hold_id': None, 'credits': balance.credits, 'held_credits': balance.held_credits}
+            hold_id = conn.execute(insert(holds).values(
+                user_id=user_id, amount=amount, status='held', description=description,
+                transaction_type=transaction_type, created_at=now, expires_at=now + timedelta(seconds=ttl_seconds)
+            ).returning(holds.c.id)).scalar()
+            return {'hold_id': hold_id, 'credits': placed.credits, 'held_credits': placed.held_credits}
+
+    def _settle(self, conn, hold_ids, status):
+        return conn.execute(
+            update(holds)
+            .where(holds.c.id.in_(hold_ids), holds.c.status == 'held')
+            .values(status=status, settled_at=datetime.now())
+            .returning(holds.c.user_id, holds.c.amount, holds.c.description, holds.c.transaction_type)
+        ).all()
+
+    def release_hold(self, hold_id):
+        return self.release_holds([hold_id]) > 0
+
+    def capture_holds(self, hold_ids):
+        if not hold_ids:
+            return 0
+        with self.engine.begin() as conn:
+            captured = self._settle(conn, hold_ids, 'captured')
+            per_user: Dict[int, int] = {}
+            for user_id, amount, _, _ in captured:
+                per_user[user_id] = per_user.get(user_id, 0) + amount
+            for user_id, amount in per_user.items():
+                conn.execute(update(users).where(users.c.id == user_id).values(
+                    credits=users.c.credits - amount, held_credits=users.c.held_credits - amount
+                ))
+            captured += self._capture_expired(conn, hold_ids)
+            if captured:
+                now = datetime.now()
+                conn.execute(insert(transactions), [{
+                    'user_id': user_id, 'transaction_type': transaction_type, 'credits_amount': -amount,
+                    'description': description, 'created_at': now
+                } for user_id, amount, description, transaction_type in captured])
+        return len(captured)
+
+    def _capture_expired(self, conn, hold_ids):
+        """结算已过期但从未结算的预留（held_credits已退回）：可用余额足够时扣减credits，不足时保持expired"""
+        expired = conn.execute(
+            select(holds.c.user_id, func.sum(holds.c.amount))
+            .where(holds.c.id.in_(hold_ids), holds.c.status == 'expired')
+            .group_by(holds.c.user_id)
+        ).all()
+        captured = []
+        for user_id, amount in expired:
+            charged = conn.execute(
+                update(users)
+                .where(users.c.id == user_id, users.c.credits - users.c.held_credits >= amount)
+                .values(credits=users.c.credits - amount)
+            ).rowcount
+            if charged:
+                captured += conn.execute(
+                    update(holds)
+                    .where(holds.c.id.in_(hold_ids), holds.c.user_id == user_id, holds.c.status == 'expired')
+                    .values(status='captured', settled_at=datetime.now())
+                    .returning(holds.c.user_id, holds.c.amount, holds.c.description, holds.c.transaction_type)
+                ).all()
+        return captured
+
+    def release_holds(self, hold_ids):
+        if not hold_ids:
+            return 0
+        with self.engine.begin() as conn:
+            released = self._settle(conn, hold_ids, 'released')
+            self._release_held(conn, [(user_id, amount) for user_id, amount, _, _ in released])
+        return len(released)
+
+    def expire_holds(self):
+        with self.engine.begin() as conn:
+            return self._expire(conn)
+
+    # --- 兑换码 ---
+    def create_code(self, credits_value, description=None, expires_days=None):
+        now = datetime.now()
+        values = {
+            'credits_value': credits_value,
+            'description': description,
+            'expires_at': now + timedelta(days=expires_days) if expires_days else None,
+            'is_used': False,
+            'created_at': now
+        }
+        # 兑换码随机生成，冲突概率极低，冲突时换一个重试
+        for _ in range(5):
+            code = _new_code()
+            try:
+                with self.engine.begin() as conn:
+                    return _to_dict(conn.execute(insert(codes).values(code=code, **values).returning(codes)).first())
+            except IntegrityError:
+                continue
+        return None
+
+    def bulk_create_codes(self, count, credits_value, description=None, expires_days=None,
+                          batch_size=1000, max_rounds=5):
+        now = datetime.now()
+        values = {
+            'credits_value': credits_value,
+            'description': description,
+            'expires_at': now + timedelta(days=expires_days) if expires_days else None,
+            'is_used': False,
+            'created_at': now
+        }
+        seen = set()
+
+        def new_codes(n):
+            candidates = []
+            while len(candidates) < n:
+                code = _new_code()
+                if code not in seen:
+                    seen.add(code)
+                    candidates.append(code)
+            return candidates
+
+        minted = []
+        try:
+            remaining = count
+            while remaining > 0:
+                wanted = min(batch_size, remaining)
+                inserted = []
+                for _ in range(max_rounds):
+                    candidates = new_codes(wanted - len(inserted))
+                    # 每批一次查询排除已存在的兑换码，其余一次插入；并发插入同一个码时整批重新生成
+                    try:
+                        with self.engine.begin() as conn:
+                            existing = set(conn.execute(
+                                select(codes.c.code).where(codes.c.code.in_(candidates))
+                            ).scalars())
+                            fresh = [code for code in candidates if code not in existing]
+                            if fresh:
+                                conn.execute(insert(codes), [dict(values, code=code) for code in fresh])
+                                inserted.extend(_to_dict(row) for row in conn.execute(
+                                    select(*MINTED_FIELDS).where(codes.c.code.in_(fresh)).order_by(codes.c.id)
+                                ))
+                    except IntegrityError:
+                        continue
+                    if len(inserted) >= wanted:
+                        break
+                else:
+                    raise RuntimeError(f"兑换码冲突过多，已生成 {len(minted) + len(inserted)} 个")
+
+                remaining -= len(inserted)
+                minted.extend(row['code'] for row in inserted)
+                yield inserted
+        finally:
+            # 通知兑换码过滤器（生成中断时已插入的码同样需要加入）
+            from code_filter import code_filter
+            code_filter.added(minted)
+
+    def codes_page(self, limit=20, cursor=None, with_total=False):
+        query = select(*CODE_FIELDS)
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            query = query.where(codes.c.id < position[1])
+        query = query.order_by(codes.c.id.desc()).limit(limit + 1)
+
+        with self.read_engine.connect() as conn:
+            rows = [_to_dict(row) for row in conn.execute(query)]
+            total = conn.execute(select(func.count()).select_from(codes)).scalar() if with_total else None
+        items = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(items[-1]['created_at'], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor, 'total': total}
+
+    def used_codes_page(self, user_id, limit=20, cursor=None):
+        query = select(*USED_CODE_FIELDS).where(codes.c.used_by_user_id == user_id)
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            used_at, last_id = position
+            query = query.where(or_(codes.c.used_at < used_at, and_(codes.c.used_at == used_at, codes.c.id < last_id)))
+        query = query.order_by(codes.c.used_at.desc(), codes.c.id.desc()).limit(limit + 1)
+
+        with self.read_engine.connect() as conn:
+            rows = [_to_dict(row) for row in conn.execute(query)]
+        items = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(items[-1]['used_at'], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def iter_codes(self, page_size=1000):
+        # 按ID游标分页读取，每页使用一个短连接，遍历期间不长时间占用连接池
+        last_id = 0
+        while True:
+            with self.read_engine.connect() as conn:
+                rows = conn.execute(
+                    select(codes.c.id, codes.c.code).where(codes.c.id > last_id).order_by(codes.c.id).limit(page_size)
+                ).all()
+            for row in rows:
+                yield row.code
+            if len(rows) < page_size:
+                return
+            last_id = rows[-1].id
+
+    def max_code_id(self):
+        with self.read_engine.connect() as conn:
+            return conn.execute(select(func.max(codes.c.id))).scalar() or 0
+
+    def redeem_code(self, code, user_id):
+        now = datetime.now()
+        with self.engine.begin() as conn:
+            redeemed = conn.execute(
+                update(codes)
+                .where(codes.c.code == code, codes.c.is_used.is_(False),
+                       or_(codes.c.expires_at.is_(None), codes.c.expires_at >= now))
+                .values(is_used=True, used_by_user_id=user_id, used_at=now)
+                .returning(codes.c.credits_value, codes.c.description)
+            ).first()
+            if redeemed is None:
+                existing = conn.execute(select(codes.c.is_used).where(codes.c.code == code)).first()
+                if existing is None:
+                    return {'status': 'not_found'}
+                return {'status': 'used' if existing.is_used else 'expired'}
+
+            new_credits = conn.execute(
+                update(users).where(users.c.id == user_id)
+                .values(credits=users.c.credits + redeemed.credits_value)
+                .returning(users.c.credits)
+            ).scalar()
+            if new_credits is None:
+                # 抛出异常使兑换码的更新一起回滚
+                raise ValueError(f"用户不存在: {user_id}")
+            suffix = f" ({redeemed.description})" if redeemed.description else ''
+            conn.execute(insert(transactions).values(
+                user_id=user_id, transaction_type='recharge', credits_amount=redeemed.credits_value,
+                description=f"兑换码充值: {code}{suffix}"[:200], created_at=now
+            ))
+        user_cache.update(user_id, {'credits': new_credits})
+        return {'status': 'redeemed', 'credits_added': redeemed.credits_value, 'credits': new_credits}
+
+    # --- 积分流水 ---
+    def transactions_page(self, user_id, limit=20, cursor=None, with_total=False):
+        query = select(*PAGE_COLUMNS).where(transactions.c.user_id == user_id)
+        position = decode_cursor(cursor, 'datetime')
+        if position:
+            created_at, last_id = position
+            query = query.where(or_(
+                transactions.c.created_at < created_at,
+                and_(transactions.c.created_at == created_at, transactions.c.id > last_id)
+            ))
+        query = query.order_by(transactions.c.created_at.desc(), transactions.c.id).limit(limit + 1)
+
+        with self.read_engine.connect() as conn:
+            rows = [_to_dict(row) for row in conn.execute(query)]
+            total = None
+            if with_total:
+                total = conn.execute(
+                    select(func.count()).select_from(transactions).where(transactions.c.user_id == user_id)
+                ).scalar()
+
+        items = rows[:limit]
+        next_cursor = None
+        if len(rows) > limit:
+            next_cursor = encode_cursor(items[-1]['created_at'], items[-1]['id'])
+        return {'items': items, 'next_cursor': next_cursor, 'total': total}
+
+    def _ledger_balance(self, conn, user_id) -> int:
+        """按流水计算的余额（最近一次快照 + 之后的流水）"""
+        snapshot = conn.execute(
+            select(snapshots.c.balance, snapshots.c.last_transaction_id)
+            .where(snapshots.c.user_id == user_id)
+            .order_by(snapshots.c.last_transaction_id.desc()).limit(1)
+        ).first()
+        opening, after_id = (snapshot.balance, snapshot.last_transaction_id) if snapshot else (0, 0)
+        delta = conn.execute(
+            select(func.coalesce(func.sum(transactions.c.credits_amount), 0))
+            .where(transactions.c.user_id == user_id, transactions.c.id > after_id)
+        ).scalar()
+        return opening + delta
+
+    def ledger_balance(self, user_id):
+        with self.read_engine.connect() as conn:
+            return self._ledger_balance(conn, user_id)
+
+    def write_snapshots(self, settle_seconds=300):
+        # 与 write_credit_snapshots 数据库函数相同的计算（SQLite只有一个写连接，不需要咨询锁）
+        settled_before = datetime.now() - timedelta(seconds=settle_seconds)
+        with self.engine.begin() as conn:
+            # 上次快照边界以下的流水都已计入各用户的快照
+            from_id = conn.execute(select(func.coalesce(func.max(snapshots.c.last_transaction_id), 0))).scalar()
+            to_id = conn.execute(
+                select(func.min(transactions.c.id) - 1).where(transactions.c.created_at >= settled_before)
+            ).scalar()
+            if to_id is None:
+                to_id = conn.execute(select(func.coalesce(func.max(transactions.c.id), 0))).scalar()
+
+            deltas = conn.execute(
+                select(transactions.c.user_id,
+                       func.sum(transactions.c.credits_amount).label('delta'),
+                       func.max(transactions.c.id).label('last_id'))
+                .where(transactions.c.id > from_id, transactions.c.id <= to_id)
+                .group_by(transactions.c.user_id)
+            ).all()
+            if not deltas:
+                return 0
+
+            balances = {}
+            for row in conn.execute(
+                select(snapshots.c.user_id, snapshots.c.balance)
+                .where(snapshots.c.user_id.in_([d.user_id for d in deltas]))
+                .order_by(snapshots.c.last_transaction_id)
+            ):
+                balances[row.user_id] = row.balance  # 按边界升序，最后一次为最近的快照
+            conn.execute(insert(snapshots), [
+                {'user_id': d.user_id, 'balance': balances.get(d.user_id, 0) + d.delta, 'last_transaction_id': d.last_id}
+                for d in deltas
+            ])
+        return len(deltas)
+
+    def reconcile_credits(self, check_all=False, repair=False):
+        # 与 reconcile_credit_balances 数据库函数相同：默认只检查快照边界之后有流水的用户
+        query = select(users.c.id, users.c.credits)
+        if not check_all:
+            boundary = select(func.coalesce(func.max(snapshots.c.last_transaction_id), 0)).scalar_subquery()
+            query = query.where(users.c.id.in_(select(transactions.c.user_id).where(transactions.c.id > boundary)))
+        with self.read_engine.connect() as conn:
+            mismatches = []
+            for user_id, credits in conn.execute(query).all():
+                ledger_credits = self._ledger_balance(conn, user_id)
+                if ledger_credits != credits:
+                    mismatches.append({'user_id': user_id, 'credits': credits, 'ledger_credits': ledger_credits})
+
+        if repair:
+            for row in mismatches:
+                # 在写事务内重新计算，修复期间写入的流水也计入
+                with self.engine.begin() as conn:
+                    row['repaired_credits'] = conn.execute(
+                        update(users).where(users.c.id == row['user_id'])
+                        .values(credits=self._ledger_balance(conn, row['user_id'])).returning(users.c.credits)
+                    ).scalar()
+                user_cache.delete(row['user_id'])
+        return mismatches
+
+    # --- 统计 ---
+    def usage_summary(self):
+        # 可移植实现没有触发器维护的计数表，直接从基础表计算（已归档的流水取自归档清单）
+        with self.read_engine.connect() as conn:
+            user_count, total_credits = conn.execute(
+                select(func.count(), func.coalesce(func.sum(users.c.credits), 0)).select_from(users)
+            ).one()
+            code_count, used_codes = conn.execute(
+                select(func.count(), func.count().filter(codes.c.is_used.is_(True))).select_from(codes)
+            ).one()
+            transaction_count, generations = conn.execute(
+                select(func.count(), func.count().filter(GENERATION)).select_from(transactions)
+            ).one()
+            archived_rows, archived_generations = conn.execute(
+                select(func.coalesce(func.sum(archive_files.c.row_count), 0),
+                       func.coalesce(func.sum(archive_files.c.generations), 0))
+            ).one()
+        stats = {
+            'users': user_count,
+            'total_credits': total_credits,
+            'codes': code_count,
+            'used_codes': used_codes,
+            'transactions': transaction_count + archived_rows,
+            'generations': generations + archived_generations
+        }
+        return {name: int(stats[name]) for name in USAGE_COUNTERS}
+
+    def daily_usage(self, start, end):
+        since, until = datetime.combine(start, time.min), datetime.combine(end + timedelta(days=1), time.min)
+        days = defaultdict(lambda: {'generations': 0, 'credits_consumed': 0, 'redemptions': 0,
+                                    'credits_redeemed': 0, 'signups': 0})
+
+        def add(rows, *names):
+            for row in rows:
+                # SQLite的date()返回字符串，PostgreSQL返回日期
+                day = row[0].isoformat() if isinstance(row[0], date) else row[0]
+                for name, value in zip(names, row[1:]):
+                    days[day][name] += int(value or 0)
+
+        consumed_day = func.date(transactions.c.created_at)
+        redeemed_day = func.date(codes.c.used_at)
+        signup_day = func.date(users.c.created_at)
+        with self.read_engine.connect() as conn:
+            add(conn.execute(
+                select(consumed_day, func.count().filter(GENERATION), -func.sum(transactions.c.credits_amount))
+                .where(transactions.c.transaction_type.in_(CONSUME_TRANSACTIONS),
+                       transactions.c.created_at >= since, transactions.c.created_at < until)
+                .group_by(consumed_day)
+            ), 'generations', 'credits_consumed')
+            add(conn.execute(
+                select(archive_files.c.partition_date, func.sum(archive_files.c.generations),
+                       func.sum(archive_files.c.credits_consumed))
+                .where(archive_files.c.partition_date.between(start, end))
+                .group_by(archive_files.c.partition_date)
+            ), 'generations', 'credits_consumed')
+            add(conn.execute(
+                select(redeemed_day, func.count(), func.sum(codes.c.credits_value))
+                .where(codes.c.is_used.is_(True), codes.c.used_at >= since, codes.c.used_at < until)
+                .group_by(redeemed_day)
+            ), 'redemptions', 'credits_redeemed')
+            add(conn.execute(
+                select(signup_day, func.count())
+                .where(users.c.created_at >= since, users.c.created_at < until)
+                .group_by(signup_day)
+            ), 'signups')
+        return [dict(days[day], day=day) for day in sorted(days)]
+
+    def rebuild_usage_stats(self):
+        # 统计每次从基础表计算，没有需要重建的汇总
+        return self.usage_summary()
+
+    # --- 积分流水归档 ---
+    def archive_boundary(self, before):
+        with self.read_engine.connect() as conn:
+            snapshot_id = conn.execute(select(func.max(snapshots.c.last_transaction_id))).scalar()
+            # 按created_at索引读取before之前最后写入的流水；乱序提交而ID更大的少量流水留到下次归档
+            latest_id = conn.execute(
+                select(transactions.c.id).where(transactions.c.created_at < before)
+                .order_by(transactions.c.created_at.desc(), transactions.c.id.desc()).limit(1)
+            ).scalar()
+        if not snapshot_id or not latest_id:
+            return 0
+        return min(snapshot_id, latest_id)
+
+    def archivable_transactions(self, before, max_id, after_id=0, limit=1000):
+        query = select(*PAGE_COLUMNS).where(
+            transactions.c.id > after_id, transactions.c.id <= max_id, transactions.c.created_at < before
+        ).order_by(transactions.c.id).limit(limit)
+        with self.read_engine.connect() as conn:
+            return [_to_dict(row) for row in conn.execute(query)]
+
+    def archive_transactions(self, first_id, last_id, before, archives):
+        expected = sum(archive['row_count'] for archive in archives)
+        with self.engine.begin() as conn:
+            boundary = conn.execute(select(func.coalesce(func.max(snapshots.c.last_transaction_id), 0))).scalar()
+            if last_id > boundary:
+                raise RuntimeError(f"流水 {last_id} 尚未计入余额快照（快照边界 {boundary}）")
+
+            # 重新归档同一范围时覆盖原有清单
+            conn.execute(delete(archive_files).where(archive_files.c.path.in_([a['path'] for a in archives])))
+            conn.execute(insert(archive_files), [
+                dict(archive, partition_date=date.fromisoformat(archive['partition_date'])) for archive in archives
+            ])
+            deleted = conn.execute(delete(transactions).where(
+                transactions.c.id.between(first_id, last_id), transactions.c.created_at < before
+            )).rowcount
+            if deleted != expected:
+                raise RuntimeError(f"删除的流水数 {deleted} 与归档文件中的 {expected} 条不一致")
+        return deleted
+
+    def prune_snapshots(self, max_id):
+        newer = snapshots.alias('newer')
+        with self.engine.begin() as conn:
+            return conn.execute(delete(snapshots).where(
+                snapshots.c.last_transaction_id <= max_id,
+                select(newer.c.id).where(
+                    newer.c.user_id == snapshots.c.user_id,
+                    newer.c.last_transaction_id > snapshots.c.last_transaction_id
+                ).exists()
+            )).rowcount
+
+    def transaction_archives(self, start=None, end=None):
+        query = select(*ARCHIVE_FIELDS)
+        if start:
+            query = query.where(archive_files.c.partition_date >= start)
+        if end:
+            query = query.where(archive_files.c.partition_date <= end)
+        query = query.order_by(archive_files.c.partition_date, archive_files.c.first_transaction_id)
+        with self.read_engine.connect() as conn:
+            return [_to_dict(row) for row in conn.execute(query)]
+
+    # --- 导出 ---
+    def iter_pages(self, kind, filters=None, page_size=1000):
+        table, columns = EXPORT_FIELDS[kind]
+        conditions = [table.c[column] == value for column, value in (filters or {}).items()]
+        last_id = 0
+        while True:
+            # 每页使用一个短连接，导出期间不长时间占用连接池
+            with self.read_engine.connect() as conn:
+                page = [_to_dict(row) for row in conn.execute(
+                    select(*columns).where(table.c.id > last_id, *conditions).order_by(table.c.id).limit(page_size)
+                )]
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            last_id = page[-1]['id']
+
+    def ping(self):
+        try:
+            with self.read_engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            return True
+        except Exception as e:
+            logger.error(f"数据库连接检查失败: {e}")
+            return False
+
+    # --- 设置 ---
+    def get_setting(self, key):
+        cached = setting_cache.get(key)
+        if cached is not None:
+            return cached
+        with self.read_engine.connect() as conn:
+            value = conn.execute(select(settings.c.value).where(settings.c.key == key)).scalar()
+        if value is not None:
+            setting_cache.set(key, value)
+        return value
+
+    def set_setting(self, key, value):
+        with self.engine.begin() as conn:
+            updated = conn.execute(update(settings).where(settings.c.key == key).values(value=value)).rowcount
+            if not updated:
+                conn.execute(insert(settings).values(key=key, value=value))
+        setting_cache.delete(key)
+        return True
+
+
+class PostgresRepository(SqlRepository):
+    """直连PostgreSQL：积分操作调用数据库函数，一次往返完成（语义与Supabase RPC完全一致）"""
+
+    name = 'postgres'
+
+    def _call(self, sql: str, **params):
+        with self.engine.begin() as conn:
+            return conn.execute(text(sql), params).scalar()
+
+    def _call_rows(self, sql: str, **params) -> List[Dict[str, Any]]:
+        """调用返回TABLE的数据库函数"""
+        with self.engine.begin() as conn:
+            return [_to_dict(row) for row in conn.execute(text(sql), params)]
+
+    def _record_initial_credits(self, conn, created):
+        # 由 users_initial_credits 触发器写入
+        pass
+
+    def bulk_adjust_credits(self, user_ids, amount, transaction_type, description, username_prefix=None):
+        results = self._call_rows(
+            'SELECT * FROM bulk_adjust_credits(CAST(:user_ids AS INTEGER[]), :username_prefix, '
+            ':amount, :transaction_type, :description)',
+            user_ids=list(user_ids), username_prefix=username_prefix or None, amount=amount,
+            transaction_type=transaction_type, description=description
+        )
+        for row in results:
+            if row['status'] == 'applied':
+                user_cache.update(row['user_id'], {'credits': row['credits']})
+        return results
+
+    def adjust_credits(self, user_id, amount, transaction_type, description):
+        new_credits = self._call(
+            'SELECT adjust_credits(:user_id, :amount, :transaction_type, :description)',
+            user_id=user_id, amount=amount, transaction_type=transaction_type, description=description
+        )
+        if new_credits is not None:
+            user_cache.update(user_id, {'credits': new_credits})
+        return new_credits
+
+    def place_hold(self, user_id, amount, description, ttl_seconds, transaction_type='consume'):
+        return self._call('SELECT hold_credits(:user_id, :amount, :description, :ttl, :transaction_type)',
+                          user_id=user_id, amount=amount, description=description, ttl=ttl_seconds,
+                          transaction_type=transaction_type)
+
+    def release_hold(self, hold_id):
+        return bool(self._call('SELECT release_credit_hold(:hold_id)', hold_id=hold_id))
+
+    def capture_holds(self, hold_ids):
+        if not hold_ids:
+            return 0
+        return self._call('SELECT capture_credit_holds(:hold_ids)', hold_ids=list(hold_ids)) or 0
+
+    def release_holds(self, hold_ids):
+        if not hold_ids:
+            return 0
+        return self._call('SELECT release_credit_holds(:hold_ids)', hold_ids=list(hold_ids)) or 0
+
+    def expire_holds(self):
+        return self._call('SELECT expire_credit_holds()') or 0
+
+    def redeem_code(self, code, user_id):
+        outcome = self._call('SELECT redeem_code(:code, :user_id)', code=code, user_id=user_id)
+        if outcome.get('status') == 'redeemed':
+            user_cache.update(user_id, {'credits': outcome['credits']})
+        return outcome
+
+    def ledger_balance(self, user_id):
+        return self._call('SELECT credit_ledger_balance(:user_id)', user_id=user_id) or 0
+
+    def reconcile_credits(self, check_all=False, repair=False):
+        mismatches = self._call_rows('SELECT * FROM reconcile_credit_balances(:check_all)', check_all=check_all)
+        if repair:
+            for row in mismatches:
+                row['repaired_credits'] = self._call('SELECT repair_credit_balance(:user_id)', user_id=row['user_id'])
+                user_cache.delete(row['user_id'])
+        return mismatches
+
+    def usage_summary(self):
+        data = self._call('SELECT get_app_stats()') or {}
+        return {name: int(data.get(name) or 0) for name in USAGE_COUNTERS}
+
+    def daily_usage(self, start, end):
+        return self._call_rows('SELECT * FROM get_daily_usage(:start, :end)', start=start, end=end)
+
+    def rebuild_usage_stats(self):
+        data = self._call('SELECT rebuild_usage_stats()') or {}
+        return {name: int(data.get(name) or 0) for name in USAGE_COUNTERS}
+
+    def write_snapshots(self, settle_seconds=300):
+        return self._call('SELECT write_credit_snapshots(:settle_seconds)', settle_seconds=settle_seconds) or 0
+
+    def archive_transactions(self, first_id, last_id, before, archives):
+        return self._call(
+            'SELECT archive_credit_transactions(:first_id, :last_id, :before, CAST(:archives AS JSONB))',
+            first_id=first_id, last_id=last_id, before=before, archives=json.dumps(archives)
+        ) or 0
+
+    def prune_snapshots(self, max_id):
+        return self._call('SELECT prune_credit_snapshots(:max_id)', max_id=max_id) or 0
+
+    def batch_update_last_login(self, updates):
+        if not updates:
+            return 0
+        return self._call('SELECT batch_update_last_login(CAST(:updates AS JSONB))',
+                          updates=json.dumps(updates)) or 0
+
+
+def create_sql_repository(database_url: Optional[str]) -> SqlRepository:
+    """按连接地址创建直连后端（postgresql:// 使用数据库函数，其余使用可移植实现）"""
+    if not database_url:
+        raise ValueError("直连后端需要设置 REPOSITORY_DATABASE_URL 或 DATABASE_URL")
+    if database_url.startswith('postgres'):
+        engine = create_engine(
+            database_url.replace('postgres://', 'postgresql://', 1),
+            pool_size=REPOSITORY_POOL_SIZE,
+            max_overflow=REPOSITORY_MAX_OVERFLOW,
+            pool_pre_ping=True,
+            pool_recycle=3600
+        )
+        return PostgresRepository(engine)
+    if database_url.startswith('sqlite'):
+        from sqlite_engine import create_sqlite_engines, WalCheckpointJob, SQLITE_CHECKPOINT_SECONDS
+        writer, reader = create_sqlite_engines(database_url)
+        # 单机模式首次启动时建表（已存在的表不受影响）
+        User.metadata.create_all(writer)
+        repository = SqlRepository(writer, reader)
+        repository.checkpoint_job = WalCheckpointJob(writer, SQLITE_CHECKPOINT_SECONDS)
+        return repository
+    return SqlRepository(create_engine(database_url, pool_pre_ping=True))
@@ -0,0 +1,9 @@
+-- 001: 用户令牌版本
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 修改密码、重置密码或禁用用户时递增 token_version，旧令牌随即失效
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS token_version INTEGER DEFAULT 0 NOT NULL;
+
+-- 吊销列表只加载有吊销记录的用户
+CREATE INDEX IF NOT EXISTS idx_users_revoked
+    ON users(id) WHERE token_version > 0 OR is_active = FALSE;
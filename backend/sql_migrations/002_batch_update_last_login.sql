@@ -0,0 +1,22 @@
+-- 002: 批量更新最后登录时间
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 后台线程把缓冲的登录时间合并成一次调用，每个刷新周期只产生一条UPDATE语句
+
+CREATE OR REPLACE FUNCTION batch_update_last_login(updates JSONB)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH batch AS (
+        SELECT (item->>'id')::INTEGER AS id,
+               (item->>'last_login')::TIMESTAMP AS last_login
+        FROM jsonb_array_elements(updates) AS item
+    ), updated AS (
+        UPDATE users
+        SET last_login = batch.last_login
+        FROM batch
+        WHERE users.id = batch.id
+          AND (users.last_login IS NULL OR users.last_login < batch.last_login)
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM updated;
+$$;
@@ -0,0 +1,25 @@
+-- 003: 原子积分调整
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 一条语句内完成条件扣减/增加余额和写入交易记录，返回新余额；
+-- 用户不存在或余额不足时返回NULL。UPDATE持有行锁，并发扣减不会超扣
+
+CREATE OR REPLACE FUNCTION adjust_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_transaction_type VARCHAR,
+    p_description VARCHAR
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH updated AS (
+        UPDATE users
+        SET credits = credits + p_amount
+        WHERE id = p_user_id AND credits + p_amount >= 0
+        RETURNING id, credits
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, p_transaction_type, p_amount, p_description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
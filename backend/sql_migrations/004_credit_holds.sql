@@ -0,0 +1,151 @@
+-- 004: 积分预留（预留 / 结算 / 释放）
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 调用上游生成服务前先预留积分，成功后结算扣款，失败时释放；
+-- 未结算的预留超过 expires_at 后自动失效。可用余额 = credits - held_credits
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS held_credits INTEGER DEFAULT 0 NOT NULL;
+
+CREATE TABLE IF NOT EXISTS credit_holds (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    amount INTEGER NOT NULL CHECK (amount > 0),
+    status VARCHAR(10) DEFAULT 'held' NOT NULL,  -- held / captured / released / expired
+    description VARCHAR(200) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    settled_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_holds_user_held ON credit_holds(user_id) WHERE status = 'held';
+CREATE INDEX IF NOT EXISTS idx_credit_holds_expires_held ON credit_holds(expires_at) WHERE status = 'held';
+
+-- 扣减时不能动用已预留的积分
+CREATE OR REPLACE FUNCTION adjust_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_transaction_type VARCHAR,
+    p_description VARCHAR
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH updated AS (
+        UPDATE users
+        SET credits = credits + p_amount
+        WHERE id = p_user_id AND (p_amount >= 0 OR credits - held_credits + p_amount >= 0)
+        RETURNING id, credits
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, p_transaction_type, p_amount, p_description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
+
+-- 预留积分：先释放该用户已过期的预留，再在可用余额足够时增加held_credits；
+-- 返回预留ID，余额不足时返回NULL
+CREATE OR REPLACE FUNCTION place_credit_hold(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_expired INTEGER;
+    v_hold_id INTEGER;
+BEGIN
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE user_id = p_user_id AND status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING amount
+    )
+    SELECT COALESCE(SUM(amount), 0) INTO v_expired FROM expired;
+
+    UPDATE users
+    SET held_credits = held_credits - v_expired + p_amount
+    WHERE id = p_user_id AND credits - (held_credits - v_expired) >= p_amount;
+
+    IF NOT FOUND THEN
+        IF v_expired > 0 THEN
+            UPDATE users SET held_credits = held_credits - v_expired WHERE id = p_user_id;
+        END IF;
+        RETURN NULL;
+    END IF;
+
+    INSERT INTO credit_holds (user_id, amount, description, expires_at)
+    VALUES (p_user_id, p_amount, p_description, CURRENT_TIMESTAMP + make_interval(secs => p_ttl_seconds))
+    RETURNING id INTO v_hold_id;
+    RETURN v_hold_id;
+END;
+$$;
+
+-- 结算预留：扣除积分并写入交易记录，返回新余额；预留已结算/释放/过期时返回NULL
+CREATE OR REPLACE FUNCTION capture_credit_hold(p_hold_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = p_hold_id AND status = 'held'
+        RETURNING user_id, amount, description
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - captured.amount,
+            held_credits = users.held_credits - captured.amount
+        FROM captured
+        WHERE users.id = captured.user_id
+        RETURNING users.id, users.credits, captured.amount, captured.description
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, 'consume', -amount, description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
+
+-- 释放预留：返回是否释放成功
+CREATE OR REPLACE FUNCTION release_credit_hold(p_hold_id INTEGER)
+RETURNS BOOLEAN
+LANGUAGE sql
+AS $$
+    WITH released AS (
+        UPDATE credit_holds
+        SET status = 'released', settled_at = CURRENT_TIMESTAMP
+        WHERE id = p_hold_id AND status = 'held'
+        RETURNING user_id, amount
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - released.amount
+        FROM released
+        WHERE users.id = released.user_id
+        RETURNING users.id
+    )
+    SELECT EXISTS (SELECT 1 FROM updated);
+$$;
+
+-- 批量释放所有已过期的预留（定时任务），返回释放的预留数
+CREATE OR REPLACE FUNCTION expire_credit_holds()
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING user_id, amount
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount, COUNT(*) AS holds
+        FROM expired
+        GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    )
+    SELECT COALESCE(SUM(holds), 0)::INTEGER FROM per_user;
+$$;
@@ -0,0 +1,150 @@
+-- 005: 以积分流水为准的余额快照
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- credit_transactions 是只追加的积分流水，余额 = 最近一次快照 + 快照之后的流水之和；
+-- users.credits 是与流水在同一条语句中更新的余额投影，由对账函数检查并修复。
+-- 快照由后台任务定期写入，余额计算和对账只需扫描快照之后的少量流水
+
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_user_id_id ON credit_transactions(user_id, id);
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_created_at ON credit_transactions(created_at);
+
+CREATE TABLE IF NOT EXISTS credit_balance_snapshots (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    balance INTEGER NOT NULL,
+    last_transaction_id INTEGER NOT NULL,  -- 快照已包含的最后一条流水ID
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_snapshots_user
+    ON credit_balance_snapshots(user_id, last_transaction_id DESC);
+CREATE INDEX IF NOT EXISTS idx_credit_snapshots_last_transaction
+    ON credit_balance_snapshots(last_transaction_id);
+
+-- 已有用户以当前余额作为初始快照（注册赠送等历史上未记流水的积分由此计入）
+INSERT INTO credit_balance_snapshots (user_id, balance, last_transaction_id)
+SELECT u.id, u.credits, COALESCE(MAX(t.id), 0)
+FROM users u
+LEFT JOIN credit_transactions t ON t.user_id = u.id
+WHERE NOT EXISTS (SELECT 1 FROM credit_balance_snapshots s WHERE s.user_id = u.id)
+GROUP BY u.id, u.credits;
+
+-- 新用户的初始积分写入流水（注册、批量导入仍然只需一次INSERT）
+CREATE OR REPLACE FUNCTION record_initial_credits()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.credits <> 0 THEN
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        VALUES (NEW.id, 'signup', NEW.credits, '注册初始积分');
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS users_initial_credits ON users;
+CREATE TRIGGER users_initial_credits
+    AFTER INSERT ON users
+    FOR EACH ROW EXECUTE FUNCTION record_initial_credits();
+
+-- 按流水计算余额：最近一次快照 + 之后的流水
+CREATE OR REPLACE FUNCTION credit_ledger_balance(p_user_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+STABLE
+AS $$
+    WITH snapshot AS (
+        SELECT balance, last_transaction_id
+        FROM credit_balance_snapshots
+        WHERE user_id = p_user_id
+        ORDER BY last_transaction_id DESC
+        LIMIT 1
+    )
+    SELECT (
+        COALESCE((SELECT balance FROM snapshot), 0)
+        + COALESCE((
+            SELECT SUM(credits_amount)
+            FROM credit_transactions
+            WHERE user_id = p_user_id
+              AND id > COALESCE((SELECT last_transaction_id FROM snapshot), 0)
+        ), 0)
+    )::INTEGER;
+$$;
+
+-- 为有新流水的用户写入快照，返回写入数量
+-- 只包含 p_settle_seconds 之前写入的流水：ID按分配顺序递增，但并发事务可能乱序提交，
+-- 留出时间窗口保证快照边界以下的流水都已提交。多个worker同时调用时只有一个执行
+CREATE OR REPLACE FUNCTION write_credit_snapshots(p_settle_seconds INTEGER DEFAULT 300)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_from INTEGER;
+    v_to INTEGER;
+    v_count INTEGER;
+BEGIN
+    IF NOT pg_try_advisory_xact_lock(hashtext('write_credit_snapshots')) THEN
+        RETURN 0;
+    END IF;
+
+    -- 上次快照边界以下的流水都已计入各用户的快照
+    SELECT COALESCE(MAX(last_transaction_id), 0) INTO v_from FROM credit_balance_snapshots;
+    SELECT COALESCE(
+        (SELECT MIN(id) - 1 FROM credit_transactions
+         WHERE created_at >= CURRENT_TIMESTAMP - make_interval(secs => p_settle_seconds)),
+        (SELECT MAX(id) FROM credit_transactions),
+        0
+    ) INTO v_to;
+
+    INSERT INTO credit_balance_snapshots (user_id, balance, last_transaction_id)
+    SELECT deltas.user_id, COALESCE(latest.balance, 0) + deltas.delta, deltas.last_id
+    FROM (
+        SELECT t.user_id, SUM(t.credits_amount) AS delta, MAX(t.id) AS last_id
+        FROM credit_transactions t
+        WHERE t.id > v_from AND t.id <= v_to
+          AND t.id > COALESCE((
+              SELECT s.last_transaction_id FROM credit_balance_snapshots s
+              WHERE s.user_id = t.user_id
+              ORDER BY s.last_transaction_id DESC LIMIT 1
+          ), 0)
+        GROUP BY t.user_id
+    ) deltas
+    LEFT JOIN LATERAL (
+        SELECT s.balance FROM credit_balance_snapshots s
+        WHERE s.user_id = deltas.user_id
+        ORDER BY s.last_transaction_id DESC LIMIT 1
+    ) latest ON TRUE;
+
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+-- 对账：返回余额投影与流水不一致的用户
+-- 默认只检查上次快照之后有流水的用户，p_all = TRUE 时检查全部用户
+CREATE OR REPLACE FUNCTION reconcile_credit_balances(p_all BOOLEAN DEFAULT FALSE)
+RETURNS TABLE (user_id INTEGER, credits INTEGER, ledger_credits INTEGER)
+LANGUAGE sql
+STABLE
+AS $$
+    WITH candidates AS (
+        SELECT u.id, u.credits, credit_ledger_balance(u.id) AS ledger_credits
+        FROM users u
+        WHERE p_all OR u.id IN (
+            SELECT t.user_id FROM credit_transactions t
+            WHERE t.id > (SELECT COALESCE(MAX(last_transaction_id), 0) FROM credit_balance_snapshots)
+        )
+    )
+    SELECT id, credits, ledger_credits FROM candidates WHERE credits <> ledger_credits;
+$$;
+
+-- 按流水修复用户的余额投影，返回修复后的余额
+CREATE OR REPLACE FUNCTION repair_credit_balance(p_user_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    UPDATE users
+    SET credits = credit_ledger_balance(p_user_id)
+    WHERE id = p_user_id
+    RETURNING credits;
+$$;
@@ -0,0 +1,52 @@
+-- 006: 批量结算/释放积分预留
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 应用把结算/释放操作先写入本地发件箱，再由后台线程按批次一次RPC提交。
+-- 只处理状态仍为 held 的预留，重复提交同一批次不会重复扣款
+
+-- 批量结算：按用户合并扣减余额，每个预留写一条流水，返回结算的预留数
+CREATE OR REPLACE FUNCTION capture_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount, description
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM captured GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount,
+            held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, 'consume', -amount, description FROM captured
+    )
+    SELECT COUNT(*)::INTEGER FROM captured;
+$$;
+
+-- 批量释放：返回释放的预留数
+CREATE OR REPLACE FUNCTION release_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH released AS (
+        UPDATE credit_holds
+        SET status = 'released', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM released GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    )
+    SELECT COUNT(*)::INTEGER FROM released;
+$$;
@@ -0,0 +1,11 @@
+-- 007: 交易记录游标分页索引
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 交易记录按 (created_at DESC, id) 游标分页：WHERE user_id = ? AND (created_at, id) 在游标之后，
+-- 覆盖索引包含分页查询的全部列，流水只追加，可走仅索引扫描；每页代价与页码无关
+
+CREATE INDEX IF NOT EXISTS idx_credit_transactions_user_created
+    ON credit_transactions(user_id, created_at DESC, id)
+    INCLUDE (transaction_type, credits_amount, description);
+
+-- 新索引以user_id开头，单列索引不再需要
+DROP INDEX IF EXISTS idx_credit_transactions_user_id;
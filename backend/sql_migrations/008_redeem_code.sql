@@ -0,0 +1,49 @@
+-- 008: 原子兑换
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 一次调用内条件标记兑换码已使用（未使用且未过期）并增加积分、写入流水；
+-- 并发兑换同一个码时只有一个成功。失败时再读取一次兑换码以给出原因
+
+CREATE OR REPLACE FUNCTION redeem_code(p_code VARCHAR, p_user_id INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_code redemption_codes%ROWTYPE;
+    v_credits INTEGER;
+BEGIN
+    UPDATE redemption_codes
+    SET is_used = TRUE, used_by_user_id = p_user_id, used_at = CURRENT_TIMESTAMP
+    WHERE code = p_code
+      AND is_used = FALSE
+      AND (expires_at IS NULL OR expires_at > CURRENT_TIMESTAMP)
+    RETURNING * INTO v_code;
+
+    IF NOT FOUND THEN
+        SELECT * INTO v_code FROM redemption_codes WHERE code = p_code;
+        IF NOT FOUND THEN
+            RETURN jsonb_build_object('status', 'not_found');
+        ELSIF v_code.is_used THEN
+            RETURN jsonb_build_object('status', 'used');
+        END IF;
+        RETURN jsonb_build_object('status', 'expired');
+    END IF;
+
+    UPDATE users SET credits = credits + v_code.credits_value
+    WHERE id = p_user_id
+    RETURNING credits INTO v_credits;
+    IF NOT FOUND THEN
+        -- 回滚兑换码的更新
+        RAISE EXCEPTION 'user % not found', p_user_id;
+    END IF;
+
+    INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+    VALUES (p_user_id, 'recharge', v_code.credits_value,
+            LEFT('兑换码充值: ' || v_code.code || COALESCE(' (' || v_code.description || ')', ''), 200));
+
+    RETURN jsonb_build_object(
+        'status', 'redeemed',
+        'credits_added', v_code.credits_value,
+        'credits', v_credits
+    );
+END;
+$$;
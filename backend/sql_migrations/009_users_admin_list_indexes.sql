@@ -0,0 +1,17 @@
+-- 009: 管理后台用户列表的排序与搜索索引
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 用户列表按 (排序列, id) 游标分页，每种排序一个复合索引，翻页只读取一页的行；
+-- 用户名/邮箱搜索使用 ILIKE '%关键词%' / '关键词%'，普通B树索引用不上，改用pg_trgm三元组GIN索引
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING GIN (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING GIN (email gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_credits_id ON users(credits DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_last_login_id ON users(last_login DESC NULLS LAST, id DESC);
+
+-- username/email 的UNIQUE约束自带索引，原有的同名单列索引是重复的
+DROP INDEX IF EXISTS idx_users_username;
+DROP INDEX IF EXISTS idx_users_email;
@@ -0,0 +1,237 @@
+-- 010: 统计计数器与每日用量汇总
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 管理后台的统计原来每次加载都对 users / redemption_codes / credit_transactions 做全表COUNT/SUM。
+-- 改为由语句级触发器在写入时增量维护 app_stats 计数和 daily_usage 每日汇总，
+-- 计数按连接分片（pg_backend_pid() % 16）避免并发写入争抢同一行，读取时汇总各分片
+
+CREATE TABLE IF NOT EXISTS app_stats (
+    name VARCHAR(40) NOT NULL,
+    shard SMALLINT NOT NULL,
+    value BIGINT DEFAULT 0 NOT NULL,
+    PRIMARY KEY (name, shard)
+);
+
+CREATE TABLE IF NOT EXISTS daily_usage (
+    day DATE NOT NULL,
+    shard SMALLINT NOT NULL,
+    generations INTEGER DEFAULT 0 NOT NULL,
+    credits_consumed BIGINT DEFAULT 0 NOT NULL,
+    redemptions INTEGER DEFAULT 0 NOT NULL,
+    credits_redeemed BIGINT DEFAULT 0 NOT NULL,
+    signups INTEGER DEFAULT 0 NOT NULL,
+    PRIMARY KEY (day, shard)
+);
+
+CREATE OR REPLACE FUNCTION stats_shard()
+RETURNS SMALLINT
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT (pg_backend_pid() % 16)::SMALLINT;
+$$;
+
+-- 语句级触发器通过转换表一次汇总整条语句影响的行，批量导入和批量生成兑换码只更新一次计数
+CREATE OR REPLACE FUNCTION users_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM new_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+        INSERT INTO daily_usage (day, shard, signups)
+        SELECT created_at::date, stats_shard(), COUNT(*) FROM new_rows GROUP BY 1
+        ON CONFLICT (day, shard) DO UPDATE SET signups = daily_usage.signups + EXCLUDED.signups;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT 'total_credits', stats_shard(), delta
+        FROM (SELECT (SELECT COALESCE(SUM(credits), 0) FROM new_rows)
+                   - (SELECT COALESCE(SUM(credits), 0) FROM old_rows) AS delta) s
+        WHERE delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    ELSE
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), -d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM old_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION redemption_codes_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), d.delta
+        FROM (SELECT COUNT(*) AS codes, COUNT(*) FILTER (WHERE is_used) AS used FROM new_rows) s,
+             LATERAL (VALUES ('codes', s.codes), ('used_codes', s.used)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT 'used_codes', stats_shard(), delta
+        FROM (SELECT (SELECT COUNT(*) FROM new_rows WHERE is_used)
+                   - (SELECT COUNT(*) FROM old_rows WHERE is_used) AS delta) s
+        WHERE delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+        -- 本条语句中由未使用变为已使用的兑换码，计入兑换当天
+        INSERT INTO daily_usage (day, shard, redemptions, credits_redeemed)
+        SELECT COALESCE(n.used_at, CURRENT_TIMESTAMP)::date, stats_shard(), COUNT(*), SUM(n.credits_value)
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.is_used AND NOT o.is_used
+        GROUP BY 1
+        ON CONFLICT (day, shard) DO UPDATE
+        SET redemptions = daily_usage.redemptions + EXCLUDED.redemptions,
+            credits_redeemed = daily_usage.credits_redeemed + EXCLUDED.credits_redeemed;
+    ELSE
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), -d.delta
+        FROM (SELECT COUNT(*) AS codes, COUNT(*) FILTER (WHERE is_used) AS used FROM old_rows) s,
+             LATERAL (VALUES ('codes', s.codes), ('used_codes', s.used)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 流水只追加：生成次数按“生成创作”的消费流水计数，消耗积分为全部消费流水之和
+CREATE OR REPLACE FUNCTION credit_transactions_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO app_stats (name, shard, value)
+    SELECT d.name, stats_shard(), d.delta
+    FROM (SELECT COUNT(*) AS transactions,
+                 COUNT(*) FILTER (WHERE transaction_type = 'consume' AND description LIKE '生成创作%') AS generations
+          FROM new_rows) s,
+         LATERAL (VALUES ('transactions', s.transactions), ('generations', s.generations)) AS d(name, delta)
+    WHERE d.delta <> 0
+    ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed)
+    SELECT created_at::date, stats_shard(),
+           COUNT(*) FILTER (WHERE description LIKE '生成创作%'),
+           -SUM(credits_amount)
+    FROM new_rows
+    WHERE transaction_type = 'consume'
+    GROUP BY 1
+    ON CONFLICT (day, shard) DO UPDATE
+    SET generations = daily_usage.generations + EXCLUDED.generations,
+        credits_consumed = daily_usage.credits_consumed + EXCLUDED.credits_consumed;
+    RETURN NULL;
+END;
+$$;
+
+-- 转换表触发器每个只能对应一种事件
+DROP TRIGGER IF EXISTS users_stats_insert ON users;
+CREATE TRIGGER users_stats_insert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_usage_stats();
+DROP TRIGGER IF EXISTS users_stats_update ON users;
+CREATE TRIGGER users_stats_update AFTER UPDATE ON users
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_usage_stats();
+DROP TRIGGER IF EXISTS users_stats_delete ON users;
+CREATE TRIGGER users_stats_delete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION users_usage_stats();
+
+DROP TRIGGER IF EXISTS redemption_codes_stats_insert ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_insert AFTER INSERT ON redemption_codes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+DROP TRIGGER IF EXISTS redemption_codes_stats_update ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_update AFTER UPDATE ON redemption_codes
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+DROP TRIGGER IF EXISTS redemption_codes_stats_delete ON redemption_codes;
+CREATE TRIGGER redemption_codes_stats_delete AFTER DELETE ON redemption_codes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION redemption_codes_usage_stats();
+
+DROP TRIGGER IF EXISTS credit_transactions_stats_insert ON credit_transactions;
+CREATE TRIGGER credit_transactions_stats_insert AFTER INSERT ON credit_transactions
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION credit_transactions_usage_stats();
+
+-- 仪表盘读取：各计数的分片汇总（最多16行 × 计数种类）
+CREATE OR REPLACE FUNCTION get_app_stats()
+RETURNS JSONB
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT COALESCE(jsonb_object_agg(name, total), '{}'::jsonb)
+    FROM (SELECT name, SUM(value) AS total FROM app_stats GROUP BY name) s;
+$$;
+
+-- 按天的用量序列（用于趋势图）
+CREATE OR REPLACE FUNCTION get_daily_usage(p_from DATE, p_to DATE)
+RETURNS TABLE (day DATE, generations BIGINT, credits_consumed BIGINT, redemptions BIGINT,
+               credits_redeemed BIGINT, signups BIGINT)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT d.day, SUM(d.generations), SUM(d.credits_consumed), SUM(d.redemptions),
+           SUM(d.credits_redeemed), SUM(d.signups)
+    FROM daily_usage d
+    WHERE d.day BETWEEN p_from AND p_to
+    GROUP BY d.day
+    ORDER BY d.day;
+$$;
+
+-- 从基础表重新计算全部计数和每日汇总（首次部署回填、或怀疑计数漂移时运行）
+-- 计算期间以SHARE模式锁定三张表，阻塞写入但不阻塞读取
+CREATE OR REPLACE FUNCTION rebuild_usage_stats()
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOCK TABLE users, redemption_codes, credit_transactions IN SHARE MODE;
+    DELETE FROM app_stats;
+    DELETE FROM daily_usage;
+
+    INSERT INTO app_stats (name, shard, value)
+    SELECT 'users', 0, COUNT(*) FROM users
+    UNION ALL SELECT 'total_credits', 0, COALESCE(SUM(credits), 0) FROM users
+    UNION ALL SELECT 'codes', 0, COUNT(*) FROM redemption_codes
+    UNION ALL SELECT 'used_codes', 0, COUNT(*) FROM redemption_codes WHERE is_used
+    UNION ALL SELECT 'transactions', 0, COUNT(*) FROM credit_transactions
+    UNION ALL SELECT 'generations', 0, COUNT(*) FROM credit_transactions
+              WHERE transaction_type = 'consume' AND description LIKE '生成创作%';
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed, redemptions, credits_redeemed, signups)
+    SELECT day, 0, SUM(generations), SUM(credits_consumed), SUM(redemptions), SUM(credits_redeemed), SUM(signups)
+    FROM (
+        SELECT created_at::date AS day,
+               COUNT(*) FILTER (WHERE description LIKE '生成创作%') AS generations,
+               -SUM(credits_amount) AS credits_consumed,
+               0 AS redemptions, 0 AS credits_redeemed, 0 AS signups
+        FROM credit_transactions WHERE transaction_type = 'consume' GROUP BY 1
+        UNION ALL
+        SELECT used_at::date, 0, 0, COUNT(*), SUM(credits_value), 0
+        FROM redemption_codes WHERE is_used AND used_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 0, 0, 0, 0, COUNT(*) FROM users GROUP BY 1
+    ) t
+    GROUP BY day;
+
+    RETURN get_app_stats();
+END;
+$$;
+
+-- 用现有数据回填计数和每日汇总
+SELECT rebuild_usage_stats();
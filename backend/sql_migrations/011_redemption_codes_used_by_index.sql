@@ -0,0 +1,8 @@
+-- 011: 用户已使用兑换码的分页索引
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 管理后台用户详情按 used_by_user_id 嵌入兑换码，并按 (used_at DESC, id DESC) 游标翻页；
+-- 原来没有该外键的索引，每次查看详情都要扫描整个兑换码表。未使用的兑换码不进入部分索引
+
+CREATE INDEX IF NOT EXISTS idx_redemption_codes_used_by
+    ON redemption_codes(used_by_user_id, used_at DESC, id DESC)
+    WHERE used_by_user_id IS NOT NULL;
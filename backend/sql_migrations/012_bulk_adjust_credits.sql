@@ -0,0 +1,51 @@
+-- 012: 批量积分调整
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 给整个班级发放积分原来需要逐个用户调用 adjust_credits（每次一到多次往返）；
+-- 改为一次RPC内完成集合UPDATE和多行流水INSERT，在同一事务中提交
+
+-- 批量积分调整：一次调用内对一组用户做一条集合UPDATE和一条多行流水INSERT，返回每个用户的结果
+-- 目标为 p_user_ids 与（p_username_prefix 非空时）该前缀的活跃用户的并集；
+-- 先按ID顺序锁定目标行，并发的批量调整不会互相死锁。扣减时余额不足的用户跳过，
+-- status 为 applied / insufficient / not_found
+CREATE OR REPLACE FUNCTION bulk_adjust_credits(
+    p_user_ids INTEGER[],
+    p_username_prefix VARCHAR,
+    p_amount INTEGER,
+    p_transaction_type VARCHAR,
+    p_description VARCHAR
+)
+RETURNS TABLE (user_id INTEGER, status TEXT, credits INTEGER)
+LANGUAGE sql
+AS $$
+    WITH targets AS (
+        SELECT DISTINCT target_id FROM (
+            SELECT unnest(COALESCE(p_user_ids, '{}'::INTEGER[])) AS target_id
+            UNION ALL
+            SELECT id FROM users
+            WHERE p_username_prefix IS NOT NULL AND p_username_prefix <> '' AND is_active
+              AND username LIKE replace(replace(replace(p_username_prefix, '\', '\\'), '%', '\%'), '_', '\_') || '%'
+        ) t
+    ), locked AS (
+        SELECT u.id FROM users u JOIN targets t ON t.target_id = u.id
+        ORDER BY u.id
+        FOR UPDATE OF u
+    ), updated AS (
+        UPDATE users u
+        SET credits = u.credits + p_amount
+        FROM locked l
+        WHERE u.id = l.id AND (p_amount >= 0 OR u.credits - u.held_credits + p_amount >= 0)
+        RETURNING u.id, u.credits
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, p_transaction_type, p_amount, p_description FROM updated
+    )
+    SELECT t.target_id,
+           CASE WHEN up.id IS NOT NULL THEN 'applied'
+                WHEN l.id IS NOT NULL THEN 'insufficient'
+                ELSE 'not_found' END,
+           up.credits
+    FROM targets t
+    LEFT JOIN updated up ON up.id = t.target_id
+    LEFT JOIN locked l ON l.id = t.target_id
+    ORDER BY t.target_id;
+$$;
@@ -0,0 +1,142 @@
+-- 013: 积分流水归档
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- credit_transactions 只追加，表和索引随时间无限增长。超过保留期的流水先计入余额快照，
+-- 再按日期写入压缩文件（见 ledger_archive.py），文件清单记录在 credit_transaction_archives 中，
+-- 随后从流水表删除。余额 = 最近一次快照 + 之后的流水，已归档的流水都在快照之内，余额和对账不受影响
+
+CREATE TABLE IF NOT EXISTS credit_transaction_archives (
+    id SERIAL PRIMARY KEY,
+    partition_date DATE NOT NULL,              -- 文件中流水的日期（created_at::date）
+    path VARCHAR(255) NOT NULL UNIQUE,         -- 相对于归档目录的路径
+    first_transaction_id INTEGER NOT NULL,
+    last_transaction_id INTEGER NOT NULL,
+    row_count INTEGER NOT NULL,
+    user_ids JSONB NOT NULL,                   -- 文件中出现的用户ID（按需读取时跳过无关文件）
+    generations INTEGER DEFAULT 0 NOT NULL,    -- 以下两列用于重建统计（rebuild_usage_stats）
+    credits_consumed BIGINT DEFAULT 0 NOT NULL,
+    bytes BIGINT NOT NULL,
+    sha256 VARCHAR(64) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_transaction_archives_date
+    ON credit_transaction_archives(partition_date);
+
+-- 记录一批已写入文件的流水并从流水表删除，返回删除数量（在同一事务中完成）
+-- 删除范围与读取时相同：p_first_id <= id <= p_last_id 且 created_at < p_before；
+-- 范围超出快照边界、或删除数量与文件中的行数不一致时回滚，流水保持原样
+CREATE OR REPLACE FUNCTION archive_credit_transactions(
+    p_first_id INTEGER,
+    p_last_id INTEGER,
+    p_before TIMESTAMP,
+    p_archives JSONB
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_boundary INTEGER;
+    v_expected INTEGER;
+    v_deleted INTEGER;
+BEGIN
+    SELECT COALESCE(MAX(last_transaction_id), 0) INTO v_boundary FROM credit_balance_snapshots;
+    IF p_last_id > v_boundary THEN
+        RAISE EXCEPTION '流水 % 尚未计入余额快照（快照边界 %）', p_last_id, v_boundary;
+    END IF;
+
+    INSERT INTO credit_transaction_archives (partition_date, path, first_transaction_id, last_transaction_id,
+                                             row_count, user_ids, generations, credits_consumed, bytes, sha256)
+    SELECT a.partition_date, a.path, a.first_transaction_id, a.last_transaction_id,
+           a.row_count, a.user_ids, a.generations, a.credits_consumed, a.bytes, a.sha256
+    FROM jsonb_to_recordset(p_archives) AS a(
+        partition_date DATE, path VARCHAR, first_transaction_id INTEGER, last_transaction_id INTEGER,
+        row_count INTEGER, user_ids JSONB, generations INTEGER, credits_consumed BIGINT, bytes BIGINT, sha256 VARCHAR
+    )
+    ON CONFLICT (path) DO UPDATE
+    SET first_transaction_id = EXCLUDED.first_transaction_id,
+        last_transaction_id = EXCLUDED.last_transaction_id,
+        row_count = EXCLUDED.row_count,
+        user_ids = EXCLUDED.user_ids,
+        generations = EXCLUDED.generations,
+        credits_consumed = EXCLUDED.credits_consumed,
+        bytes = EXCLUDED.bytes,
+        sha256 = EXCLUDED.sha256,
+        created_at = CURRENT_TIMESTAMP;
+
+    SELECT COALESCE(SUM((a ->> 'row_count')::INTEGER), 0) INTO v_expected
+    FROM jsonb_array_elements(p_archives) a;
+
+    DELETE FROM credit_transactions
+    WHERE id BETWEEN p_first_id AND p_last_id AND created_at < p_before;
+    GET DIAGNOSTICS v_deleted = ROW_COUNT;
+
+    IF v_deleted <> v_expected THEN
+        RAISE EXCEPTION '删除的流水数 % 与归档文件中的 % 条不一致', v_deleted, v_expected;
+    END IF;
+    RETURN v_deleted;
+END;
+$$;
+
+-- 删除已被更新快照取代的旧快照（只保留每个用户最近一次），返回删除数量
+-- 余额计算和快照写入只使用每个用户最近一次快照
+CREATE OR REPLACE FUNCTION prune_credit_snapshots(p_max_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH pruned AS (
+        DELETE FROM credit_balance_snapshots s
+        WHERE s.last_transaction_id <= p_max_id
+          AND EXISTS (
+              SELECT 1 FROM credit_balance_snapshots n
+              WHERE n.user_id = s.user_id AND n.last_transaction_id > s.last_transaction_id
+          )
+        RETURNING 1
+    )
+    SELECT COUNT(*)::INTEGER FROM pruned;
+$$;
+
+-- 重建统计时计入已归档的流水（归档文件的行数、生成次数和消耗积分记录在清单中）
+CREATE OR REPLACE FUNCTION rebuild_usage_stats()
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOCK TABLE users, redemption_codes, credit_transactions, credit_transaction_archives IN SHARE MODE;
+    DELETE FROM app_stats;
+    DELETE FROM daily_usage;
+
+    INSERT INTO app_stats (name, shard, value)
+    SELECT 'users', 0, COUNT(*) FROM users
+    UNION ALL SELECT 'total_credits', 0, COALESCE(SUM(credits), 0) FROM users
+    UNION ALL SELECT 'codes', 0, COUNT(*) FROM redemption_codes
+    UNION ALL SELECT 'used_codes', 0, COUNT(*) FROM redemption_codes WHERE is_used
+    UNION ALL SELECT 'transactions', 0,
+              (SELECT COUNT(*) FROM credit_transactions)
+              + (SELECT COALESCE(SUM(row_count), 0) FROM credit_transaction_archives)
+    UNION ALL SELECT 'generations', 0,
+              (SELECT COUNT(*) FROM credit_transactions
+               WHERE transaction_type = 'consume' AND description LIKE '生成创作%')
+              + (SELECT COALESCE(SUM(generations), 0) FROM credit_transaction_archives);
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed, redemptions, credits_redeemed, signups)
+    SELECT day, 0, SUM(generations), SUM(credits_consumed), SUM(redemptions), SUM(credits_redeemed), SUM(signups)
+    FROM (
+        SELECT created_at::date AS day,
+               COUNT(*) FILTER (WHERE description LIKE '生成创作%') AS generations,
+               -SUM(credits_amount) AS credits_consumed,
+               0 AS redemptions, 0 AS credits_redeemed, 0 AS signups
+        FROM credit_transactions WHERE transaction_type = 'consume' GROUP BY 1
+        UNION ALL
+        SELECT partition_date, SUM(generations), SUM(credits_consumed), 0, 0, 0
+        FROM credit_transaction_archives GROUP BY 1
+        UNION ALL
+        SELECT used_at::date, 0, 0, COUNT(*), SUM(credits_value), 0
+        FROM redemption_codes WHERE is_used AND used_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 0, 0, 0, 0, COUNT(*) FROM users GROUP BY 1
+    ) t
+    GROUP BY day;
+
+    RETURN get_app_stats();
+END;
+$$;
@@ -0,0 +1,16 @@
+-- 014: 原子启用/禁用用户
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 禁用用户原来先读取 token_version 再写回加1后的值，两次请求之间并发的修改密码会被覆盖；
+-- 改为一条UPDATE内完成状态修改和令牌版本递增
+
+-- 启用/禁用用户，禁用时令牌版本加1；返回更新后的用户（不含密码哈希），用户不存在时返回NULL
+CREATE OR REPLACE FUNCTION set_user_active(p_user_id INTEGER, p_is_active BOOLEAN)
+RETURNS JSONB
+LANGUAGE sql
+AS $$
+    UPDATE users
+    SET is_active = p_is_active,
+        token_version = CASE WHEN p_is_active THEN token_version ELSE token_version + 1 END
+    WHERE id = p_user_id
+    RETURNING to_jsonb(users) - 'password_hash';
+$$;
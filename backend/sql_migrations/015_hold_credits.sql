@@ -0,0 +1,67 @@
+-- 015: 预留积分时返回余额
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- place_credit_hold 只返回预留ID，接口响应中的余额只能取自缓存的用户信息（可能已过期），
+-- 余额不足时还要再查询一次可用余额；hold_credits 在同一次调用中返回预留后的余额
+
+-- 预留积分：先释放该用户已过期的预留，再在可用余额足够时增加held_credits；
+-- 返回 {'hold_id', 'credits', 'held_credits'}（预留后的余额，余额不足时hold_id为NULL），用户不存在时返回NULL
+CREATE OR REPLACE FUNCTION hold_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_expired INTEGER;
+    v_hold_id INTEGER;
+    v_credits INTEGER;
+    v_held INTEGER;
+BEGIN
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE user_id = p_user_id AND status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING amount
+    )
+    SELECT COALESCE(SUM(amount), 0) INTO v_expired FROM expired;
+
+    UPDATE users
+    SET held_credits = held_credits - v_expired + p_amount
+    WHERE id = p_user_id AND credits - (held_credits - v_expired) >= p_amount
+    RETURNING credits, held_credits INTO v_credits, v_held;
+
+    IF NOT FOUND THEN
+        IF v_expired > 0 THEN
+            UPDATE users SET held_credits = held_credits - v_expired WHERE id = p_user_id
+            RETURNING credits, held_credits INTO v_credits, v_held;
+        ELSE
+            SELECT credits, held_credits INTO v_credits, v_held FROM users WHERE id = p_user_id;
+        END IF;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN jsonb_build_object('hold_id', NULL, 'credits', v_credits, 'held_credits', v_held);
+    END IF;
+
+    INSERT INTO credit_holds (user_id, amount, description, expires_at)
+    VALUES (p_user_id, p_amount, p_description, CURRENT_TIMESTAMP + make_interval(secs => p_ttl_seconds))
+    RETURNING id INTO v_hold_id;
+    RETURN jsonb_build_object('hold_id', v_hold_id, 'credits', v_credits, 'held_credits', v_held);
+END;
+$$;
+
+-- 旧版接口：只返回预留ID，余额不足时返回NULL
+CREATE OR REPLACE FUNCTION place_credit_hold(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER
+)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    SELECT (hold_credits(p_user_id, p_amount, p_description, p_ttl_seconds) ->> 'hold_id')::INTEGER;
+$$;
@@ -0,0 +1,67 @@
+-- 016: 结算已过期但未结算的积分预留
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 结算操作经本地发件箱延迟提交（见 ledger_outbox.py），数据库不可用或发件箱积压超过 CREDIT_HOLD_TTL 时，
+-- 预留在结算前已过期，原来的批量结算只处理状态为 held 的预留，生成结果已交付却不扣款
+
+-- 批量结算：按用户合并扣减余额，每个预留写一条流水，返回结算的预留数
+-- 发件箱提交晚于预留有效期时预留已被标记为expired（held_credits已退回），这类从未结算的预留同样结算：
+-- 可用余额足够时直接扣减credits；不足时保持expired，由调用方按返回数量记录差额
+CREATE OR REPLACE FUNCTION capture_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_held INTEGER;
+    v_expired INTEGER;
+BEGIN
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount, description
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM captured GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount,
+            held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, 'consume', -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_held FROM captured;
+
+    -- 先锁定过期预留，重复提交同一批次时只有一个事务能结算
+    PERFORM 1 FROM credit_holds
+    WHERE id = ANY(p_hold_ids) AND status = 'expired'
+    ORDER BY id
+    FOR UPDATE;
+
+    WITH per_user AS (
+        SELECT user_id, SUM(amount) AS amount
+        FROM credit_holds
+        WHERE id = ANY(p_hold_ids) AND status = 'expired'
+        GROUP BY user_id
+    ), charged AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id AND users.credits - users.held_credits >= per_user.amount
+        RETURNING users.id
+    ), captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'expired' AND user_id IN (SELECT id FROM charged)
+        RETURNING user_id, amount, description
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, 'consume', -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_expired FROM captured;
+
+    RETURN v_held + v_expired;
+END;
+$$;
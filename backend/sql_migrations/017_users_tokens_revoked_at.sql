@@ -0,0 +1,28 @@
+-- 017: 令牌吊销时间
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 吊销列表原来加载所有 token_version > 0 或已禁用的用户，随改过密码的用户数无限增长，
+-- 且Supabase单次最多返回1000行，超出部分被静默丢弃。令牌版本递增或禁用用户时记录吊销时间，
+-- 吊销列表只加载访问令牌有效期内的吊销（更早签发的旧令牌都已过期）
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS tokens_revoked_at TIMESTAMP;
+
+-- 已有的吊销记录从现在起再保留一个令牌有效期
+UPDATE users SET tokens_revoked_at = CURRENT_TIMESTAMP
+WHERE tokens_revoked_at IS NULL AND (token_version > 0 OR is_active = FALSE);
+
+DROP INDEX IF EXISTS idx_users_revoked;
+CREATE INDEX IF NOT EXISTS idx_users_tokens_revoked_at
+    ON users(tokens_revoked_at, id) WHERE tokens_revoked_at IS NOT NULL;
+
+-- 启用/禁用用户，禁用时令牌版本加1并记录吊销时间；返回更新后的用户（不含密码哈希），用户不存在时返回NULL
+CREATE OR REPLACE FUNCTION set_user_active(p_user_id INTEGER, p_is_active BOOLEAN)
+RETURNS JSONB
+LANGUAGE sql
+AS $$
+    UPDATE users
+    SET is_active = p_is_active,
+        token_version = CASE WHEN p_is_active THEN token_version ELSE token_version + 1 END,
+        tokens_revoked_at = CASE WHEN p_is_active THEN tokens_revoked_at ELSE CURRENT_TIMESTAMP END
+    WHERE id = p_user_id
+    RETURNING to_jsonb(users) - 'password_hash';
+$$;
@@ -0,0 +1,291 @@
+-- 018: 生成创作使用独立的交易类型，总积分计数随流水维护
+-- 在Supabase SQL编辑器中对已有数据库运行此脚本（新库直接使用 create_tables.sql）
+-- 生成次数原来按 description LIKE '生成创作%' 识别，依赖描述文案；改为预留时记录交易类型，
+-- 结算生成创作的预留时写入 transaction_type = 'generation' 的流水，统计按类型计数。
+-- users 上的语句级 UPDATE 触发器原来在每次更新用户（预留、结算、登录时间）时都写一次 app_stats，
+-- 改为由写入流水的触发器维护 total_credits：积分函数修改余额时都在同一条语句中写入流水
+
+-- 预留记录结算时写入的交易类型
+ALTER TABLE credit_holds ADD COLUMN IF NOT EXISTS transaction_type VARCHAR(20) DEFAULT 'consume' NOT NULL;
+
+-- 回填：已有的生成创作流水和尚未结算的生成预留
+UPDATE credit_transactions SET transaction_type = 'generation'
+WHERE transaction_type = 'consume' AND description LIKE '生成创作%';
+UPDATE credit_holds SET transaction_type = 'generation'
+WHERE status IN ('held', 'expired') AND description LIKE '生成创作%';
+
+-- 参数列表变化，先删除旧函数（否则新增带默认值的参数会产生有歧义的重载）
+DROP FUNCTION IF EXISTS hold_credits(INTEGER, INTEGER, VARCHAR, INTEGER);
+
+-- 预留积分：先释放该用户已过期的预留，再在可用余额足够时增加held_credits；
+-- 返回 {'hold_id', 'credits', 'held_credits'}（预留后的余额，余额不足时hold_id为NULL），用户不存在时返回NULL
+-- p_transaction_type 为结算时写入流水的类型（生成创作为 generation）
+CREATE OR REPLACE FUNCTION hold_credits(
+    p_user_id INTEGER,
+    p_amount INTEGER,
+    p_description VARCHAR,
+    p_ttl_seconds INTEGER,
+    p_transaction_type VARCHAR DEFAULT 'consume'
+)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_expired INTEGER;
+    v_hold_id INTEGER;
+    v_credits INTEGER;
+    v_held INTEGER;
+BEGIN
+    WITH expired AS (
+        UPDATE credit_holds
+        SET status = 'expired', settled_at = CURRENT_TIMESTAMP
+        WHERE user_id = p_user_id AND status = 'held' AND expires_at < CURRENT_TIMESTAMP
+        RETURNING amount
+    )
+    SELECT COALESCE(SUM(amount), 0) INTO v_expired FROM expired;
+
+    UPDATE users
+    SET held_credits = held_credits - v_expired + p_amount
+    WHERE id = p_user_id AND credits - (held_credits - v_expired) >= p_amount
+    RETURNING credits, held_credits INTO v_credits, v_held;
+
+    IF NOT FOUND THEN
+        IF v_expired > 0 THEN
+            UPDATE users SET held_credits = held_credits - v_expired WHERE id = p_user_id
+            RETURNING credits, held_credits INTO v_credits, v_held;
+        ELSE
+            SELECT credits, held_credits INTO v_credits, v_held FROM users WHERE id = p_user_id;
+        END IF;
+        IF NOT FOUND THEN
+            RETURN NULL;
+        END IF;
+        RETURN jsonb_build_object('hold_id', NULL, 'credits', v_credits, 'held_credits', v_held);
+    END IF;
+
+    INSERT INTO credit_holds (user_id, amount, description, transaction_type, expires_at)
+    VALUES (p_user_id, p_amount, p_description, p_transaction_type,
+            CURRENT_TIMESTAMP + make_interval(secs => p_ttl_seconds))
+    RETURNING id INTO v_hold_id;
+    RETURN jsonb_build_object('hold_id', v_hold_id, 'credits', v_credits, 'held_credits', v_held);
+END;
+$$;
+
+-- 结算预留：扣除积分并写入交易记录，返回新余额；预留已结算/释放/过期时返回NULL
+CREATE OR REPLACE FUNCTION capture_credit_hold(p_hold_id INTEGER)
+RETURNS INTEGER
+LANGUAGE sql
+AS $$
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = p_hold_id AND status = 'held'
+        RETURNING user_id, amount, description, transaction_type
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - captured.amount,
+            held_credits = users.held_credits - captured.amount
+        FROM captured
+        WHERE users.id = captured.user_id
+        RETURNING users.id, users.credits, captured.amount, captured.description, captured.transaction_type
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT id, transaction_type, -amount, description FROM updated
+    )
+    SELECT credits FROM updated;
+$$;
+
+-- 批量结算：按用户合并扣减余额，每个预留按其交易类型写一条流水，返回结算的预留数
+-- 发件箱提交晚于预留有效期时预留已被标记为expired（held_credits已退回），这类从未结算的预留同样结算：
+-- 可用余额足够时直接扣减credits；不足时保持expired，由调用方按返回数量记录差额
+CREATE OR REPLACE FUNCTION capture_credit_holds(p_hold_ids INTEGER[])
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_held INTEGER;
+    v_expired INTEGER;
+BEGIN
+    WITH captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'held'
+        RETURNING user_id, amount, description, transaction_type
+    ), per_user AS (
+        SELECT user_id, SUM(amount) AS amount FROM captured GROUP BY user_id
+    ), updated AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount,
+            held_credits = users.held_credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id
+        RETURNING users.id
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, transaction_type, -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_held FROM captured;
+
+    -- 先锁定过期预留，重复提交同一批次时只有一个事务能结算
+    PERFORM 1 FROM credit_holds
+    WHERE id = ANY(p_hold_ids) AND status = 'expired'
+    ORDER BY id
+    FOR UPDATE;
+
+    WITH per_user AS (
+        SELECT user_id, SUM(amount) AS amount
+        FROM credit_holds
+        WHERE id = ANY(p_hold_ids) AND status = 'expired'
+        GROUP BY user_id
+    ), charged AS (
+        UPDATE users
+        SET credits = users.credits - per_user.amount
+        FROM per_user
+        WHERE users.id = per_user.user_id AND users.credits - users.held_credits >= per_user.amount
+        RETURNING users.id
+    ), captured AS (
+        UPDATE credit_holds
+        SET status = 'captured', settled_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(p_hold_ids) AND status = 'expired' AND user_id IN (SELECT id FROM charged)
+        RETURNING user_id, amount, description, transaction_type
+    ), ledger AS (
+        INSERT INTO credit_transactions (user_id, transaction_type, credits_amount, description)
+        SELECT user_id, transaction_type, -amount, description FROM captured
+    )
+    SELECT COUNT(*) INTO v_expired FROM captured;
+
+    RETURN v_held + v_expired;
+END;
+$$;
+
+-- 按流水修复用户的余额投影，返回修复后的余额；修复不写流水，差额直接计入 total_credits
+CREATE OR REPLACE FUNCTION repair_credit_balance(p_user_id INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_previous INTEGER;
+    v_credits INTEGER;
+BEGIN
+    SELECT credits INTO v_previous FROM users WHERE id = p_user_id FOR UPDATE;
+    UPDATE users
+    SET credits = credit_ledger_balance(p_user_id)
+    WHERE id = p_user_id
+    RETURNING credits INTO v_credits;
+
+    IF v_credits <> v_previous THEN
+        INSERT INTO app_stats (name, shard, value)
+        VALUES ('total_credits', stats_shard(), v_credits - v_previous)
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN v_credits;
+END;
+$$;
+
+-- 用户的插入和删除维护用户数和 total_credits；余额的变化由流水触发器计入
+DROP TRIGGER IF EXISTS users_stats_update ON users;
+
+CREATE OR REPLACE FUNCTION users_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM new_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+        INSERT INTO daily_usage (day, shard, signups)
+        SELECT created_at::date, stats_shard(), COUNT(*) FROM new_rows GROUP BY 1
+        ON CONFLICT (day, shard) DO UPDATE SET signups = daily_usage.signups + EXCLUDED.signups;
+    ELSE
+        INSERT INTO app_stats (name, shard, value)
+        SELECT d.name, stats_shard(), -d.delta
+        FROM (SELECT COUNT(*) AS users, COALESCE(SUM(credits), 0) AS credits FROM old_rows) s,
+             LATERAL (VALUES ('users', s.users), ('total_credits', s.credits)) AS d(name, delta)
+        WHERE d.delta <> 0
+        ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+-- 流水只追加：生成次数按 generation 类型的流水计数，消耗积分为 consume 和 generation 流水之和；
+-- total_credits 计入除注册初始积分以外的全部流水（初始积分由用户插入触发器计入）
+CREATE OR REPLACE FUNCTION credit_transactions_usage_stats()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    INSERT INTO app_stats (name, shard, value)
+    SELECT d.name, stats_shard(), d.delta
+    FROM (SELECT COUNT(*) AS transactions,
+                 COUNT(*) FILTER (WHERE transaction_type = 'generation') AS generations,
+                 COALESCE(SUM(credits_amount) FILTER (WHERE transaction_type <> 'signup'), 0) AS credits
+          FROM new_rows) s,
+         LATERAL (VALUES ('transactions', s.transactions), ('generations', s.generations),
+                         ('total_credits', s.credits)) AS d(name, delta)
+    WHERE d.delta <> 0
+    ON CONFLICT (name, shard) DO UPDATE SET value = app_stats.value + EXCLUDED.value;
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed)
+    SELECT created_at::date, stats_shard(),
+           COUNT(*) FILTER (WHERE transaction_type = 'generation'),
+           -SUM(credits_amount)
+    FROM new_rows
+    WHERE transaction_type IN ('consume', 'generation')
+    GROUP BY 1
+    ON CONFLICT (day, shard) DO UPDATE
+    SET generations = daily_usage.generations + EXCLUDED.generations,
+        credits_consumed = daily_usage.credits_consumed + EXCLUDED.credits_consumed;
+    RETURN NULL;
+END;
+$$;
+
+-- 从基础表重新计算全部计数和每日汇总（首次部署回填、或怀疑计数漂移时运行）
+-- 计算期间以SHARE模式锁定相关表，阻塞写入但不阻塞读取
+CREATE OR REPLACE FUNCTION rebuild_usage_stats()
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    LOCK TABLE users, redemption_codes, credit_transactions, credit_transaction_archives IN SHARE MODE;
+    DELETE FROM app_stats;
+    DELETE FROM daily_usage;
+
+    INSERT INTO app_stats (name, shard, value)
+    SELECT 'users', 0, COUNT(*) FROM users
+    UNION ALL SELECT 'total_credits', 0, COALESCE(SUM(credits), 0) FROM users
+    UNION ALL SELECT 'codes', 0, COUNT(*) FROM redemption_codes
+    UNION ALL SELECT 'used_codes', 0, COUNT(*) FROM redemption_codes WHERE is_used
+    UNION ALL SELECT 'transactions', 0,
+              (SELECT COUNT(*) FROM credit_transactions)
+              + (SELECT COALESCE(SUM(row_count), 0) FROM credit_transaction_archives)
+    UNION ALL SELECT 'generations', 0,
+              (SELECT COUNT(*) FROM credit_transactions WHERE transaction_type = 'generation')
+              + (SELECT COALESCE(SUM(generations), 0) FROM credit_transaction_archives);
+
+    INSERT INTO daily_usage (day, shard, generations, credits_consumed, redemptions, credits_redeemed, signups)
+    SELECT day, 0, SUM(generations), SUM(credits_consumed), SUM(redemptions), SUM(credits_redeemed), SUM(signups)
+    FROM (
+        SELECT created_at::date AS day,
+               COUNT(*) FILTER (WHERE transaction_type = 'generation') AS generations,
+               -SUM(credits_amount) AS credits_consumed,
+               0 AS redemptions, 0 AS credits_redeemed, 0 AS signups
+        FROM credit_transactions WHERE transaction_type IN ('consume', 'generation') GROUP BY 1
+        UNION ALL
+        SELECT partition_date, SUM(generations), SUM(credits_consumed), 0, 0, 0
+        FROM credit_transaction_archives GROUP BY 1
+        UNION ALL
+        SELECT used_at::date, 0, 0, COUNT(*), SUM(credits_value), 0
+        FROM redemption_codes WHERE is_used AND used_at IS NOT NULL GROUP BY 1
+        UNION ALL
+        SELECT created_at::date, 0, 0, 0, 0, COUNT(*) FROM users GROUP BY 1
+    ) t
+    GROUP BY day;
+
+    RETURN get_app_stats();
+END;
+$$;
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite单机模式
+小规模部署（一台服务器）设置 DATA_BACKEND=sqlite 后，数据保存在本地SQLite文件中，查询不经过网络。
+
+每个连接打开时设置：
+    journal_mode=WAL       读写互不阻塞，读操作不等待写事务
+    synchronous=NORMAL     WAL模式下提交时不再fsync，只在检查点落盘（断电可能丢失最近的提交，但不会损坏数据库）
+    mmap_size              通过内存映射读取数据库文件，减少系统调用和内存拷贝
+    busy_timeout           其他进程持有写锁时等待，而不是立即报 database is locked
+每个进程只有一个写连接，写事务以 BEGIN IMMEDIATE 开始，并发的写操作在连接池中排队，
+不会在读取之后升级写锁时失败；读操作使用只读连接池。后台线程定期执行WAL检查点，控制WAL文件大小
+"""
+import atexit
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import StaticPool
+
+logger = logging.getLogger(__name__)
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.getenv('SQLITE_CACHE_SIZE_KB', 16384))
+SQLITE_JOURNAL_SIZE_LIMIT = int(os.getenv('SQLITE_JOURNAL_SIZE_LIMIT', 64 * 1024 * 1024))
+SQLITE_READ_POOL_SIZE = int(os.getenv('SQLITE_READ_POOL_SIZE', 4))
+SQLITE_WRITE_TIMEOUT = float(os.getenv('SQLITE_WRITE_TIMEOUT', 30))
+SQLITE_CHECKPOINT_SECONDS = float(os.getenv('SQLITE_CHECKPOINT_SECONDS', 300))
+
+
+def apply_pragmas(dbapi_connection, readonly: bool = False) -> None:
+    """新建连接时设置PRAGMA"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}')
+        if not readonly:
+            # journal_mode会写入数据库文件，由写连接设置
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute(f'PRAGMA journal_size_limit={SQLITE_JOURNAL_SIZE_LIMIT}')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+        cursor.execute(f'PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA foreign_keys=ON')
+        if readonly:
+            cursor.execute('PRAGMA query_only=ON')
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine: Engine, readonly: bool = False, begin: Optional[str] = None) -> Engine:
+    """为引擎注册连接事件：设置PRAGMA，begin不为空时由SQLAlchemy发出BEGIN语句（如 BEGIN IMMEDIATE）"""
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, readonly)
+        if begin:
+            # 关闭驱动自身的事务管理，由下面的begin事件发出BEGIN
+            dbapi_connection.isolation_level = None
+
+    if begin:
+        @event.listens_for(engine, 'begin')
+        def on_begin(conn):
+            conn.exec_driver_sql(begin)
+
+    return engine
+
+
+def engine_options(pool_size: int = 3) -> Dict[str, Any]:
+    """Flask-SQLAlchemy使用SQLite时的引擎参数（PRAGMA由configure_engine设置）"""
+    return {
+        'connect_args': {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000},
+        'pool_size': pool_size,
+        'max_overflow': 0,
+        'pool_timeout': SQLITE_WRITE_TIMEOUT
+    }
+
+
+def create_sqlite_engines(database_url: str) -> Tuple[Engine, Engine]:
+    """创建 (写引擎, 读引擎)：写引擎只有一个连接，读引擎为只读连接池"""
+    url = make_url(database_url)
+    if url.database not in (None, '', ':memory:') and not os.path.isabs(url.database):
+        # 相对路径与Flask-SQLAlchemy一致，相对于应用的instance目录，两个引擎访问同一个文件
+        instance_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+        os.makedirs(instance_path, exist_ok=True)
+        url = url.set(database=os.path.join(instance_path, url.database))
+    connect_args = {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}
+
+    if url.database in (None, '', ':memory:'):
+        # 内存数据库只存在于单个连接中，读写共用
+        engine = create_engine(url, connect_args=connect_args, poolclass=StaticPool)
+        configure_engine(engine, begin='BEGIN IMMEDIATE')
+        return engine, engine
+
+    writer = configure_engine(create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=SQLITE_WRITE_TIMEOUT
+    ), begin='BEGIN IMMEDIATE')
+    # 先打开写连接，确保数据库已切换到WAL模式后再创建读连接
+    writer.connect().close()
+
+    # 读连接在一次 connect() 内使用同一个快照（BEGIN DEFERRED），多条查询的结果一致
+    reader = configure_engine(create_engine(
+        url,
+        connect_args=connect_args,
+        pool_size=SQLITE_READ_POOL_SIZE,
+        max_overflow=SQLITE_READ_POOL_SIZE
+    ), readonly=True, begin='BEGIN')
+    return writer, reader
+
+
+class WalCheckpointJob:
+    """定期执行WAL检查点
+
+    SQLite在WAL达到1000页时会自动检查点，但有持续读事务时可能一直无法完成，
+    这里在后台定期执行PASSIVE检查点（不阻塞读写），退出时执行TRUNCATE检查点清空WAL文件
+    """
+
+    def __init__(self, engine: Engine, interval: float = 300.0):
+        self.engine = engine
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.failed_runs = 0
+        self.last_result = None
+
+    def run_once(self, mode: str = 'PASSIVE') -> Optional[Tuple[int, int, int]]:
+        """执行一次检查点，返回 (是否被阻塞, WAL页数, 已写回页数)"""
+        try:
+            # 直接使用驱动连接（不经过BEGIN IMMEDIATE），检查点不能在事务内执行
+            conn = self.engine.raw_connection()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(f'PRAGMA wal_checkpoint({mode})')
+                result = tuple(cursor.fetchone())
+                cursor.close()
+            finally:
+                conn.close()
+        except Exception as e:
+            logger.error(f"SQLite检查点失败: {e}")
+            self.failed_runs += 1
+            return None
+
+        self.runs += 1
+        self.last_result = result
+        return result
+
+    def start(self) -> None:
+        """启动后台线程（interval为0时不启动）"""
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='sqlite-checkpoint', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.run_once()
+
+    def stop(self) -> None:
+        """停止后台线程并清空WAL文件"""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self.run_once('TRUNCATE')
+
+    def stats(self) -> Dict[str, Any]:
+        """检查点统计信息"""
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'failed_runs': self.failed_runs,
+            'last_result': self.last_result
+        }
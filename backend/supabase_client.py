@@ -5,23 +5,68 @@ Supabase客户端配置模块
 用于通过REST API操作数据库，绕过IPv6连接问题
 """
 
+import contextvars
 import os
-from supabase import create_client, Client
-from typing import Optional, Dict, Any, List
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+import httpx
+from supabase import create_client, Client, ClientOptions
+from postgrest.constants import DEFAULT_POSTGREST_CLIENT_TIMEOUT
+from postgrest.exceptions import APIError
+from typing import Optional, Dict, Any, Callable, List
 import logging
 from dotenv import load_dotenv
 
+from query_stats import InstrumentedClient
+
 # 确保加载环境变量
 load_dotenv()
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 各查询只读取需要的列，不使用 select('*')
+# users表的列（不含password_hash，用户缓存和接口返回都使用这一组）；只有登录和修改密码时才读取密码哈希
+USER_COLUMNS = 'id, username, email, credits, held_credits, is_active, token_version, created_at, last_login'
+CREDENTIAL_COLUMNS = f'{USER_COLUMNS}, password_hash'
+REDEMPTION_CODE_COLUMNS = 'id, code, credits_value, is_used, used_by_user_id, used_at, created_at, expires_at, description'
+
+def returning(query, columns: str):
+    """写操作（insert/update/upsert）只返回指定的列，而不是整行"""
+    query.params = query.params.set('select', columns)
+    return query
+
+class DuplicateKeyError(Exception):
+    """违反唯一约束（PostgreSQL错误码23505）"""
+    
+    def __init__(self, field: Optional[str], message: str = ''):
+        self.field = field
+        super().__init__(message or f"重复的字段: {field}")
+
+def raise_for_duplicate(error: APIError) -> None:
+    """唯一约束冲突时转换为DuplicateKeyError，其余错误原样忽略"""
+    if error.code != '23505':
+        return
+    # details形如: Key (username)=(alice) already exists.
+    match = re.search(r'Key \((\w+)\)=', error.details or '')
+    if not match:
+        # 退而从约束名推断，如 users_email_key
+        match = re.search(r'"\w+?_(\w+)_key"', error.message or '')
+    raise DuplicateKeyError(match.group(1) if match else None, error.message or '')
+
 class SupabaseManager:
     """Supabase客户端管理器"""
     
+    # 并发执行相互独立的REST请求的线程数（请求耗时主要在网络往返，线程等待时释放GIL）
+    CONCURRENCY = int(os.getenv('SUPABASE_CONCURRENCY', 8))
+    # HTTP连接池：所有线程共用一个客户端，空闲连接保持一段时间，避免重复TLS握手
+    MAX_CONNECTIONS = int(os.getenv('SUPABASE_MAX_CONNECTIONS', 20))
+    KEEPALIVE_SECONDS = float(os.getenv('SUPABASE_KEEPALIVE_SECONDS', 60))
+    
     def __init__(self):
         self.client: Optional[Client] = None
+        # 线程在首次提交任务时才创建
+        self._executor = ThreadPoolExecutor(max_workers=self.CONCURRENCY, thread_name_prefix='supabase')
         self._initialize_client()
     
     def _initialize_client(self):
@@ -35,8 +80,21 @@ class SupabaseManager:
                 logger.error("缺少Supabase配置：SUPABASE_URL或SUPABASE_SERVICE_KEY")
                 return
             
-            # 创建客户端
-            self.client = create_client(supabase_url, supabase_key)
+            # 创建客户端（httpx.Client线程安全，worker内的所有线程共用同一个连接池；
+            # 每次请求的耗时计入所属请求的数据库访问统计，见 query_stats.py）
+            http_client = InstrumentedClient(
+                http2=True,
+                follow_redirects=True,
+                timeout=DEFAULT_POSTGREST_CLIENT_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=self.MAX_CONNECTIONS,
+                    max_keepalive_connections=self.MAX_CONNECTIONS,
+                    keepalive_expiry=self.KEEPALIVE_SECONDS
+                )
+            )
+            self.client = create_client(supabase_url, supabase_key, ClientOptions(httpx_client=http_client))
+            # PostgREST客户端在首次访问时才创建，这里提前创建，避免多个线程同时初始化
+            self.client.postgrest
             logger.info("Supabase客户端初始化成功")
             
         except Exception as e:
@@ -62,29 +120,50 @@ class SupabaseManager:
             return False
     
     # 用户相关操作
-    def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+    def submit(self, call: Callable[[], Any]) -> Future:
+        """在后台线程中执行查询（如导出时预取下一页），返回Future
+
+        查询在提交时的上下文中执行，耗时计入发起请求的统计
+        """
+        return self._executor.submit(contextvars.copy_context().run, call)
+    
+    def run_concurrently(self, *calls: Callable[[], Any]) -> List[Any]:
+        """并发执行多个相互独立的查询，按顺序返回结果（任一查询出错时抛出该异常）
+
+        总耗时约等于最慢的一次往返，而不是各次往返之和
+        """
+        if len(calls) <= 1:
+            return [call() for call in calls]
+        futures = [self.submit(call) for call in calls]
+        return [future.result() for future in futures]
+    
+    def get_user_by_username(self, username: str, columns: str = USER_COLUMNS) -> Optional[Dict[str, Any]]:
         """根据用户名获取用户"""
         try:
-            result = self.client.table('users').select('*').eq('username', username).execute()
+            result = self.client.table('users').select(columns).eq('username', username).execute()
             return result.data[0] if result.data else None
         except Exception as e:
             logger.error(f"获取用户失败: {e}")
             return None
     
-    def get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
+    def get_user_by_email(self, email: str, columns: str = USER_COLUMNS) -> Optional[Dict[str, Any]]:
         """根据邮箱获取用户"""
         try:
-            result = self.client.table('users').select('*').eq('email', email).execute()
+            result = self.client.table('users').select(columns).eq('email', email).execute()
             return result.data[0] if result.data else None
         except Exception as e:
             logger.error(f"获取用户失败: {e}")
             return None
     
     def create_user(self, user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """创建用户"""
+        """创建用户（用户名或邮箱重复时抛出DuplicateKeyError）"""
         try:
-            result = self.client.table('users').insert(user_data).execute()
+            result = returning(self.client.table('users').insert(user_data), USER_COLUMNS).execute()
             return result.data[0] if result.data else None
+        except APIError as e:
+            raise_for_duplicate(e)
+            logger.error(f"创建用户失败: {e}")
+            return None
         except Exception as e:
             logger.error(f"创建用户失败: {e}")
             return None
@@ -92,16 +171,16 @@ class SupabaseManager:
     def update_user(self, user_id: int, user_data: Dict[str, Any]) -> bool:
         """更新用户"""
         try:
-            result = self.client.table('users').update(user_data).eq('id', user_id).execute()
+            result = returning(self.client.table('users').update(user_data), 'id').eq('id', user_id).execute()
             return len(result.data) > 0
         except Exception as e:
             logger.error(f"更新用户失败: {e}")
             return False
     
-    def get_all_users(self) -> List[Dict[str, Any]]:
+    def get_all_users(self, columns: str = USER_COLUMNS) -> List[Dict[str, Any]]:
         """获取所有用户"""
         try:
-            result = self.client.table('users').select('*').execute()
+            result = self.client.table('users').select(columns).execute()
             return result.data
         except Exception as e:
             logger.error(f"获取用户列表失败: {e}")
@@ -121,11 +200,11 @@ class SupabaseManager:
         """设置值"""
         try:
             # 先尝试更新
-            result = self.client.table('settings').update({'value': value}).eq('key', key).execute()
+            result = returning(self.client.table('settings').update({'value': value}), 'key').eq('key', key).execute()
             
             # 如果没有更新任何行，则插入新记录
             if not result.data:
-                result = self.client.table('settings').insert({'key': key, 'value': value}).execute()
+                result = returning(self.client.table('settings').insert({'key': key, 'value': value}), 'key').execute()
             
             return True
         except Exception as e:
@@ -133,10 +212,10 @@ class SupabaseManager:
             return False
     
     # 兑换码相关操作
-    def get_redemption_code(self, code: str) -> Optional[Dict[str, Any]]:
+    def get_redemption_code(self, code: str, columns: str = REDEMPTION_CODE_COLUMNS) -> Optional[Dict[str, Any]]:
         """获取兑换码"""
         try:
-            result = self.client.table('redemption_codes').select('*').eq('code', code).execute()
+            result = self.client.table('redemption_codes').select(columns).eq('code', code).execute()
             return result.data[0] if result.data else None
         except Exception as e:
             logger.error(f"获取兑换码失败: {e}")
@@ -145,7 +224,7 @@ class SupabaseManager:
     def create_redemption_code(self, code_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """创建兑换码"""
         try:
-            result = self.client.table('redemption_codes').insert(code_data).execute()
+            result = returning(self.client.table('redemption_codes').insert(code_data), REDEMPTION_CODE_COLUMNS).execute()
             return result.data[0] if result.data else None
         except Exception as e:
             logger.error(f"创建兑换码失败: {e}")
@@ -154,7 +233,7 @@ class SupabaseManager:
     def update_redemption_code(self, code: str, code_data: Dict[str, Any]) -> bool:
         """更新兑换码"""
         try:
-            result = self.client.table('redemption_codes').update(code_data).eq('code', code).execute()
+            result = returning(self.client.table('redemption_codes').update(code_data), 'id').eq('code', code).execute()
             return len(result.data) > 0
         except Exception as e:
             logger.error(f"更新兑换码失败: {e}")
@@ -163,7 +242,7 @@ class SupabaseManager:
     def get_all_redemption_codes(self) -> List[Dict[str, Any]]:
         """获取所有兑换码"""
         try:
-            result = self.client.table('redemption_codes').select('*').execute()
+            result = self.client.table('redemption_codes').select(REDEMPTION_CODE_COLUMNS).execute()
             return result.data
         except Exception as e:
             logger.error(f"获取兑换码列表失败: {e}")
@@ -23,8 +23,9 @@ def switch_to_development():
 SECRET_KEY='dev-secret-key-change-in-production'
 JWT_SECRET_KEY='dev-jwt-secret-change-in-production'
 
-# 本地SQLite数据库
+# 本地SQLite数据库（单机模式，认证、积分、兑换等直接读写本地文件）
 DATABASE_URL='sqlite:///instance/kiddie_color_creations.db'
+DATA_BACKEND=sqlite
 
 # 管理员配置
 ADMIN_USERNAME='admin'
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+JWT令牌工具
+签发携带用户名、启用状态和令牌版本的访问令牌，缓存已验证过签名的令牌，
+并维护按 (用户, 令牌版本) 吊销的内存列表，使大部分接口无需查库即可完成鉴权
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from flask import request
+from flask_jwt_extended import create_access_token, decode_token
+from flask_jwt_extended.exceptions import NoAuthorizationError, InvalidHeaderError, WrongTokenError
+
+from cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# 令牌中的自定义声明
+USERNAME_CLAIM = 'username'
+ACTIVE_CLAIM = 'active'
+TOKEN_VERSION_CLAIM = 'tv'
+
+USER_TOKEN_EXPIRES = timedelta(days=7)
+
+# 已验证令牌缓存：按令牌的SHA-256摘要缓存解码后的声明，避免重复验签
+decoded_token_cache = TTLCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 4096)),
+    ttl=float(os.getenv('TOKEN_CACHE_TTL', 300))
+)
+
+
+def create_user_token(user_data: Dict[str, Any]) -> str:
+    """为用户签发访问令牌（携带用户名、启用状态和令牌版本）"""
+    return create_access_token(
+        identity=str(user_data['id']),
+        additional_claims={
+            USERNAME_CLAIM: user_data['username'],
+            ACTIVE_CLAIM: user_data.get('is_active', True),
+            TOKEN_VERSION_CLAIM: user_data.get('token_version', 0)
+        },
+        expires_delta=USER_TOKEN_EXPIRES
+    )
+
+
+def decode_request_token() -> Dict[str, Any]:
+    """从请求头解析并验证Bearer令牌，已验证过的令牌直接返回缓存的声明
+
+    缺少令牌、令牌无效或不是访问令牌时抛出flask_jwt_extended/PyJWT的异常，
+    由JWTManager注册的错误处理器统一返回401
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        raise NoAuthorizationError('Missing Authorization Header')
+
+    parts = auth_header.split()
+    if len(parts) != 2 or parts[0] != 'Bearer':
+        raise InvalidHeaderError("Bad Authorization header. Expected 'Authorization: Bearer <JWT>'")
+
+    encoded_token = parts[1]
+    token_key = hashlib.sha256(encoded_token.encode('utf-8')).digest()
+
+    claims = decoded_token_cache.get(token_key)
+    if claims is not None and claims.get('exp', 0) > time.time():
+        return claims
+
+    claims = decode_token(encoded_token)
+    if claims.get('type') != 'access':
+        # 刷新令牌等其他类型的令牌不能用于访问接口
+        raise WrongTokenError('Only access tokens are allowed')
+    remaining = claims.get('exp', 0) - time.time()
+    if remaining > 0:
+        decoded_token_cache.set(token_key, claims, ttl=min(remaining, decoded_token_cache.ttl))
+    return claims
+
+
+class RevocationList:
+    """令牌吊销列表
+
+    只保存有吊销记录的用户：user_id -> 最低有效令牌版本，
+    令牌版本低于该值即视为已吊销；被禁用的用户吊销全部令牌。
+    列表定期从数据库刷新，只加载访问令牌有效期内的吊销（更早签发的令牌都已过期）；
+    本进程内的吊销操作立即生效，刷新时合并查询开始之后的本地吊销。
+    """
+
+    ALL_VERSIONS = 2 ** 31
+    # 多加载一天的吊销，容忍应用与数据库之间的时钟和时区差异
+    CLOCK_MARGIN = timedelta(days=1)
+
+    def __init__(self, refresh_interval: float = 30.0):
+        self.refresh_interval = refresh_interval
+        self._min_versions: Dict[int, int] = {}
+        # 本进程内的吊销：user_id -> (操作时间, 最低有效版本)，刷新时合并查询开始之后的部分
+        self._local: Dict[int, Tuple[float, int]] = {}
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def is_revoked(self, user_id: int, version: int) -> bool:
+        """检查 (用户, 令牌版本) 是否已被吊销"""
+        self._maybe_refresh()
+        return version < self._min_versions.get(user_id, 0)
+
+    def _set(self, user_id: int, min_version: int) -> None:
+        self._min_versions[user_id] = min_version
+        self._local[user_id] = (time.monotonic(), min_version)
+
+    def revoke(self, user_id: int, min_version: int) -> None:
+        """吊销该用户低于 min_version 的所有令牌"""
+        with self._lock:
+            if min_version > self._min_versions.get(user_id, 0):
+                self._set(user_id, min_version)
+
+    def revoke_all(self, user_id: int) -> None:
+        """吊销该用户的所有令牌（用户被禁用）"""
+        with self._lock:
+            self._set(user_id, self.ALL_VERSIONS)
+
+    def reinstate(self, user_id: int, min_version: int) -> None:
+        """用户重新启用：撤销revoke_all，只吊销低于 min_version 的令牌"""
+        with self._lock:
+            self._set(user_id, min_version)
+
+    def refresh(self) -> None:
+        """从数据库重新加载令牌有效期内的吊销"""
+        from repository import repository
+        started = time.monotonic()
+        since = datetime.now() - USER_TOKEN_EXPIRES - self.CLOCK_MARGIN
+        min_versions = {}
+        for row in repository.token_revocations(since):
+            if not row.get('is_active', True):
+                min_versions[row['id']] = self.ALL_VERSIONS
+            else:
+                min_versions[row['id']] = row.get('token_version') or 0
+
+        with self._lock:
+            # 查询开始之后本进程内的吊销，查询结果中可能还没有
+            self._local = {user_id: local for user_id, local in self._local.items() if local[0] >= started}
+            for user_id, (_, min_version) in self._local.items():
+                min_versions[user_id] = min_version
+            self._min_versions = min_versions
+            self._loaded_at = time.monotonic()
+
+    def _maybe_refresh(self) -> None:
+        """超过刷新间隔时刷新列表（同一时刻只有一个线程执行刷新）"""
+        if time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.refresh()
+        except Exception as e:
+            # 刷新失败时继续使用旧列表，稍后重试
+            logger.error(f"刷新令牌吊销列表失败: {e}")
+            self._loaded_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def stats(self) -> Dict[str, Any]:
+        """吊销列表统计信息"""
+        return {
+            'revoked_users': len(self._min_versions),
+            'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at else None
+        }
+
+
+revocation_list = RevocationList(
+    refresh_interval=float(os.getenv('REVOCATION_REFRESH_SECONDS', 30))
+)
+
+
+def is_token_revoked(claims: Dict[str, Any]) -> bool:
+    """检查令牌是否已被吊销（旧版令牌不含版本声明，视为版本0）"""
+    if claims.get(ACTIVE_CLAIM) is False:
+        return True
+    try:
+        user_id = int(claims['sub'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    return revocation_list.is_revoked(user_id, claims.get(TOKEN_VERSION_CLAIM, 0))
+
+
+def claims_to_user(claims: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """从令牌声明构造轻量用户信息，旧版令牌（缺少声明）返回None"""
+    if TOKEN_VERSION_CLAIM not in claims or USERNAME_CLAIM not in claims:
+        return None
+    return {
+        'id': int(claims['sub']),
+        'username': claims[USERNAME_CLAIM],
+        'is_active': claims.get(ACTIVE_CLAIM, True),
+        'token_version': claims[TOKEN_VERSION_CLAIM]
+    }
@@ -36,7 +36,9 @@ async function apiRequest(endpoint, options = {}) {
         const data = await response.json();
 
         if (!response.ok) {
-            throw new Error(data.error || `HTTP ${response.status}`);
+            const error = new Error(data.error || `HTTP ${response.status}`);
+            error.status = response.status;
+            throw error;
         }
 
         return data;
@@ -46,6 +48,28 @@ async function apiRequest(endpoint, options = {}) {
     }
 }
 
+// 幂等键：同一操作重试（网络中断、服务端错误）时复用同一个键，服务端不会重复执行
+const pendingIdempotencyKeys = {};
+
+function getIdempotencyKey(scope, payload) {
+    const pending = pendingIdempotencyKeys[scope];
+    if (pending && pending.payload === payload) {
+        return pending.key;
+    }
+    const key = window.crypto && crypto.randomUUID
+        ? crypto.randomUUID()
+        : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+    pendingIdempotencyKeys[scope] = { payload, key };
+    return key;
+}
+
+// 服务端已给出结果（2xx/4xx）后丢弃键，下次提交视为新操作
+function settleIdempotencyKey(scope, status) {
+    if (status && status < 500) {
+        delete pendingIdempotencyKeys[scope];
+    }
+}
+
 // 认证相关函数
 function saveAuthData(token, user) {
     authToken = token;
@@ -174,8 +198,10 @@ async function redeemCode(code) {
     try {
         const data = await apiRequest('/api/auth/redeem', {
             method: 'POST',
+            headers: { 'Idempotency-Key': getIdempotencyKey('redeem', code) },
             body: JSON.stringify({ code })
         });
+        settleIdempotencyKey('redeem', 200);
 
         // 更新用户积分
         currentUser.credits = data.current_credits;
@@ -188,6 +214,7 @@ async function redeemCode(code) {
         return true;
     } catch (error) {
         console.error('兑换失败:', error);
+        settleIdempotencyKey('redeem', error.status);
         showMessage('redeem-message', error.message, 'error');
         return false;
     }
@@ -205,6 +232,11 @@ async function changePassword(currentPassword, newPassword, confirmPassword) {
             })
         });
 
+        // 修改密码后旧令牌失效，保存服务器签发的新令牌
+        if (data.access_token) {
+            saveAuthData(data.access_token, currentUser);
+        }
+
         // 清空表单
         document.getElementById('change-password-form').reset();
 
@@ -367,6 +399,8 @@ const authSystem = {
     refreshUserInfo,
     updateUserInfo,
     loadTransactionHistory,
+    getIdempotencyKey,
+    settleIdempotencyKey,
     openModal,
     closeModal,
     closeUserDropdown